@@ -1,3 +1,5 @@
+import collections
+import hashlib
 import itertools
 import json
 from typing import Any, List, NamedTuple, Optional, Tuple, Union, Callable
@@ -61,6 +63,7 @@ from library.sdxl_original_unet import InferSdxlUNet2DConditionModel
 from library.original_unet import FlashAttentionFunction
 from networks.control_net_lllite import ControlNetLLLite
 from library.utils import GradualLatent, EulerAncestralDiscreteSchedulerGL
+from library.gen_img_server import GenerationServer, Txt2ImgRequest
 from library.utils import setup_logging, add_logging_arguments
 
 setup_logging()
@@ -286,6 +289,56 @@ def replace_vae_attn_to_sdpa():
 
 # endregion
 
+class PromptEmbeddingCache:
+    """
+    LRU cache of the text encoder outputs (embeddings and pool) for each prompt, keyed by the prompt and the state which
+    affects the outputs. if cache_dir is given, the outputs are also saved to and loaded from safetensors files in it.
+    model_key identifies the models (checkpoint, merged networks, Textual Inversion etc.) for the files on disk.
+    """
+
+    def __init__(self, max_entries: int, cache_dir: Optional[str] = None, model_key: str = ""):
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.model_key = model_key
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def get_path(self, key) -> str:
+        digest = hashlib.sha1(repr((self.model_key, key)).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".safetensors")
+
+    def get(self, key, device) -> Optional[Tuple[torch.Tensor, Optional[torch.Tensor]]]:
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+            return value
+
+        if self.cache_dir is not None and os.path.exists(self.get_path(key)):
+            from safetensors.torch import load_file
+
+            sd = load_file(self.get_path(key), device=str(device))
+            value = (sd["embeddings"], sd.get("pool"))
+            self.put(key, value, save_to_disk=False)
+        return value
+
+    def put(self, key, value: Tuple[torch.Tensor, Optional[torch.Tensor]], save_to_disk: bool = True) -> None:
+        if self.max_entries > 0:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+        if save_to_disk and self.cache_dir is not None:
+            from safetensors.torch import save_file
+
+            embeddings, pool = value
+            sd = {"embeddings": embeddings.contiguous().cpu()}
+            if pool is not None:
+                sd["pool"] = pool.contiguous().cpu()
+            save_file(sd, self.get_path(key))
+
+
 # region 画像生成の本体：lpw_stable_diffusion.py （ASL）からコピーして修正
 # https://github.com/huggingface/diffusers/blob/main/examples/community/lpw_stable_diffusion.py
 # Pipelineだけ独立して使えないのと機能追加するのとでコピーして修正
@@ -358,6 +411,10 @@ class PipelineLike:
 
         self.gradual_latent: GradualLatent = None
 
+        # prompt embedding cache
+        self.prompt_embedding_cache: PromptEmbeddingCache = None
+        self.text_encoder_state = None  # hashable state of networks which affects text encoder outputs, e.g. multipliers
+
     # Textual Inversion
     def add_token_replacement(self, text_encoder_index, target_token_id, rep_token_ids):
         self.token_replacements_list[text_encoder_index][target_token_id] = rep_token_ids
@@ -391,6 +448,84 @@ class PipelineLike:
     def set_control_net_lllites(self, ctrl_net_lllites):
         self.control_net_lllites = ctrl_net_lllites
 
+    def set_prompt_embedding_cache(self, prompt_embedding_cache: PromptEmbeddingCache):
+        self.prompt_embedding_cache = prompt_embedding_cache
+
+    def set_text_encoder_state(self, text_encoder_state):
+        self.text_encoder_state = text_encoder_state
+
+    def get_weighted_text_embeddings_with_cache(
+        self,
+        text_encoder_index: int,
+        prompt: List[str],
+        uncond_prompt: Optional[List[str]],
+        max_embeddings_multiples: int,
+        emb_normalize_mode: str,
+    ):
+        # same outputs as get_weighted_text_embeddings, but the text encoder is called only for prompts not in the cache
+        tokenizer = self.tokenizers[text_encoder_index]
+        text_encoder = self.text_encoders[text_encoder_index]
+        token_replacer = self.get_token_replacer(tokenizer)
+
+        texts = prompt + (uncond_prompt or [])
+        unique_texts = list(dict.fromkeys(texts))
+
+        # number of chunks for this batch: the embeddings depend on it because of padding and normalization
+        max_length = (tokenizer.model_max_length - 2) * max_embeddings_multiples + 2
+        tokens, _ = get_prompts_with_weights(tokenizer, token_replacer, unique_texts, max_length - 2)
+        num_multiples = (max([len(token) for token in tokens]) - 1) // (tokenizer.model_max_length - 2) + 1
+        num_multiples = max(1, min(max_embeddings_multiples, num_multiples))
+
+        replacements = self.token_replacements_list[text_encoder_index]
+        replacements_key = tuple(sorted((k, tuple(v)) for k, v in replacements.items()))
+
+        def get_key(text):
+            return (
+                text_encoder_index,
+                text,
+                num_multiples,
+                self.clip_skip,
+                emb_normalize_mode,
+                replacements_key,
+                self.text_encoder_state,
+            )
+
+        outputs = {}
+        for text in unique_texts:
+            value = self.prompt_embedding_cache.get(get_key(text), self.device)
+            if value is not None:
+                outputs[text] = value
+
+        missing_texts = [text for text in unique_texts if text not in outputs]
+        if missing_texts:
+            embeddings, pool, _, _, _ = get_weighted_text_embeddings(
+                self.is_sdxl,
+                tokenizer,
+                text_encoder,
+                prompt=missing_texts,
+                max_embeddings_multiples=num_multiples,
+                min_embeddings_multiples=num_multiples,
+                clip_skip=self.clip_skip,
+                token_replacer=token_replacer,
+                device=self.device,
+                emb_normalize_mode=emb_normalize_mode,
+            )
+            for i, text in enumerate(missing_texts):
+                # clone so that the cache entry does not keep the whole batch alive
+                value = (embeddings[i : i + 1].clone(), None if pool is None else pool[i : i + 1].clone())
+                self.prompt_embedding_cache.put(get_key(text), value)
+                outputs[text] = value
+
+        def concat(texts, index):
+            if outputs[texts[0]][index] is None:
+                return None
+            return torch.cat([outputs[text][index] for text in texts])
+
+        text_embeddings, text_pool = concat(prompt, 0), concat(prompt, 1)
+        if uncond_prompt is None:
+            return text_embeddings, text_pool, None, None
+        return text_embeddings, text_pool, concat(uncond_prompt, 0), concat(uncond_prompt, 1)
+
     def set_gradual_latent(self, gradual_latent):
         if gradual_latent is None:
             logger.info("gradual_latent is disabled")
@@ -433,6 +568,7 @@ class PipelineLike:
         img2img_noise=None,
         clip_guide_images=None,
         emb_normalize_mode: str = "original",
+        cfg_truncation: Optional[float] = None,
         **kwargs,
     ):
         # TODO support secondary prompt
@@ -493,23 +629,46 @@ class PipelineLike:
         tes_uncond_embs = []
         tes_real_uncond_embs = []
 
-        for tokenizer, text_encoder in zip(self.tokenizers, self.text_encoders):
+        # regional prompts with AND are not cached
+        use_prompt_embedding_cache = self.prompt_embedding_cache is not None and not regional_network
+
+        # encode the negative prompt only once if it is same for all images in the batch, and broadcast it
+        # バッチ内のネガティブプロンプトがすべて同じなら一度だけエンコードして全画像で共有する
+        uncond_prompt = negative_prompt if do_classifier_free_guidance else None
+        share_uncond = uncond_prompt is not None and batch_size > 1 and len(set(negative_prompt)) == 1
+        if share_uncond:
+            uncond_prompt = negative_prompt[:1]
+
+        for i, (tokenizer, text_encoder) in enumerate(zip(self.tokenizers, self.text_encoders)):
             token_replacer = self.get_token_replacer(tokenizer)
 
             # use last text_pool, because it is from text encoder 2
-            text_embeddings, text_pool, uncond_embeddings, uncond_pool, _ = get_weighted_text_embeddings(
-                self.is_sdxl,
-                tokenizer,
-                text_encoder,
-                prompt=prompt,
-                uncond_prompt=negative_prompt if do_classifier_free_guidance else None,
-                max_embeddings_multiples=max_embeddings_multiples,
-                clip_skip=self.clip_skip,
-                token_replacer=token_replacer,
-                device=self.device,
-                emb_normalize_mode=emb_normalize_mode,
-                **kwargs,
-            )
+            if use_prompt_embedding_cache:
+                text_embeddings, text_pool, uncond_embeddings, uncond_pool = self.get_weighted_text_embeddings_with_cache(
+                    i,
+                    prompt,
+                    uncond_prompt,
+                    max_embeddings_multiples,
+                    emb_normalize_mode,
+                )
+            else:
+                text_embeddings, text_pool, uncond_embeddings, uncond_pool, _ = get_weighted_text_embeddings(
+                    self.is_sdxl,
+                    tokenizer,
+                    text_encoder,
+                    prompt=prompt,
+                    uncond_prompt=uncond_prompt,
+                    max_embeddings_multiples=max_embeddings_multiples,
+                    clip_skip=self.clip_skip,
+                    token_replacer=token_replacer,
+                    device=self.device,
+                    emb_normalize_mode=emb_normalize_mode,
+                    **kwargs,
+                )
+            if share_uncond:
+                uncond_embeddings = uncond_embeddings.expand(batch_size, -1, -1)
+                if uncond_pool is not None:
+                    uncond_pool = uncond_pool.expand(batch_size, -1)
             tes_text_embs.append(text_embeddings)
             tes_uncond_embs.append(uncond_embeddings)
 
@@ -789,6 +948,20 @@ class PipelineLike:
                     self.scheduler.set_gradual_latent_params(None, None)
                 step_elapsed += 1
 
+            # CFG truncation: skip the uncond pass after the specified ratio of the steps
+            # 指定した割合のステップ以降はuncondの推論を省略する
+            if do_classifier_free_guidance and cfg_truncation is not None and i >= len(timesteps) * cfg_truncation:
+                if regional_network:
+                    logger.warning("cfg_truncation is ignored for regional prompts / 領域別プロンプトではcfg_truncationは無視されます")
+                    cfg_truncation = None
+                else:
+                    logger.info(f"classifier free guidance is disabled (cfg_truncation={cfg_truncation} at {i} / {len(timesteps)})")
+                    do_classifier_free_guidance = False
+                    text_embeddings = text_embeddings[batch_size : batch_size * 2]  # cond only
+                    if self.is_sdxl:
+                        vector_embeddings = vector_embeddings[batch_size : batch_size * 2]
+                    num_latent_input = 1
+
             # expand the latents if we are doing classifier free guidance
             latent_model_input = latents.repeat((num_latent_input, 1, 1, 1))
             latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
@@ -1153,6 +1326,7 @@ def get_weighted_text_embeddings(
     prompt: Union[str, List[str]],
     uncond_prompt: Optional[Union[str, List[str]]] = None,
     max_embeddings_multiples: Optional[int] = 1,
+    min_embeddings_multiples: Optional[int] = 1,
     no_boseos_middle: Optional[bool] = False,
     skip_parsing: Optional[bool] = False,
     skip_weighting: Optional[bool] = False,
@@ -1196,7 +1370,7 @@ def get_weighted_text_embeddings(
         max_embeddings_multiples,
         (max_length - 1) // (tokenizer.model_max_length - 2) + 1,
     )
-    max_embeddings_multiples = max(1, max_embeddings_multiples)
+    max_embeddings_multiples = max(min_embeddings_multiples, max_embeddings_multiples)
     max_length = (tokenizer.model_max_length - 2) * max_embeddings_multiples + 2
 
     # pad the length of tokens and weights
@@ -1902,6 +2076,30 @@ def main(args):
     pipe.set_control_net_lllites(control_net_lllites)
     logger.info("pipeline is ready.")
 
+    if args.prompt_embedding_cache_size is not None or args.prompt_embedding_cache_dir is not None:
+        # identify the models for the cache files: outputs of text encoders depend on them
+        def file_key(path):
+            return (path, os.path.getmtime(path)) if path is not None and os.path.isfile(path) else path
+
+        model_key = json.dumps(
+            {
+                "ckpt": file_key(args.ckpt),
+                "v2": args.v2,
+                "sdxl": is_sdxl,
+                "dtype": str(dtype),
+                "network_module": args.network_module,
+                "network_weights": [file_key(w) for w in args.network_weights or []],
+                "network_mul": args.network_mul,
+                "network_args": args.network_args,
+                "network_merge": args.network_merge,
+                "network_merge_n_models": args.network_merge_n_models,
+                "textual_inversion_embeddings": [file_key(e) for e in args.textual_inversion_embeddings or []],
+            }
+        )
+        cache_size = 256 if args.prompt_embedding_cache_size is None else args.prompt_embedding_cache_size
+        pipe.set_prompt_embedding_cache(PromptEmbeddingCache(cache_size, args.prompt_embedding_cache_dir, model_key))
+        logger.info(f"prompt embedding cache is enabled: size={cache_size}, dir={args.prompt_embedding_cache_dir}")
+
     if args.diffusers_xformers:
         pipe.enable_xformers_memory_efficient_attention()
 
@@ -2217,7 +2415,7 @@ def main(args):
             prompter.shuffle()
 
         # バッチ処理の関数
-        def process_batch(batch: List[BatchData], highres_fix, highres_1st=False):
+        def process_batch(batch: List[BatchData], highres_fix, highres_1st=False, save_images=True):
             batch_size = len(batch)
 
             # highres_fixの処理
@@ -2341,10 +2539,7 @@ def main(args):
             raw_prompts = []
             filenames = []
             start_code = torch.zeros((batch_size, *noise_shape), device=device, dtype=dtype)
-            noises = [
-                torch.zeros((batch_size, *noise_shape), device=device, dtype=dtype)
-                for _ in range(steps * scheduler_num_noises_per_step)
-            ]
+            noises = torch.zeros((steps * scheduler_num_noises_per_step, batch_size, *noise_shape), device=device, dtype=dtype)
             seeds = []
             clip_prompts = []
 
@@ -2401,16 +2596,26 @@ def main(args):
                         if i > 0 and all_guide_images_are_same:
                             all_guide_images_are_same = guide_images[-2] is guide_image
 
-                # make start code
-                torch.manual_seed(seed)
-                start_code[i] = torch.randn(noise_shape, device=device, dtype=dtype)
+                if args.vectorized_noise:
+                    # start code, noises for all steps and img2img noise in one call, in the same order as below
+                    generator = torch.Generator(device=device).manual_seed(seed)
+                    num_noises = 1 + len(noises) + (1 if i2i_noises is not None else 0)
+                    seed_noises = torch.randn((num_noises, *noise_shape), generator=generator, device=device, dtype=dtype)
+                    start_code[i] = seed_noises[0]
+                    noises[:, i] = seed_noises[1 : 1 + len(noises)]
+                    if i2i_noises is not None:
+                        i2i_noises[i] = seed_noises[-1]
+                else:
+                    # make start code
+                    torch.manual_seed(seed)
+                    start_code[i] = torch.randn(noise_shape, device=device, dtype=dtype)
 
-                # make each noises
-                for j in range(steps * scheduler_num_noises_per_step):
-                    noises[j][i] = torch.randn(noise_shape, device=device, dtype=dtype)
+                    # make each noises
+                    for j in range(steps * scheduler_num_noises_per_step):
+                        noises[j][i] = torch.randn(noise_shape, device=device, dtype=dtype)
 
-                if i2i_noises is not None:  # img2img noise
-                    i2i_noises[i] = torch.randn(noise_shape, device=device, dtype=dtype)
+                    if i2i_noises is not None:  # img2img noise
+                        i2i_noises[i] = torch.randn(noise_shape, device=device, dtype=dtype)
 
             noise_manager.reset_sampler_noises(noises)
 
@@ -2434,6 +2639,7 @@ def main(args):
             if networks:
                 # 追加ネットワークの処理
                 shared = {}
+                pipe.set_text_encoder_state(tuple(network_muls if network_muls else network_default_muls))
                 for n, m in zip(networks, network_muls if network_muls else network_default_muls):
                     n.set_multiplier(m)
                     if regional_network:
@@ -2473,9 +2679,12 @@ def main(args):
                 clip_prompts=clip_prompts,
                 clip_guide_images=guide_images,
                 emb_normalize_mode=args.emb_normalize_mode,
+                cfg_truncation=args.cfg_truncation,
             )
             if highres_1st and not args.highres_fix_save_1st:  # return images or latents
                 return images
+            if not save_images:  # server mode
+                return images
 
             # save image
             highres_prefix = ("0" if highres_1st else "1") if highres_fix else ""
@@ -2495,6 +2704,8 @@ def main(args):
                     metadata.add_text("negative-prompt", negative_prompt)
                 if negative_scale is not None:
                     metadata.add_text("negative-scale", str(negative_scale))
+                if args.cfg_truncation is not None:
+                    metadata.add_text("cfg-truncation", str(args.cfg_truncation))
                 if clip_prompt is not None:
                     metadata.add_text("clip-prompt", clip_prompt)
                 if raw_prompt is not None:
@@ -2540,6 +2751,59 @@ def main(args):
 
             return images
 
+        if args.server_port is not None:
+            # serve txt2img requests with the loaded models instead of the prompts
+            server_step = itertools.count()
+
+            def make_items_for_request(request: Txt2ImgRequest):
+                network_muls = request.network_muls
+                if network_muls:
+                    network_muls = network_muls[: len(networks)]
+                    while len(network_muls) < len(networks):
+                        network_muls.append(network_muls[-1])
+
+                keys_and_items = []
+                for seed in request.seeds:
+                    base = BatchDataBase(
+                        next(server_step), request.prompt, request.negative_prompt, seed, None, None, None, None, None, None
+                    )
+                    ext = BatchDataExt(
+                        request.width or args.W,
+                        request.height or args.H,
+                        args.original_width,
+                        args.original_height,
+                        args.original_width_negative,
+                        args.original_height_negative,
+                        args.crop_left,
+                        args.crop_top,
+                        request.steps or args.steps,
+                        request.scale or args.scale,
+                        args.negative_scale,
+                        0.8 if args.strength is None else args.strength,
+                        tuple(network_muls) if network_muls else None,
+                        None,
+                    )
+                    # images with the same ext can be generated in one batch, same as batch_data in the prompt loop
+                    keys_and_items.append(((ext, request.save_images), (BatchData(False, base, ext), request.save_images)))
+                return keys_and_items
+
+            def generate_for_items(items):
+                return process_batch([bd for bd, _ in items], highres_fix, save_images=items[0][1])
+
+            server = GenerationServer(
+                make_items_for_request,
+                generate_for_items,
+                args.server_host,
+                args.server_port,
+                os.path.basename(args.ckpt),
+                args.sampler,
+                args.batch_size,
+                args.server_max_wait,
+                args.server_max_images,
+            )
+            server.serve_forever()
+            break
+
         # 画像生成のプロンプトが一周するまでのループ
         prompt_index = 0
         global_step = 0
@@ -2985,6 +3249,30 @@ def setup_parser() -> argparse.ArgumentParser:
     parser.add_argument("--strength", type=float, default=None, help="img2img strength / img2img時のstrength")
     parser.add_argument("--images_per_prompt", type=int, default=1, help="number of images per prompt / プロンプトあたりの出力枚数")
     parser.add_argument("--outdir", type=str, default="outputs", help="dir to write results to / 生成画像の出力先")
+    parser.add_argument(
+        "--server_port",
+        type=int,
+        default=None,
+        help="run as a server with the models loaded, which serves txt2img API compatible with a subset of AUTOMATIC1111 web UI"
+        + " / モデルを読み込んだままサーバーとして起動し、AUTOMATIC1111 web UIの一部互換のtxt2img APIを提供する",
+    )
+    parser.add_argument(
+        "--server_host", type=str, default="127.0.0.1", help="host address for --server_port / サーバーのホストアドレス"
+    )
+    parser.add_argument(
+        "--server_max_wait",
+        type=float,
+        default=0.1,
+        help="max seconds to wait for other requests to fill a batch of --batch_size in server mode"
+        + " / サーバーモードで、--batch_sizeのバッチを他のリクエストで埋めるために待つ最大秒数",
+    )
+    parser.add_argument(
+        "--server_max_images",
+        type=int,
+        default=64,
+        help="max number of images (batch_size * n_iter) in a request in server mode"
+        + " / サーバーモードで、1リクエストあたりの最大画像数（batch_size * n_iter）",
+    )
     parser.add_argument(
         "--sequential_file_name", action="store_true", help="sequential output file name / 生成画像のファイル名を連番にする"
     )
@@ -3097,6 +3385,13 @@ def setup_parser() -> argparse.ArgumentParser:
         default=None,
         help="seed, or seed of seeds in multiple generation / 1枚生成時のseed、または複数枚生成時の乱数seedを決めるためのseed",
     )
+    parser.add_argument(
+        "--vectorized_noise",
+        action="store_true",
+        help="generate all noises for a seed in one call instead of one call per step. same images on CPU if width and height are"
+        + " multiples of 16, but different images from the same seed on CUDA"
+        + " / seedごとのノイズをステップごとではなく一度に生成する。CPUでは幅と高さが16の倍数なら同じ画像になるが、CUDAでは同じseedでも画像が変わる",
+    )
     parser.add_argument(
         "--iter_same_seed",
         action="store_true",
@@ -3191,6 +3486,20 @@ def setup_parser() -> argparse.ArgumentParser:
         choices=["original", "none", "abs"],
         help="embedding normalization mode / embeddingの正規化モード",
     )
+    parser.add_argument(
+        "--prompt_embedding_cache_size",
+        type=int,
+        default=None,
+        help="number of prompts to cache text encoder outputs in memory, default is 256 if --prompt_embedding_cache_dir is given"
+        + " / Text Encoderの出力をメモリにキャッシュするプロンプト数。--prompt_embedding_cache_dir指定時のデフォルトは256",
+    )
+    parser.add_argument(
+        "--prompt_embedding_cache_dir",
+        type=str,
+        default=None,
+        help="directory to save and load the cached text encoder outputs across runs"
+        + " / キャッシュしたText Encoderの出力を実行をまたいで保存・読み込みするディレクトリ",
+    )
     parser.add_argument(
         "--guide_image_path", type=str, default=None, nargs="*", help="image to ControlNet / ControlNetでガイドに使う画像"
     )
@@ -3247,6 +3556,14 @@ def setup_parser() -> argparse.ArgumentParser:
         help="set another guidance scale for negative prompt / ネガティブプロンプトのscaleを指定する",
     )
 
+    parser.add_argument(
+        "--cfg_truncation",
+        type=float,
+        default=None,
+        help="disable classifier free guidance after this ratio of the steps to skip the uncond pass, e.g. 0.8"
+        + " / 指定した割合のステップ以降はclassifier free guidanceを無効にしてuncondの推論を省略する（例：0.8）",
+    )
+
     parser.add_argument(
         "--control_net_lllite_models",
         type=str,
@@ -78,6 +78,7 @@ class BaseSubsetParams:
     caption_tag_dropout_rate: float = 0.0
     token_warmup_min: int = 1
     token_warmup_step: float = 0
+    network_multiplier: Optional[float] = None
 
 
 @dataclass
@@ -109,6 +110,8 @@ class BaseDatasetParams:
     resolution: Optional[Tuple[int, int]] = None
     network_multiplier: float = 1.0
     debug_dataset: bool = False
+    latents_cache_dir: Optional[str] = None
+    cache_storage_dtype: str = "float32"
 
 
 @dataclass
@@ -199,6 +202,7 @@ class ConfigSanitizer:
         "token_warmup_step": Any(float, int),
         "caption_prefix": str,
         "caption_suffix": str,
+        "network_multiplier": float,
     }
     # DO means DropOut
     DO_SUBSET_ASCENDABLE_SCHEMA = {
@@ -242,6 +246,8 @@ class ConfigSanitizer:
         "min_bucket_reso": int,
         "resolution": functools.partial(__validate_and_convert_scalar_or_twodim.__func__, int),
         "network_multiplier": float,
+        "latents_cache_dir": str,
+        "cache_storage_dtype": Any(*train_util.CACHE_STORAGE_DTYPES),
     }
 
     # options handled by argparse but not handled by user config
@@ -254,6 +260,7 @@ class ConfigSanitizer:
     ARGPARSE_NULLABLE_OPTNAMES = [
         "face_crop_aug_range",
         "resolution",
+        "latents_cache_dir",
     ]
     # prepare map because option name may differ among argparse and user config
     ARGPARSE_OPTNAME_TO_CONFIG_OPTNAME = {
@@ -543,6 +550,7 @@ def generate_dataset_group_by_blueprint(dataset_group_blueprint: DatasetGroupBlu
           token_warmup_min: {subset.token_warmup_min},
           token_warmup_step: {subset.token_warmup_step},
           alpha_mask: {subset.alpha_mask},
+          network_multiplier: {dataset.get_network_multiplier(subset)},
       """
                 ),
                 "  ",
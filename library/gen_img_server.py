@@ -0,0 +1,321 @@
+# HTTP server for gen_img.py: keeps the models loaded and serves a subset of AUTOMATIC1111 web UI API
+# supported: POST /sdapi/v1/txt2img, GET /sdapi/v1/sd-models, /sdapi/v1/samplers, /sdapi/v1/options
+
+import base64
+import collections
+import io
+import json
+import queue
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Hashable, List, NamedTuple, Optional, Tuple
+
+from PIL import Image
+
+from library.utils import setup_logging
+
+setup_logging()
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Txt2ImgRequest:
+    """
+    parameters of a txt2img request. fields not in the payload are None and the defaults of gen_img.py are used.
+    """
+
+    def __init__(
+        self,
+        prompt: str,
+        negative_prompt: str,
+        seed: int,
+        num_images: int,
+        width: Optional[int],
+        height: Optional[int],
+        steps: Optional[int],
+        scale: Optional[float],
+        network_muls: Optional[List[float]],
+        save_images: bool,
+    ):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.seed = seed
+        self.num_images = num_images
+        self.width = width
+        self.height = height
+        self.steps = steps
+        self.scale = scale
+        self.network_muls = network_muls
+        self.save_images = save_images
+
+    @property
+    def seeds(self) -> List[int]:
+        return [(self.seed + i) % 2**32 for i in range(self.num_images)]
+
+    @staticmethod
+    def from_payload(payload: Dict[str, Any], max_images: Optional[int] = None) -> "Txt2ImgRequest":
+        if not isinstance(payload, dict):
+            raise ValueError(f"request body must be a JSON object / リクエストの本体はJSONオブジェクトで指定してください")
+
+        def get(key, type_fn, default=None):
+            value = payload.get(key)
+            return default if value is None else type_fn(value)
+
+        seed = get("seed", int, -1)
+        if seed < 0:
+            seed = random.randint(0, 2**32 - 1)
+
+        width = get("width", int)
+        height = get("height", int)
+        for size in [width, height]:
+            if size is not None and (size <= 0 or size % 8 != 0):
+                raise ValueError(
+                    f"width and height must be positive multiples of 8 / width、heightは8の倍数で指定してください: {size}"
+                )
+
+        num_images = get("batch_size", int, 1) * get("n_iter", int, 1)
+        if num_images <= 0:
+            raise ValueError(f"batch_size and n_iter must be positive / batch_size、n_iterは1以上で指定してください")
+        if max_images is not None and num_images > max_images:
+            raise ValueError(
+                f"batch_size * n_iter must be {max_images} or less / batch_size * n_iterは{max_images}以下で指定してください: {num_images}"
+            )
+
+        network_muls = payload.get("network_multipliers")  # gen_img.py extension, same as --am
+        if network_muls is not None:
+            network_muls = [float(m) for m in network_muls]
+
+        return Txt2ImgRequest(
+            prompt=get("prompt", str, ""),
+            negative_prompt=get("negative_prompt", str, ""),
+            seed=seed,
+            num_images=num_images,
+            width=width,
+            height=height,
+            steps=get("steps", int),
+            scale=get("cfg_scale", float),
+            network_muls=network_muls,
+            save_images=get("save_images", bool, False),
+        )
+
+
+class GenerationJob:
+    def __init__(self, request: Txt2ImgRequest, num_items: int):
+        self.request = request
+        self.images: List[Optional[Image.Image]] = [None] * num_items
+        self.num_remaining = num_items
+        self.error: Optional[Exception] = None
+        self.done = threading.Event()
+
+
+class ScheduledItem(NamedTuple):
+    job: GenerationJob
+    index: int  # index of the image in the job
+    item: Any
+    deadline: float
+
+
+class BatchScheduler:
+    """
+    groups pending images of the requests by the key which must be same in a batch (resolution, steps, scale, network
+    multipliers etc.). a group is processed when it reaches max_batch_size, or when the oldest pending image has waited
+    for max_wait seconds, so that batches are filled with the images of several requests and the latency is bounded.
+    """
+
+    def __init__(self, max_batch_size: int, max_wait: float):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.pending: "collections.OrderedDict[Hashable, List[ScheduledItem]]" = collections.OrderedDict()
+
+    def add(self, job: GenerationJob, keys_and_items: List[Tuple[Hashable, Any]], now: float):
+        for index, (key, item) in enumerate(keys_and_items):
+            self.pending.setdefault(key, []).append(ScheduledItem(job, index, item, now + self.max_wait))
+
+    def wait_time(self, now: float) -> Optional[float]:
+        # seconds until the oldest pending image expires, None if no image is pending
+        if not self.pending:
+            return None
+        oldest = min(items[0].deadline for items in self.pending.values())
+        return max(0.0, oldest - now)
+
+    def pop_batch(self, now: float) -> Optional[List[ScheduledItem]]:
+        if not self.pending:
+            return None
+
+        # the group with the oldest image first if it expired, then a full group
+        key = min(self.pending.keys(), key=lambda k: self.pending[k][0].deadline)
+        if self.pending[key][0].deadline > now:
+            key = next((k for k, items in self.pending.items() if len(items) >= self.max_batch_size), None)
+            if key is None:
+                return None
+
+        items = self.pending[key]
+        batch, rest = items[: self.max_batch_size], items[self.max_batch_size :]
+        if rest:
+            self.pending[key] = rest
+        else:
+            del self.pending[key]
+        return batch
+
+
+def encode_image(image: Image.Image) -> str:
+    with io.BytesIO() as buffer:
+        image.save(buffer, format="PNG")
+        return base64.b64encode(buffer.getvalue()).decode("ascii")
+
+
+class GenerationServer:
+    """
+    HTTP requests are handled in threads and queued. generation is done in the thread calling serve_forever,
+    because models and the pipeline are not thread safe.
+
+    make_items_fn: takes a Txt2ImgRequest and returns (key, item) for each image. items with the same key can be
+        generated in the same batch
+    generate_fn: takes a list of items with the same key and returns the images
+    """
+
+    def __init__(
+        self,
+        make_items_fn: Callable[[Txt2ImgRequest], List[Tuple[Hashable, Any]]],
+        generate_fn: Callable[[List[Any]], List[Image.Image]],
+        host: str,
+        port: int,
+        model_title: str,
+        sampler_name: str,
+        max_batch_size: int,
+        max_wait: float,
+        max_images: Optional[int] = None,
+    ):
+        self.make_items_fn = make_items_fn
+        self.generate_fn = generate_fn
+        self.host = host
+        self.port = port
+        self.model_title = model_title
+        self.sampler_name = sampler_name
+        self.max_images = max_images  # max number of images in a request
+        self.scheduler = BatchScheduler(max_batch_size, max_wait)
+        self.jobs: "queue.Queue[Tuple[GenerationJob, List[Tuple[Hashable, Any]]]]" = queue.Queue()
+
+    def submit(self, request: Txt2ImgRequest) -> GenerationJob:
+        keys_and_items = self.make_items_fn(request)
+        job = GenerationJob(request, len(keys_and_items))
+        self.jobs.put((job, keys_and_items))
+        job.done.wait()
+        return job
+
+    def process_batch(self, batch: List[ScheduledItem]):
+        batch = [scheduled for scheduled in batch if scheduled.job.error is None]
+        if not batch:
+            return
+
+        num_jobs = len(set(id(scheduled.job) for scheduled in batch))
+        logger.info(f"generate {len(batch)} images for {num_jobs} requests")
+        try:
+            images = self.generate_fn([scheduled.item for scheduled in batch])
+        except Exception as e:
+            logger.exception(f"error in generation / 生成中にエラーが発生しました: {e}")
+            for scheduled in batch:
+                scheduled.job.error = e
+                scheduled.job.done.set()
+            return
+
+        for scheduled, image in zip(batch, images):
+            job = scheduled.job
+            job.images[scheduled.index] = image
+            job.num_remaining -= 1
+            if job.num_remaining == 0:
+                job.done.set()
+
+    def serve_forever(self):
+        server = ThreadingHTTPServer((self.host, self.port), make_handler_class(self))
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        logger.info(f"server is running on http://{self.host}:{self.port} / サーバーを起動しました")
+
+        try:
+            while True:
+                # wait for a new request until the oldest pending image expires
+                try:
+                    timeout = self.scheduler.wait_time(time.monotonic())
+                    job, keys_and_items = self.jobs.get(timeout=timeout)
+                    self.scheduler.add(job, keys_and_items, time.monotonic())
+                    while not self.jobs.empty():
+                        job, keys_and_items = self.jobs.get_nowait()
+                        self.scheduler.add(job, keys_and_items, time.monotonic())
+                except queue.Empty:
+                    pass
+
+                batch = self.scheduler.pop_batch(time.monotonic())
+                while batch is not None:
+                    self.process_batch(batch)
+                    batch = self.scheduler.pop_batch(time.monotonic())
+        except KeyboardInterrupt:
+            logger.info("server is stopped / サーバーを停止しました")
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+def make_handler_class(server: GenerationServer):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def send_json(self, obj, status=200):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = self.path.split("?")[0].rstrip("/")
+            if path == "/sdapi/v1/sd-models":
+                self.send_json([{"title": server.model_title, "model_name": server.model_title, "filename": server.model_title}])
+            elif path == "/sdapi/v1/samplers":
+                self.send_json([{"name": server.sampler_name, "aliases": [], "options": {}}])
+            elif path == "/sdapi/v1/options":
+                self.send_json({"sd_model_checkpoint": server.model_title})
+            else:
+                self.send_json({"detail": "Not Found"}, 404)
+
+        def do_POST(self):
+            path = self.path.split("?")[0].rstrip("/")
+            if path != "/sdapi/v1/txt2img":
+                self.send_json({"detail": "Not Found"}, 404)
+                return
+
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                payload = json.loads(self.rfile.read(length) or b"{}")
+                request = Txt2ImgRequest.from_payload(payload, server.max_images)
+            except (ValueError, TypeError) as e:
+                self.send_json({"detail": str(e)}, 422)
+                return
+
+            try:
+                job = server.submit(request)
+            except ValueError as e:  # invalid parameters found in making items
+                self.send_json({"detail": str(e)}, 422)
+                return
+
+            if job.error is not None:
+                self.send_json({"detail": str(job.error)}, 500)
+                return
+
+            info = {
+                "prompt": request.prompt,
+                "negative_prompt": request.negative_prompt,
+                "seed": request.seed,
+                "all_seeds": request.seeds,
+                "sampler_name": server.sampler_name,
+                "sd_model_name": server.model_title,
+            }
+            images = [encode_image(image) for image in job.images]
+            self.send_json({"images": images, "parameters": payload, "info": json.dumps(info)})
+
+    return Handler
@@ -3,6 +3,7 @@
 import argparse
 import ast
 import asyncio
+import collections
 import datetime
 import importlib
 import json
@@ -27,6 +28,10 @@ import os
 import random
 import hashlib
 import subprocess
+import sys
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
 import toml
 
@@ -140,8 +145,39 @@ IMAGE_TRANSFORMS = transforms.Compose(
 
 TEXT_ENCODER_OUTPUTS_CACHE_SUFFIX = "_te_outputs.npz"
 
+# number of tokenized captions kept per dataset (and per DataLoader worker)
+INPUT_IDS_CACHE_SIZE = 8192
+
 
 class ImageInfo:
+    # 画像数が多い場合のメモリ使用量を抑えるため__dict__を持たない
+    __slots__ = (
+        "image_key",
+        "num_repeats",
+        "caption",
+        "is_reg",
+        "absolute_path",
+        "image_size",
+        "resized_size",
+        "bucket_reso",
+        "latents",
+        "latents_flipped",
+        "latents_npz",
+        "latents_npz_flipped",
+        "latents_store_key",
+        "latents_original_size",
+        "latents_crop_ltrb",
+        "cond_img_path",
+        "image",
+        "text_encoder_outputs_npz",
+        "text_encoder_outputs1",
+        "text_encoder_outputs2",
+        "text_encoder_pool2",
+        "alpha_mask",
+        "input_ids1",
+        "input_ids2",
+    )
+
     def __init__(self, image_key: str, num_repeats: int, caption: str, is_reg: bool, absolute_path: str) -> None:
         self.image_key: str = image_key
         self.num_repeats: int = num_repeats
@@ -154,6 +190,8 @@ class ImageInfo:
         self.latents: torch.Tensor = None
         self.latents_flipped: torch.Tensor = None
         self.latents_npz: str = None
+        self.latents_npz_flipped: str = None  # old format, not used
+        self.latents_store_key: Optional[str] = None  # key in ShardedLatentsStore, used instead of latents_npz
         self.latents_original_size: Tuple[int, int] = None  # original image size, not latents size
         self.latents_crop_ltrb: Tuple[int, int] = None  # crop left top right bottom in original pixel size, not latents size
         self.cond_img_path: str = None
@@ -164,6 +202,9 @@ class ImageInfo:
         self.text_encoder_outputs2: Optional[torch.Tensor] = None
         self.text_encoder_pool2: Optional[torch.Tensor] = None
         self.alpha_mask: Optional[torch.Tensor] = None  # alpha mask can be flipped in runtime
+        # set by tools/cache_text_encoder_outputs.py
+        self.input_ids1: Optional[torch.Tensor] = None
+        self.input_ids2: Optional[torch.Tensor] = None
 
 
 class BucketManager:
@@ -188,15 +229,21 @@ class BucketManager:
 
         self.resos = []
         self.reso_to_id = {}
-        self.buckets = []  # 前処理時は (image_key, image, original size, crop left/top)、学習時は image_key
+        self.buckets = []  # 前処理時は (image_key, image, original size, crop left/top)、学習時は画像のindexのnp.ndarray
 
     def add_image(self, reso, image_or_info):
         bucket_id = self.reso_to_id[reso]
         self.buckets[bucket_id].append(image_or_info)
 
     def shuffle(self):
-        for bucket in self.buckets:
-            random.shuffle(bucket)
+        for i, bucket in enumerate(self.buckets):
+            if isinstance(bucket, np.ndarray):
+                # same permutation as random.shuffle on a list, but without swapping numpy scalars one by one
+                permutation = list(range(len(bucket)))
+                random.shuffle(permutation)
+                self.buckets[i] = bucket[permutation]
+            else:
+                random.shuffle(bucket)
 
     def sort(self):
         # 解像度順にソートする（表示時、メタデータ格納時の見栄えをよくするためだけ）。bucketsも入れ替えてreso_to_idも振り直す
@@ -298,6 +345,97 @@ class BucketManager:
         ar_error = (reso[0] / reso[1]) - aspect_ratio
         return reso, resized_size, ar_error
 
+    def _select_predefined_resos(self, widths: np.ndarray, heights: np.ndarray, aspect_ratios: np.ndarray) -> np.ndarray:
+        # same as the predefined reso selection in select_bucket, but vectorized
+        predefined_resos = np.array(self.predefined_resos, dtype=np.int64).reshape(-1, 2)
+
+        # aspect ratio errorが最も少ないもの: neighbors in the sorted unique aspect ratios are the candidates.
+        # np.unique returns the first index for each aspect ratio, same as argmin in select_bucket
+        unique_ars, first_ids = np.unique(self.predefined_aspect_ratios, return_index=True)
+        upper = np.clip(np.searchsorted(unique_ars, aspect_ratios), 0, len(unique_ars) - 1)
+        lower = np.clip(upper - 1, 0, len(unique_ars) - 1)
+        lower_errors = np.abs(unique_ars[lower] - aspect_ratios)
+        upper_errors = np.abs(unique_ars[upper] - aspect_ratios)
+        use_lower = (lower_errors < upper_errors) | ((lower_errors == upper_errors) & (first_ids[lower] < first_ids[upper]))
+        predefined_ids = np.where(use_lower, first_ids[lower], first_ids[upper])
+
+        # 同じ解像度があればそれを優先する
+        predefined_keys = (predefined_resos[:, 0] << 32) | predefined_resos[:, 1]
+        image_keys = (widths << 32) | heights
+        key_order = np.argsort(predefined_keys)
+        pos = np.clip(np.searchsorted(predefined_keys[key_order], image_keys), 0, len(predefined_keys) - 1)
+        exact_match = predefined_keys[key_order][pos] == image_keys
+        predefined_ids = np.where(exact_match, key_order[pos], predefined_ids)
+
+        return predefined_resos[predefined_ids]
+
+    def _round_to_steps_array(self, x: np.ndarray) -> np.ndarray:
+        x = np.floor(x + 0.5).astype(np.int64)
+        return x - x % self.reso_steps
+
+    def select_buckets(self, image_widths, image_heights) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        r"""
+        select_bucketを多数の画像に対してまとめて行う
+        vectorized version of select_bucket for many images. results are same as calling select_bucket for each image
+        returns bucket ids [N], resized sizes (width, height) [N,2] and aspect ratio errors [N]
+        """
+        widths = np.asarray(image_widths, dtype=np.int64)
+        heights = np.asarray(image_heights, dtype=np.int64)
+        aspect_ratios = widths / heights
+
+        if not self.no_upscale:
+            # 拡大および縮小を行う
+            resos = self._select_predefined_resos(widths, heights, aspect_ratios)
+            ar_resos = resos[:, 0] / resos[:, 1]
+            scales = np.where(aspect_ratios > ar_resos, resos[:, 1] / heights, resos[:, 0] / widths)
+            resized_sizes = np.stack(
+                [np.floor(widths * scales + 0.5).astype(np.int64), np.floor(heights * scales + 0.5).astype(np.int64)], axis=1
+            )
+        else:
+            # 縮小のみを行う
+            with np.errstate(divide="ignore", invalid="ignore"):
+                resized_widths = np.sqrt(self.max_area * aspect_ratios)
+                resized_heights = self.max_area / resized_widths
+            too_large = widths * heights > self.max_area
+            assert np.all(
+                np.abs(resized_widths[too_large] / resized_heights[too_large] - aspect_ratios[too_large]) < 1e-2
+            ), "aspect is illegal"
+
+            with np.errstate(divide="ignore", invalid="ignore"):
+                b_widths_rounded = self._round_to_steps_array(resized_widths)
+                b_heights_in_wr = self._round_to_steps_array(b_widths_rounded / aspect_ratios)
+                ar_widths_rounded = b_widths_rounded / b_heights_in_wr
+
+                b_heights_rounded = self._round_to_steps_array(resized_heights)
+                b_widths_in_hr = self._round_to_steps_array(b_heights_rounded * aspect_ratios)
+                ar_heights_rounded = b_widths_in_hr / b_heights_rounded
+
+                use_width = np.abs(ar_widths_rounded - aspect_ratios) < np.abs(ar_heights_rounded - aspect_ratios)
+                downscaled_widths = np.where(
+                    use_width, b_widths_rounded, np.floor(b_heights_rounded * aspect_ratios + 0.5).astype(np.int64)
+                )
+                downscaled_heights = np.where(
+                    use_width, np.floor(b_widths_rounded / aspect_ratios + 0.5).astype(np.int64), b_heights_rounded
+                )
+
+            resized_sizes = np.stack(
+                [np.where(too_large, downscaled_widths, widths), np.where(too_large, downscaled_heights, heights)], axis=1
+            )
+
+            # 画像のサイズ未満をbucketのサイズとする（paddingせずにcroppingする）
+            resos = resized_sizes - resized_sizes % self.reso_steps
+
+        unique_resos, inverse = np.unique(resos, axis=0, return_inverse=True)
+        unique_ids = []
+        for reso in unique_resos:
+            reso = (int(reso[0]), int(reso[1]))
+            self.add_if_new_reso(reso)
+            unique_ids.append(self.reso_to_id[reso])
+        bucket_ids = np.array(unique_ids, dtype=np.int64)[inverse.reshape(-1)]
+
+        ar_errors = resos[:, 0] / resos[:, 1] - aspect_ratios
+        return bucket_ids, resized_sizes, ar_errors
+
     @staticmethod
     def get_crop_ltrb(bucket_reso: Tuple[int, int], image_size: Tuple[int, int]):
         # Stability AIの前処理に合わせてcrop left/topを計算する。crop rightはflipのaugmentationのために求める
@@ -339,29 +477,121 @@ class AugHelper:
         #     ],
         #     p=0.33,
         # )
-        hue_shift_limit = 8
+        hue_shift, gamma = self.sample_color_aug_params()
 
         # remove dependency to albumentations
+        if hue_shift is not None:
+            # hue shift
+            hsv_img = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+            if hue_shift < 0:
+                hue_shift = 180 + hue_shift
+            hsv_img[:, :, 0] = (hsv_img[:, :, 0] + hue_shift) % 180
+            image = cv2.cvtColor(hsv_img, cv2.COLOR_HSV2BGR)
+        elif gamma is not None:
+            # random gamma
+            image = np.clip(image**gamma, 0, 255).astype(np.uint8)
+
+        return {"image": image}
+
+    def sample_color_aug_params(self) -> Tuple[Optional[float], Optional[float]]:
+        # returns (hue shift in OpenCV hue unit, gamma), either or both are None. same random sequence as color_aug
+        hue_shift_limit = 8
+
         if random.random() <= 0.33:
             if random.random() > 0.5:
-                # hue shift
-                hsv_img = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-                hue_shift = random.uniform(-hue_shift_limit, hue_shift_limit)
-                if hue_shift < 0:
-                    hue_shift = 180 + hue_shift
-                hsv_img[:, :, 0] = (hsv_img[:, :, 0] + hue_shift) % 180
-                image = cv2.cvtColor(hsv_img, cv2.COLOR_HSV2BGR)
+                return random.uniform(-hue_shift_limit, hue_shift_limit), None
             else:
-                # random gamma
-                gamma = random.uniform(0.95, 1.05)
-                image = np.clip(image**gamma, 0, 255).astype(np.uint8)
-
-        return {"image": image}
+                return None, random.uniform(0.95, 1.05)
+        return None, None
 
     def get_augmentor(self, use_color_aug: bool):  # -> Optional[Callable[[np.ndarray], Dict[str, np.ndarray]]]:
         return self.color_aug if use_color_aug else None
 
 
+class InputIdsCache:
+    """
+    LRU cache of tokenized captions keyed by (tokenizer index, caption).
+    Values are numpy arrays so that the dataset can be pickled to DataLoader workers without sharing tensors.
+    """
+
+    def __init__(self, max_size: int = INPUT_IDS_CACHE_SIZE) -> None:
+        self.max_size = max_size
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+
+    def get(self, key) -> Optional[np.ndarray]:
+        input_ids = self.entries.get(key)
+        if input_ids is not None:
+            self.entries.move_to_end(key)
+        return input_ids
+
+    def put(self, key, input_ids: np.ndarray) -> None:
+        self.entries[key] = input_ids
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+
+class DecodedImageCache:
+    """
+    LRU cache of decoded uint8 images keyed by (image path, alpha), bounded by the total bytes of the images.
+    Images are kept in shared memory tensors, so DataLoader workers share the images cached in the main process
+    without copying them. Only the main process adds images to keep the cache shared.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries: collections.OrderedDict = collections.OrderedDict()
+
+    def get(self, key) -> Optional[np.ndarray]:
+        image = self.entries.get(key)
+        if image is None:
+            return None
+        self.entries.move_to_end(key)
+        return image.numpy().copy()  # augmentation may modify the image in place
+
+    def put(self, key, image: np.ndarray) -> None:
+        if torch.utils.data.get_worker_info() is not None:
+            return  # images added in a worker are not shared with the other workers
+        size = image.nbytes
+        if size > self.max_bytes or key in self.entries:
+            return
+        while self.total_bytes + size > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= evicted.numel()
+        self.entries[key] = torch.from_numpy(image).share_memory_()
+        self.total_bytes += size
+
+
+def split_input_ids_to_chunks(input_ids: torch.Tensor, tokenizer) -> torch.Tensor:
+    """
+    input_ids: (b, max_length) tokenized with max_length > tokenizer.model_max_length, e.g. 227
+    returns (b, n, model_max_length): "<BOS> ... <EOS>" chunks for each 75 tokens
+    """
+    max_length = input_ids.shape[-1]
+    model_max_length = tokenizer.model_max_length
+    if max_length <= model_max_length:
+        return input_ids
+
+    # indices of each chunk: <BOS>, 75 tokens from i, and the last token (<EOS> or <PAD>)
+    starts = torch.arange(1, max_length - model_max_length + 2, model_max_length - 2)  # (1, 76, 151)
+    indices = torch.empty((len(starts), model_max_length), dtype=torch.long)
+    indices[:, 0] = 0
+    indices[:, 1:-1] = starts.unsqueeze(1) + torch.arange(model_max_length - 2).unsqueeze(0)
+    indices[:, -1] = max_length - 1
+    chunks = input_ids[:, indices]  # b, n, 77
+
+    if tokenizer.pad_token_id != tokenizer.eos_token_id:
+        # v2 or SDXL: "<BOS> .... <EOS> <PAD> <PAD>..." の三連なので、各チャンクの末尾と先頭を補正する
+        # 末尾が x <PAD/EOS> の場合は末尾を <EOS> に変える（x <EOS> なら結果的に変化なし）
+        second_last = chunks[:, :, -2]
+        is_text = (second_last != tokenizer.eos_token_id) & (second_last != tokenizer.pad_token_id)
+        chunks[:, :, -1] = torch.where(is_text, tokenizer.eos_token_id, chunks[:, :, -1])
+        # 先頭が <BOS> <PAD> ... の場合は <BOS> <EOS> <PAD> ... に変える
+        chunks[:, :, 1] = torch.where(chunks[:, :, 1] == tokenizer.pad_token_id, tokenizer.eos_token_id, chunks[:, :, 1])
+    return chunks
+
+
 class BaseSubset:
     def __init__(
         self,
@@ -385,6 +615,7 @@ class BaseSubset:
         caption_suffix: Optional[str],
         token_warmup_min: int,
         token_warmup_step: Union[float, int],
+        network_multiplier: Optional[float] = None,
     ) -> None:
         self.image_dir = image_dir
         self.alpha_mask = alpha_mask if alpha_mask is not None else False
@@ -408,6 +639,8 @@ class BaseSubset:
         self.token_warmup_min = token_warmup_min  # step=0におけるタグの数
         self.token_warmup_step = token_warmup_step  # N（N<1ならN*max_train_steps）ステップ目でタグの数が最大になる
 
+        self.network_multiplier = network_multiplier  # None: use network_multiplier of the dataset
+
         self.img_count = 0
 
 
@@ -438,6 +671,7 @@ class DreamBoothSubset(BaseSubset):
         caption_suffix,
         token_warmup_min,
         token_warmup_step,
+        network_multiplier=None,
     ) -> None:
         assert image_dir is not None, "image_dir must be specified / image_dirは指定が必須です"
 
@@ -462,6 +696,7 @@ class DreamBoothSubset(BaseSubset):
             caption_suffix,
             token_warmup_min,
             token_warmup_step,
+            network_multiplier,
         )
 
         self.is_reg = is_reg
@@ -501,6 +736,7 @@ class FineTuningSubset(BaseSubset):
         caption_suffix,
         token_warmup_min,
         token_warmup_step,
+        network_multiplier=None,
     ) -> None:
         assert metadata_file is not None, "metadata_file must be specified / metadata_fileは指定が必須です"
 
@@ -525,6 +761,7 @@ class FineTuningSubset(BaseSubset):
             caption_suffix,
             token_warmup_min,
             token_warmup_step,
+            network_multiplier,
         )
 
         self.metadata_file = metadata_file
@@ -560,6 +797,7 @@ class ControlNetSubset(BaseSubset):
         caption_suffix,
         token_warmup_min,
         token_warmup_step,
+        network_multiplier=None,
     ) -> None:
         assert image_dir is not None, "image_dir must be specified / image_dirは指定が必須です"
 
@@ -584,6 +822,7 @@ class ControlNetSubset(BaseSubset):
             caption_suffix,
             token_warmup_min,
             token_warmup_step,
+            network_multiplier,
         )
 
         self.conditioning_data_dir = conditioning_data_dir
@@ -598,6 +837,102 @@ class ControlNetSubset(BaseSubset):
         return self.image_dir == other.image_dir and self.conditioning_data_dir == other.conditioning_data_dir
 
 
+def split_caption_to_tokens(subset: BaseSubset, caption: str) -> Tuple[List[str], List[str], List[str]]:
+    # returns fixed tokens, flexible (shuffled/dropped) tokens and fixed suffix tokens
+    fixed_tokens = []
+    flex_tokens = []
+    fixed_suffix_tokens = []
+    if hasattr(subset, "keep_tokens_separator") and subset.keep_tokens_separator and subset.keep_tokens_separator in caption:
+        fixed_part, flex_part = caption.split(subset.keep_tokens_separator, 1)
+        if subset.keep_tokens_separator in flex_part:
+            flex_part, fixed_suffix_part = flex_part.split(subset.keep_tokens_separator, 1)
+            fixed_suffix_tokens = [t.strip() for t in fixed_suffix_part.split(subset.caption_separator) if t.strip()]
+
+        fixed_tokens = [t.strip() for t in fixed_part.split(subset.caption_separator) if t.strip()]
+        flex_tokens = [t.strip() for t in flex_part.split(subset.caption_separator) if t.strip()]
+    else:
+        tokens = [t.strip() for t in caption.strip().split(subset.caption_separator)]
+        flex_tokens = tokens[:]
+        if subset.keep_tokens > 0:
+            fixed_tokens = flex_tokens[: subset.keep_tokens]
+            flex_tokens = tokens[subset.keep_tokens :]
+    return fixed_tokens, flex_tokens, fixed_suffix_tokens
+
+
+class CompiledCaptionLine:
+    __slots__ = ("text", "pieces", "tokens")
+
+    def __init__(self, text: str, pieces: Optional[List[Union[str, Tuple[str, ...]]]], tokens) -> None:
+        self.text: str = text  # line without wildcards
+        self.pieces = pieces  # literal strings and alternatives of wildcards, None if no wildcard
+        self.tokens: Optional[Tuple[List[str], Tuple[str, ...], List[str]]] = tokens  # pre-split tokens for text
+
+
+class CompiledCaption:
+    """
+    caption parsed for BaseDataset.process_caption: prefix/suffix are added, lines and wildcards are split,
+    and the tokens for shuffle_caption/caption_tag_dropout_rate/token_warmup_step are pre-split.
+    """
+
+    __slots__ = ("lines", "choose_line")
+
+    def __init__(self, subset: BaseSubset, caption: str) -> None:
+        # caption に prefix/suffix を付ける
+        if subset.caption_prefix:
+            caption = subset.caption_prefix + " " + caption
+        if subset.caption_suffix:
+            caption = caption + " " + subset.caption_suffix
+
+        if subset.enable_wildcard:
+            # if caption is multiline, random choice one line
+            self.choose_line = "\n" in caption
+            lines = caption.split("\n") if self.choose_line else [caption]
+            self.lines = [self.compile_wildcard_line(subset, line) for line in lines]
+        else:
+            # if caption is multiline, use the first line
+            self.choose_line = False
+            self.lines = [self.compile_line(subset, caption.split("\n")[0])]
+
+    def compile_line(self, subset: BaseSubset, text: str) -> CompiledCaptionLine:
+        tokens = None
+        if subset.shuffle_caption or subset.token_warmup_step > 0 or subset.caption_tag_dropout_rate > 0:
+            fixed_tokens, flex_tokens, fixed_suffix_tokens = split_caption_to_tokens(subset, text)
+            # tag-style captions share many tokens
+            fixed_tokens = [sys.intern(t) for t in fixed_tokens]
+            flex_tokens = tuple(sys.intern(t) for t in flex_tokens)
+            fixed_suffix_tokens = [sys.intern(t) for t in fixed_suffix_tokens]
+            tokens = (fixed_tokens, flex_tokens, fixed_suffix_tokens)
+        return CompiledCaptionLine(text, None, tokens)
+
+    def compile_wildcard_line(self, subset: BaseSubset, line: str) -> CompiledCaptionLine:
+        # wildcard is like '{aaa|bbb|ccc...}'
+        # escape the curly braces like {{ or }}
+        replacer1 = "⦅"
+        replacer2 = "⦆"
+        while replacer1 in line or replacer2 in line:
+            replacer1 += "⦅"
+            replacer2 += "⦆"
+
+        def unescape(text: str) -> str:
+            return text.replace(replacer1, "{").replace(replacer2, "}")
+
+        line = line.replace("{{", replacer1).replace("}}", replacer2)
+
+        # literal, alternatives, literal, alternatives, ..., literal
+        parts = re.split(r"\{([^}]+)\}", line)
+        if len(parts) == 1:
+            return self.compile_line(subset, unescape(line))
+
+        pieces = []
+        for i, part in enumerate(parts):
+            if i % 2 == 0:
+                if part:
+                    pieces.append(unescape(part))
+            else:
+                pieces.append(tuple(unescape(alternative) for alternative in part.split("|")))
+        return CompiledCaptionLine(None, pieces, None)
+
+
 class BaseDataset(torch.utils.data.Dataset):
     def __init__(
         self,
@@ -606,6 +941,8 @@ class BaseDataset(torch.utils.data.Dataset):
         resolution: Optional[Tuple[int, int]],
         network_multiplier: float,
         debug_dataset: bool,
+        latents_cache_dir: Optional[str] = None,
+        cache_storage_dtype: str = "float32",
     ) -> None:
         super().__init__()
 
@@ -620,6 +957,7 @@ class BaseDataset(torch.utils.data.Dataset):
         self.subsets: List[Union[DreamBoothSubset, FineTuningSubset]] = []
 
         self.token_padding_disabled = False
+        self.device_augmentation = False
         self.tag_frequency = {}
         self.XTI_layers = None
         self.token_strings = None
@@ -646,12 +984,27 @@ class BaseDataset(torch.utils.data.Dataset):
         self.image_transforms = IMAGE_TRANSFORMS
 
         self.image_data: Dict[str, ImageInfo] = {}
+        self.image_keys: List[str] = []  # index in buckets -> image key, set in make_buckets
         self.image_to_subset: Dict[str, Union[DreamBoothSubset, FineTuningSubset]] = {}
 
         self.replacements = {}
 
         # caching
         self.caching_mode = None  # None, 'latents', 'text'
+        self.latents_cache_dir = latents_cache_dir
+        self.latents_store: Optional[ShardedLatentsStore] = None
+        self.cache_storage_dtype = cache_storage_dtype
+        self.text_encoder_outputs_variants = 1  # number of augmented captions cached per image
+        self.image_cache: Optional[DecodedImageCache] = None
+
+        # image sizes and captions read in the previous runs
+        self.dataset_index = DatasetIndex()
+
+        # tokenized captions, see get_input_ids_batch
+        self.input_ids_cache = InputIdsCache()
+
+        # parsed captions for process_caption, (subset index, caption) -> CompiledCaption
+        self.compiled_captions: Dict[Tuple[int, str], CompiledCaption] = {}
 
     def adjust_min_max_bucket_reso_by_steps(
         self, resolution: Tuple[int, int], min_bucket_reso: int, max_bucket_reso: int, bucket_reso_steps: int
@@ -681,12 +1034,27 @@ class BaseDataset(torch.utils.data.Dataset):
 
         return min_bucket_reso, max_bucket_reso
 
+    def get_network_multiplier(self, subset: BaseSubset) -> float:
+        # network_multiplier of the subset overrides the one of the dataset
+        return self.network_multiplier if subset.network_multiplier is None else subset.network_multiplier
+
     def set_seed(self, seed):
         self.seed = seed
 
     def set_caching_mode(self, mode):
         self.caching_mode = mode
 
+    def set_text_encoder_outputs_variants(self, num_variants):
+        assert num_variants >= 1, "number of caption variants must be 1 or more / キャプションのバリエーション数は1以上である必要があります"
+        self.text_encoder_outputs_variants = num_variants
+
+    def get_text_encoder_outputs_captions(self, info: ImageInfo) -> List[str]:
+        # single variant: raw caption as before. multiple variants: apply caption augmentation for each variant
+        if self.text_encoder_outputs_variants == 1:
+            return [info.caption]
+        subset = self.image_to_subset[info.image_key]
+        return [self.process_caption(subset, info.caption) for _ in range(self.text_encoder_outputs_variants)]
+
     def set_current_epoch(self, epoch):
         if not self.current_epoch == epoch:  # epochが切り替わったらバケツをシャッフルする
             if epoch > self.current_epoch:
@@ -720,6 +1088,10 @@ class BaseDataset(torch.utils.data.Dataset):
     def disable_token_padding(self):
         self.token_padding_disabled = True
 
+    def enable_device_augmentation(self):
+        # workers only load images, and resize, crop, augmentation and normalization are done in apply_device_augmentation
+        self.device_augmentation = True
+
     def enable_XTI(self, layers=None, token_strings=None):
         self.XTI_layers = layers
         self.token_strings = token_strings
@@ -727,12 +1099,26 @@ class BaseDataset(torch.utils.data.Dataset):
     def add_replacement(self, str_from, str_to):
         self.replacements[str_from] = str_to
 
+    def get_compiled_caption(self, subset: BaseSubset, caption: str) -> "CompiledCaption":
+        # subsets are not hashable (they define __eq__), so use the index in self.subsets
+        subset_index = next((i for i, s in enumerate(self.subsets) if s is subset), None)
+        if subset_index is None:
+            return CompiledCaption(subset, caption)
+
+        compiled = self.compiled_captions.get((subset_index, caption))
+        if compiled is None:
+            compiled = CompiledCaption(subset, caption)
+            self.compiled_captions[(subset_index, caption)] = compiled
+        return compiled
+
+    def compile_captions(self):
+        # parse captions once before DataLoader workers are started, process_caption only shuffles and joins tokens
+        for image_key, info in self.image_data.items():
+            if isinstance(info.caption, str):
+                self.get_compiled_caption(self.image_to_subset[image_key], info.caption)
+
     def process_caption(self, subset: BaseSubset, caption):
-        # caption に prefix/suffix を付ける
-        if subset.caption_prefix:
-            caption = subset.caption_prefix + " " + caption
-        if subset.caption_suffix:
-            caption = caption + " " + subset.caption_suffix
+        compiled = self.get_compiled_caption(subset, caption)
 
         # dropoutの決定：tag dropがこのメソッド内にあるのでここで行うのが良い
         is_drop_out = subset.caption_dropout_rate > 0 and random.random() < subset.caption_dropout_rate
@@ -745,56 +1131,23 @@ class BaseDataset(torch.utils.data.Dataset):
         if is_drop_out:
             caption = ""
         else:
-            # process wildcards
-            if subset.enable_wildcard:
-                # if caption is multiline, random choice one line
-                if "\n" in caption:
-                    caption = random.choice(caption.split("\n"))
-
-                # wildcard is like '{aaa|bbb|ccc...}'
-                # escape the curly braces like {{ or }}
-                replacer1 = "⦅"
-                replacer2 = "⦆"
-                while replacer1 in caption or replacer2 in caption:
-                    replacer1 += "⦅"
-                    replacer2 += "⦆"
-
-                caption = caption.replace("{{", replacer1).replace("}}", replacer2)
-
-                # replace the wildcard
-                def replace_wildcard(match):
-                    return random.choice(match.group(1).split("|"))
-
-                caption = re.sub(r"\{([^}]+)\}", replace_wildcard, caption)
-
-                # unescape the curly braces
-                caption = caption.replace(replacer1, "{").replace(replacer2, "}")
+            # if caption is multiline, random choice one line (wildcard) or use the first line
+            line = random.choice(compiled.lines) if compiled.choose_line else compiled.lines[0]
+
+            if line.pieces is not None:
+                # replace the wildcard like '{aaa|bbb|ccc...}': the tokens are known only after choosing
+                caption = "".join([piece if isinstance(piece, str) else random.choice(piece) for piece in line.pieces])
+                tokens = None
             else:
-                # if caption is multiline, use the first line
-                caption = caption.split("\n")[0]
+                caption = line.text
+                tokens = line.tokens
 
             if subset.shuffle_caption or subset.token_warmup_step > 0 or subset.caption_tag_dropout_rate > 0:
-                fixed_tokens = []
-                flex_tokens = []
-                fixed_suffix_tokens = []
-                if (
-                    hasattr(subset, "keep_tokens_separator")
-                    and subset.keep_tokens_separator
-                    and subset.keep_tokens_separator in caption
-                ):
-                    fixed_part, flex_part = caption.split(subset.keep_tokens_separator, 1)
-                    if subset.keep_tokens_separator in flex_part:
-                        flex_part, fixed_suffix_part = flex_part.split(subset.keep_tokens_separator, 1)
-                        fixed_suffix_tokens = [t.strip() for t in fixed_suffix_part.split(subset.caption_separator) if t.strip()]
-
-                    fixed_tokens = [t.strip() for t in fixed_part.split(subset.caption_separator) if t.strip()]
-                    flex_tokens = [t.strip() for t in flex_part.split(subset.caption_separator) if t.strip()]
+                if tokens is None:
+                    fixed_tokens, flex_tokens, fixed_suffix_tokens = split_caption_to_tokens(subset, caption)
                 else:
-                    tokens = [t.strip() for t in caption.strip().split(subset.caption_separator)]
-                    flex_tokens = tokens[:]
-                    if subset.keep_tokens > 0:
-                        fixed_tokens = flex_tokens[: subset.keep_tokens]
-                        flex_tokens = tokens[subset.keep_tokens :]
+                    fixed_tokens, flex_tokens, fixed_suffix_tokens = tokens
+                    flex_tokens = list(flex_tokens)
 
                 if subset.token_warmup_step < 1:  # 初回に上書きする
                     subset.token_warmup_step = math.floor(subset.token_warmup_step * self.max_train_steps)
@@ -807,19 +1160,11 @@ class BaseDataset(torch.utils.data.Dataset):
                     )
                     flex_tokens = flex_tokens[:tokens_len]
 
-                def dropout_tags(tokens):
-                    if subset.caption_tag_dropout_rate <= 0:
-                        return tokens
-                    l = []
-                    for token in tokens:
-                        if random.random() >= subset.caption_tag_dropout_rate:
-                            l.append(token)
-                    return l
-
                 if subset.shuffle_caption:
                     random.shuffle(flex_tokens)
 
-                flex_tokens = dropout_tags(flex_tokens)
+                if subset.caption_tag_dropout_rate > 0:
+                    flex_tokens = [token for token in flex_tokens if random.random() >= subset.caption_tag_dropout_rate]
 
                 caption = ", ".join(fixed_tokens + flex_tokens + fixed_suffix_tokens)
 
@@ -841,55 +1186,48 @@ class BaseDataset(torch.utils.data.Dataset):
         return caption
 
     def get_input_ids(self, caption, tokenizer=None):
+        if isinstance(caption, str):
+            return self.get_input_ids_batch([caption], tokenizer)[0]
+        return self.get_input_ids_batch(caption, tokenizer).flatten(0, 1)  # XTI: list of captions for each layer
+
+    def get_input_ids_batch(self, captions: List[str], tokenizer=None) -> torch.Tensor:
+        """
+        tokenize captions at once. returns (b, 1, 77) or (b, n, 77) if max_token_length is specified.
+        tokenized captions are memoized because same captions appear every epoch.
+        """
         if tokenizer is None:
             tokenizer = self.tokenizers[0]
-
-        input_ids = tokenizer(
-            caption, padding="max_length", truncation=True, max_length=self.tokenizer_max_length, return_tensors="pt"
-        ).input_ids
-
-        if self.tokenizer_max_length > tokenizer.model_max_length:
-            input_ids = input_ids.squeeze(0)
-            iids_list = []
-            if tokenizer.pad_token_id == tokenizer.eos_token_id:
-                # v1
-                # 77以上の時は "<BOS> .... <EOS> <EOS> <EOS>" でトータル227とかになっているので、"<BOS>...<EOS>"の三連に変換する
-                # 1111氏のやつは , で区切る、とかしているようだが　とりあえず単純に
-                for i in range(
-                    1, self.tokenizer_max_length - tokenizer.model_max_length + 2, tokenizer.model_max_length - 2
-                ):  # (1, 152, 75)
-                    ids_chunk = (
-                        input_ids[0].unsqueeze(0),
-                        input_ids[i : i + tokenizer.model_max_length - 2],
-                        input_ids[-1].unsqueeze(0),
-                    )
-                    ids_chunk = torch.cat(ids_chunk)
-                    iids_list.append(ids_chunk)
+        tokenizer_index = next((i for i, t in enumerate(self.tokenizers) if t is tokenizer), None)
+
+        input_ids_list: List[Optional[np.ndarray]] = [None] * len(captions)
+        missing_indices: Dict[str, List[int]] = {}  # caption -> indices in captions
+        for i, caption in enumerate(captions):
+            input_ids = self.input_ids_cache.get((tokenizer_index, caption)) if tokenizer_index is not None else None
+            if input_ids is None:
+                missing_indices.setdefault(caption, []).append(i)
             else:
-                # v2 or SDXL
-                # 77以上の時は "<BOS> .... <EOS> <PAD> <PAD>..." でトータル227とかになっているので、"<BOS>...<EOS> <PAD> <PAD> ..."の三連に変換する
-                for i in range(1, self.tokenizer_max_length - tokenizer.model_max_length + 2, tokenizer.model_max_length - 2):
-                    ids_chunk = (
-                        input_ids[0].unsqueeze(0),  # BOS
-                        input_ids[i : i + tokenizer.model_max_length - 2],
-                        input_ids[-1].unsqueeze(0),
-                    )  # PAD or EOS
-                    ids_chunk = torch.cat(ids_chunk)
-
-                    # 末尾が <EOS> <PAD> または <PAD> <PAD> の場合は、何もしなくてよい
-                    # 末尾が x <PAD/EOS> の場合は末尾を <EOS> に変える（x <EOS> なら結果的に変化なし）
-                    if ids_chunk[-2] != tokenizer.eos_token_id and ids_chunk[-2] != tokenizer.pad_token_id:
-                        ids_chunk[-1] = tokenizer.eos_token_id
-                    # 先頭が <BOS> <PAD> ... の場合は <BOS> <EOS> <PAD> ... に変える
-                    if ids_chunk[1] == tokenizer.pad_token_id:
-                        ids_chunk[1] = tokenizer.eos_token_id
-
-                    iids_list.append(ids_chunk)
-
-            input_ids = torch.stack(iids_list)  # 3,77
-        return input_ids
+                input_ids_list[i] = input_ids
+
+        if len(missing_indices) > 0:
+            missing_captions = list(missing_indices.keys())
+            input_ids = tokenizer(
+                missing_captions, padding="max_length", truncation=True, max_length=self.tokenizer_max_length, return_tensors="pt"
+            ).input_ids
+            input_ids = split_input_ids_to_chunks(input_ids, tokenizer)
+            if input_ids.dim() == 2:
+                input_ids = input_ids.unsqueeze(1)  # b,1,77
+            input_ids = input_ids.numpy()
+            for caption, ids in zip(missing_captions, input_ids):
+                if tokenizer_index is not None:
+                    self.input_ids_cache.put((tokenizer_index, caption), ids.copy())
+                for i in missing_indices[caption]:
+                    input_ids_list[i] = ids
+
+        return torch.from_numpy(np.stack(input_ids_list))
 
     def register_image(self, info: ImageInfo, subset: BaseSubset):
+        if isinstance(info.caption, str):
+            info.caption = sys.intern(info.caption)  # many images may have the same caption (e.g. class tokens)
         self.image_data[info.image_key] = info
         self.image_to_subset[info.image_key] = subset
 
@@ -899,9 +1237,15 @@ class BaseDataset(torch.utils.data.Dataset):
         min_size and max_size are ignored when enable_bucket is False
         """
         logger.info("loading image sizes.")
-        for info in tqdm(self.image_data.values()):
-            if info.image_size is None:
-                info.image_size = self.get_image_size(info.absolute_path)
+        infos_without_size = [info for info in self.image_data.values() if info.image_size is None]
+        sizes = map_in_threads(
+            lambda info: self.dataset_index.get_image_size(info.absolute_path, self.get_image_size),
+            infos_without_size,
+            desc="get image size",
+        )
+        for info, size in zip(infos_without_size, sizes):
+            info.image_size = size
+        self.dataset_index.save()
 
         if self.enable_bucket:
             logger.info("make buckets")
@@ -925,27 +1269,33 @@ class BaseDataset(torch.utils.data.Dataset):
                         "min_bucket_reso and max_bucket_reso are ignored if bucket_no_upscale is set, because bucket reso is defined by image size automatically / bucket_no_upscaleが指定された場合は、bucketの解像度は画像サイズから自動計算されるため、min_bucket_resoとmax_bucket_resoは無視されます"
                     )
 
-            img_ar_errors = []
-            for image_info in self.image_data.values():
-                image_width, image_height = image_info.image_size
-                image_info.bucket_reso, image_info.resized_size, ar_error = self.bucket_manager.select_bucket(
-                    image_width, image_height
-                )
-
-                # logger.info(image_info.image_key, image_info.bucket_reso)
-                img_ar_errors.append(abs(ar_error))
-
-            self.bucket_manager.sort()
         else:
             self.bucket_manager = BucketManager(False, (self.width, self.height), None, None, None)
             self.bucket_manager.set_predefined_resos([(self.width, self.height)])  # ひとつの固定サイズbucketのみ
-            for image_info in self.image_data.values():
-                image_width, image_height = image_info.image_size
-                image_info.bucket_reso, image_info.resized_size, _ = self.bucket_manager.select_bucket(image_width, image_height)
 
-        for image_info in self.image_data.values():
-            for _ in range(image_info.num_repeats):
-                self.bucket_manager.add_image(image_info.bucket_reso, image_info.image_key)
+        # 全画像のbucketをまとめて決める
+        image_infos = list(self.image_data.values())
+        image_sizes = np.array([image_info.image_size for image_info in image_infos], dtype=np.int64).reshape(-1, 2)
+        bucket_ids, resized_sizes, img_ar_errors = self.bucket_manager.select_buckets(image_sizes[:, 0], image_sizes[:, 1])
+
+        for image_info, bucket_id, resized_size in zip(image_infos, bucket_ids.tolist(), resized_sizes.tolist()):
+            image_info.bucket_reso = self.bucket_manager.resos[bucket_id]
+            image_info.resized_size = tuple(resized_size)
+
+        # bucketには画像のindexを繰り返し回数分だけ入れる。DataLoaderのworkerでcopy-on-writeが起きないようにnp.ndarrayにする
+        self.image_keys = [image_info.image_key for image_info in image_infos]
+        num_repeats = np.array([image_info.num_repeats for image_info in image_infos], dtype=np.int64)
+        image_indices = np.repeat(np.arange(len(image_infos), dtype=np.int32), num_repeats)
+        image_bucket_ids = np.repeat(bucket_ids, num_repeats)
+        bucket_counts = np.bincount(image_bucket_ids, minlength=len(self.bucket_manager.buckets))
+        image_indices = image_indices[np.argsort(image_bucket_ids, kind="stable")]
+        self.bucket_manager.buckets = np.split(image_indices, np.cumsum(bucket_counts)[:-1])
+
+        if self.enable_bucket:
+            self.bucket_manager.sort()
+
+        # captionを事前に解析しておく / parse captions before DataLoader workers are started
+        self.compile_captions()
 
         # bucket情報を表示、格納する
         if self.enable_bucket:
@@ -957,7 +1307,6 @@ class BaseDataset(torch.utils.data.Dataset):
                     self.bucket_info["buckets"][i] = {"resolution": reso, "count": len(bucket)}
                     logger.info(f"bucket {i}: resolution {reso}, count: {len(bucket)}")
 
-            img_ar_errors = np.array(img_ar_errors)
             mean_img_ar_error = np.mean(np.abs(img_ar_errors))
             self.bucket_info["mean_img_ar_error"] = mean_img_ar_error
             logger.info(f"mean ar error (without repeats): {mean_img_ar_error}")
@@ -1004,7 +1353,12 @@ class BaseDataset(torch.utils.data.Dataset):
     def is_latent_cacheable(self):
         return all([not subset.color_aug and not subset.random_crop for subset in self.subsets])
 
-    def is_text_encoder_output_cacheable(self):
+    def is_text_encoder_output_cacheable(self, num_variants=1):
+        # caption augmentation can be cached as multiple variants, but token warmup and dropout every n epochs depend on the step
+        if num_variants > 1:
+            return all(
+                [not (subset.token_warmup_step > 0 or subset.caption_dropout_every_n_epochs > 0) for subset in self.subsets]
+            )
         return all(
             [
                 not (
@@ -1017,88 +1371,141 @@ class BaseDataset(torch.utils.data.Dataset):
             ]
         )
 
+    def set_image_cache(self, image_cache: DecodedImageCache):
+        # decode images once in the main process before DataLoader workers start, in the order of images until the cache is full
+        self.image_cache = image_cache
+
+        keys = []
+        total_bytes = image_cache.total_bytes
+        for info in self.image_data.values():
+            subset = self.image_to_subset[info.image_key]
+            if info.image_size is None:
+                continue
+            size = info.image_size[0] * info.image_size[1] * (4 if subset.alpha_mask else 3)
+            if total_bytes + size > image_cache.max_bytes:
+                break
+            total_bytes += size
+            keys.append((info.absolute_path, subset.alpha_mask))
+
+        logger.info(f"caching {len(keys)}/{len(self.image_data)} decoded images in memory.")
+
+        # decode in chunks and put them to the cache immediately, so that decoded images not in the cache are bounded
+        chunk_size = 64
+        with ThreadPoolExecutor() as executor, tqdm(total=len(keys), desc="decoding images") as pbar:
+            for i in range(0, len(keys), chunk_size):
+                chunk = keys[i : i + chunk_size]
+                for key, image in zip(chunk, executor.map(lambda key: load_image(*key), chunk)):
+                    image_cache.put(key, image)
+                    pbar.update(1)
+
     def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True):
         # マルチGPUには対応していないので、そちらはtools/cache_latents.pyを使うこと
         logger.info("caching latents.")
 
         image_infos = list(self.image_data.values())
 
-        # sort by resolution
-        image_infos.sort(key=lambda info: info.bucket_reso[0] * info.bucket_reso[1])
-
-        # split by resolution and some conditions
-        class Condition:
-            def __init__(self, reso, flip_aug, alpha_mask, random_crop):
-                self.reso = reso
-                self.flip_aug = flip_aug
-                self.alpha_mask = alpha_mask
-                self.random_crop = random_crop
-
-            def __eq__(self, other):
-                return (
-                    self.reso == other.reso
-                    and self.flip_aug == other.flip_aug
-                    and self.alpha_mask == other.alpha_mask
-                    and self.random_crop == other.random_crop
-                )
+        # use sharded store instead of npz files if latents_cache_dir is specified
+        use_latents_store = cache_to_disk and self.latents_cache_dir is not None
+        if use_latents_store:
+            self.latents_store = ShardedLatentsStore(self.latents_cache_dir)
 
-        batches: List[Tuple[Condition, List[ImageInfo]]] = []
-        batch: List[ImageInfo] = []
-        current_condition = None
+        # fine tuning dataset may have npz already
+        image_infos = [info for info in image_infos if info.latents_npz is None]
 
-        logger.info("checking cache validity...")
-        for info in tqdm(image_infos):
-            subset = self.image_to_subset[info.image_key]
+        manifest = None
+        if cache_to_disk:
+            for info in image_infos:
+                if use_latents_store:
+                    info.latents_store_key = info.absolute_path
+                else:
+                    info.latents_npz = os.path.splitext(info.absolute_path)[0] + ".npz"
 
-            if info.latents_npz is not None:  # fine tuning dataset
-                continue
+            if not is_main_process:  # if cache to disk, don't cache latents in non-main process, set to info only
+                return
 
             # check disk cache exists and size of latents
-            if cache_to_disk:
-                info.latents_npz = os.path.splitext(info.absolute_path)[0] + ".npz"
-                if not is_main_process:  # store to info only
-                    continue
-
-                cache_available = is_disk_cached_latents_is_expected(
-                    info.bucket_reso, info.latents_npz, subset.flip_aug, subset.alpha_mask
-                )
-
-                if cache_available:  # do not add to batch
-                    continue
-
-            # if batch is not empty and condition is changed, flush the batch. Note that current_condition is not None if batch is not empty
-            condition = Condition(info.bucket_reso, subset.flip_aug, subset.alpha_mask, subset.random_crop)
-            if len(batch) > 0 and current_condition != condition:
-                batches.append((current_condition, batch))
-                batch = []
+            logger.info("checking cache validity...")
+            if use_latents_store:
+                cache_availables = [
+                    self.latents_store.is_cached(
+                        info.latents_store_key,
+                        info.bucket_reso,
+                        self.image_to_subset[info.image_key].flip_aug,
+                        self.image_to_subset[info.image_key].alpha_mask,
+                    )
+                    for info in tqdm(image_infos)
+                ]
+            else:
+                # the manifest avoids opening npz files, and missing entries are checked with npz headers in parallel
+                manifest = LatentsCacheManifest()
 
-            batch.append(info)
-            current_condition = condition
+                def check_cache(info: ImageInfo) -> bool:
+                    subset = self.image_to_subset[info.image_key]
+                    return check_disk_cached_latents(
+                        info.absolute_path, info.latents_npz, info.bucket_reso, subset.flip_aug, subset.alpha_mask, manifest
+                    )
 
-            # if number of data in batch is enough, flush the batch
-            if len(batch) >= vae_batch_size:
-                batches.append((current_condition, batch))
-                batch = []
-                current_condition = None
+                cache_availables = map_in_threads(check_cache, image_infos)
 
-        if len(batch) > 0:
-            batches.append((current_condition, batch))
+            # do not add to batch if cache is available
+            image_infos = [info for info, cache_available in zip(image_infos, cache_availables) if not cache_available]
 
-        if cache_to_disk and not is_main_process:  # if cache to disk, don't cache latents in non-main process, set to info only
-            return
+        batches = make_batches_for_latents_caching(image_infos, self.image_to_subset, vae_batch_size)
 
-        # iterate batches: batch doesn't have image, image will be loaded in cache_batch_latents and discarded
+        # iterate batches: batch doesn't have image, image will be loaded and discarded in the pipeline
+        # images are loaded and resized by worker threads ahead of VAE, and latents are saved by a writer thread
         logger.info("caching latents...")
-        for condition, batch in tqdm(batches, smoothing=1, total=len(batches)):
-            cache_batch_latents(vae, cache_to_disk, batch, condition.flip_aug, condition.alpha_mask, condition.random_crop)
+        with AsyncCacheWriter() as writer:
+            pipeline = encode_batches_for_latents_caching(vae, batches)
+            for condition, batch, latents, flipped_latents, alpha_masks in tqdm(pipeline, smoothing=1, total=len(batches)):
+                if not cache_to_disk:
+                    save_batch_latents(False, batch, latents, flipped_latents, alpha_masks, condition.flip_aug)
+                else:
+                    writer.submit(
+                        save_batch_latents,
+                        True,
+                        batch,
+                        latents,
+                        flipped_latents,
+                        alpha_masks,
+                        condition.flip_aug,
+                        self.latents_store,
+                        self.cache_storage_dtype,
+                    )
+            # all writes are finished when exiting the writer
+
+        if self.latents_store is not None:
+            self.latents_store.close()
+
+        if manifest is not None:
+            # record newly cached files to the manifest for the next run
+            cached_infos = [info for _, batch in batches for info in batch]
+            map_in_threads(
+                lambda info: manifest.update(info.absolute_path, info.latents_npz, load_npz_array_shapes(info.latents_npz)),
+                cached_infos,
+                desc="update manifest",
+            )
+            manifest.save()
 
     # weight_dtypeを指定するとText Encoderそのもの、およひ出力がweight_dtypeになる
-    # SDXLでのみ有効だが、datasetのメソッドとする必要があるので、sdxl_train_util.pyではなくこちらに実装する
-    # SD1/2に対応するにはv2のフラグを持つ必要があるので後回し
+    # datasetのメソッドとする必要があるので、sdxl_train_util.pyではなくこちらに実装する
+    # SD1/2ではclip_skipとv2のフラグを指定する / clip_skip and v2 are used for SD1/2 (single Text Encoder) only
     def cache_text_encoder_outputs(
-        self, tokenizers, text_encoders, device, weight_dtype, cache_to_disk=False, is_main_process=True
+        self,
+        tokenizers,
+        text_encoders,
+        device,
+        weight_dtype,
+        cache_to_disk=False,
+        is_main_process=True,
+        clip_skip=None,
+        v2=False,
+        num_variants=1,
     ):
-        assert len(tokenizers) == 2, "only support SDXL"
+        assert len(tokenizers) in [1, 2], "only support SD1/2 or SDXL"
+        assert len(tokenizers) == len(text_encoders), "number of tokenizers and text encoders must be same"
+        is_sdxl = len(tokenizers) == 2
+        self.set_text_encoder_outputs_variants(num_variants)
 
         # latentsのキャッシュと同様に、ディスクへのキャッシュに対応する
         # またマルチGPUには対応していないので、そちらはtools/cache_latents.pyを使うこと
@@ -1106,23 +1513,23 @@ class BaseDataset(torch.utils.data.Dataset):
         image_infos = list(self.image_data.values())
 
         logger.info("checking cache existence...")
-        image_infos_to_cache = []
-        for info in tqdm(image_infos):
-            # subset = self.image_to_subset[info.image_key]
-            if cache_to_disk:
-                te_out_npz = os.path.splitext(info.absolute_path)[0] + TEXT_ENCODER_OUTPUTS_CACHE_SUFFIX
-                info.text_encoder_outputs_npz = te_out_npz
-
-                if not is_main_process:  # store to info only
-                    continue
-
-                if os.path.exists(te_out_npz):
-                    continue
+        image_infos_to_cache = image_infos
+        if cache_to_disk:
+            for info in image_infos:
+                info.text_encoder_outputs_npz = os.path.splitext(info.absolute_path)[0] + TEXT_ENCODER_OUTPUTS_CACHE_SUFFIX
 
-            image_infos_to_cache.append(info)
+            if not is_main_process:  # if cache to disk, don't cache latents in non-main process, set to info only
+                return
 
-        if cache_to_disk and not is_main_process:  # if cache to disk, don't cache latents in non-main process, set to info only
-            return
+            # existence check is I/O bound, so check in parallel
+            cache_params = get_text_encoder_outputs_cache_params(is_sdxl, clip_skip, self.max_token_length, v2)
+            exists = map_in_threads(
+                lambda info: is_disk_cached_text_encoder_outputs_valid(
+                    info.text_encoder_outputs_npz, is_sdxl, num_variants, cache_params
+                ),
+                image_infos,
+            )
+            image_infos_to_cache = [info for info, e in zip(image_infos, exists) if not e]
 
         # prepare tokenizers and text encoders
         for text_encoder in text_encoders:
@@ -1134,8 +1541,9 @@ class BaseDataset(torch.utils.data.Dataset):
         batch = []
         batches = []
         for info in image_infos_to_cache:
-            input_ids1 = self.get_input_ids(info.caption, tokenizers[0])
-            input_ids2 = self.get_input_ids(info.caption, tokenizers[1])
+            captions = self.get_text_encoder_outputs_captions(info)
+            input_ids1 = self.get_input_ids_batch(captions, tokenizers[0])
+            input_ids2 = self.get_input_ids_batch(captions, tokenizers[1]) if is_sdxl else None
             batch.append((info, input_ids1, input_ids2))
 
             if len(batch) >= self.batch_size:
@@ -1147,19 +1555,36 @@ class BaseDataset(torch.utils.data.Dataset):
 
         # iterate batches: call text encoder and cache outputs for memory or disk
         logger.info("caching text encoder outputs...")
-        for batch in tqdm(batches):
-            infos, input_ids1, input_ids2 = zip(*batch)
-            input_ids1 = torch.stack(input_ids1, dim=0)
-            input_ids2 = torch.stack(input_ids2, dim=0)
-            cache_batch_text_encoder_outputs(
-                infos, tokenizers, text_encoders, self.max_token_length, cache_to_disk, input_ids1, input_ids2, weight_dtype
-            )
+        with AsyncCacheWriter() as writer:
+            for batch in tqdm(batches):
+                infos, input_ids1, input_ids2 = zip(*batch)
+                input_ids1 = torch.cat(input_ids1, dim=0)  # b*num_variants,...
+                input_ids2 = torch.cat(input_ids2, dim=0) if is_sdxl else None
+                cache_batch_text_encoder_outputs(
+                    infos,
+                    tokenizers,
+                    text_encoders,
+                    self.max_token_length,
+                    cache_to_disk,
+                    input_ids1,
+                    input_ids2,
+                    weight_dtype,
+                    writer,
+                    self.cache_storage_dtype,
+                    clip_skip,
+                    v2,
+                    num_variants,
+                )
 
     def get_image_size(self, image_path):
         return imagesize.get(image_path)
 
     def load_image_with_face_info(self, subset: BaseSubset, image_path: str, alpha_mask=False):
-        img = load_image(image_path, alpha_mask)
+        img = None if self.image_cache is None else self.image_cache.get((image_path, alpha_mask))
+        if img is None:
+            img = load_image(image_path, alpha_mask)
+            if self.image_cache is not None:
+                self.image_cache.put((image_path, alpha_mask), img)
 
         face_cx = face_cy = face_w = face_h = 0
         if subset.face_crop_aug_range is not None:
@@ -1232,6 +1657,7 @@ class BaseDataset(torch.utils.data.Dataset):
             return self.get_item_for_caching(bucket, bucket_batch_size, image_index)
 
         loss_weights = []
+        network_multipliers = []
         captions = []
         input_ids_list = []
         input_ids2_list = []
@@ -1245,13 +1671,16 @@ class BaseDataset(torch.utils.data.Dataset):
         text_encoder_outputs1_list = []
         text_encoder_outputs2_list = []
         text_encoder_pool2_list = []
+        device_augmentation_params = []
 
-        for image_key in bucket[image_index : image_index + bucket_batch_size]:
+        image_keys = [self.image_keys[i] for i in bucket[image_index : image_index + bucket_batch_size]]
+        for image_key in image_keys:
             image_info = self.image_data[image_key]
             subset = self.image_to_subset[image_key]
             loss_weights.append(
                 self.prior_loss_weight if image_info.is_reg else 1.0
             )  # in case of fine tuning, is_reg is always False
+            network_multipliers.append(self.get_network_multiplier(subset))
 
             flipped = subset.flip_aug and random.random() < 0.5  # not flipped or flipped with 50% chance
 
@@ -1267,8 +1696,16 @@ class BaseDataset(torch.utils.data.Dataset):
                     alpha_mask = None if image_info.alpha_mask is None else torch.flip(image_info.alpha_mask, [1])
 
                 image = None
-            elif image_info.latents_npz is not None:  # FineTuningDatasetまたはcache_latents_to_disk=Trueの場合
-                latents, original_size, crop_ltrb, flipped_latents, alpha_mask = load_latents_from_disk(image_info.latents_npz)
+            elif image_info.latents_npz is not None or image_info.latents_store_key is not None:
+                # FineTuningDatasetまたはcache_latents_to_disk=Trueの場合
+                if image_info.latents_store_key is not None:
+                    latents, original_size, crop_ltrb, flipped_latents, alpha_mask = self.latents_store.load(
+                        image_info.latents_store_key, image_info.bucket_reso
+                    )
+                else:
+                    latents, original_size, crop_ltrb, flipped_latents, alpha_mask = load_latents_from_disk(
+                        image_info.latents_npz
+                    )
                 if flipped:
                     latents = flipped_latents
                     alpha_mask = None if alpha_mask is None else alpha_mask[:, ::-1].copy()  # copy to avoid negative stride problem
@@ -1285,7 +1722,13 @@ class BaseDataset(torch.utils.data.Dataset):
                 )
                 im_h, im_w = img.shape[0:2]
 
-                if self.enable_bucket:
+                if self.enable_bucket and self.device_augmentation:
+                    # リサイズとtrimは学習デバイス上で行う。ここではtrimする位置のみ決める
+                    original_size = (im_w, im_h)
+                    resized_size = image_info.resized_size
+                    trim_left, trim_top = get_trim_offsets(subset.random_crop, resized_size, image_info.bucket_reso)
+                    crop_ltrb = BucketManager.get_crop_ltrb(image_info.bucket_reso, original_size)
+                elif self.enable_bucket:
                     img, original_size, crop_ltrb = trim_and_resize_if_required(
                         subset.random_crop, img, image_info.bucket_reso, image_info.resized_size
                     )
@@ -1310,39 +1753,62 @@ class BaseDataset(torch.utils.data.Dataset):
 
                     original_size = [im_w, im_h]
                     crop_ltrb = (0, 0, 0, 0)
+                    resized_size = (im_w, im_h)
+                    trim_left = trim_top = 0
+
+                if self.device_augmentation:
+                    # 画像はuint8のまま渡し、apply_device_augmentationでbatchごとに処理する
+                    hue_shift, gamma = self.aug_helper.sample_color_aug_params() if subset.color_aug else (None, None)
+                    device_augmentation_params.append(
+                        (resized_size, (trim_left, trim_top), image_info.bucket_reso, hue_shift, gamma, flipped)
+                    )
 
-                # augmentation
-                aug = self.aug_helper.get_augmentor(subset.color_aug)
-                if aug is not None:
-                    # augment RGB channels only
-                    img_rgb = img[:, :, :3]
-                    img_rgb = aug(image=img_rgb)["image"]
-                    img[:, :, :3] = img_rgb
-
-                if flipped:
-                    img = img[:, ::-1, :].copy()  # copy to avoid negative stride problem
+                    if subset.alpha_mask and img.shape[2] == 3:
+                        img = np.concatenate([img, np.full_like(img[:, :, :1], 255)], axis=2)  # no alpha means opaque
+                    elif not subset.alpha_mask:
+                        img = img[:, :, :3]
 
-                if subset.alpha_mask:
-                    if img.shape[2] == 4:
-                        alpha_mask = img[:, :, 3]  # [H,W]
-                        alpha_mask = alpha_mask.astype(np.float32) / 255.0  # 0.0~1.0
-                        alpha_mask = torch.FloatTensor(alpha_mask)
-                    else:
-                        alpha_mask = torch.ones((img.shape[0], img.shape[1]), dtype=torch.float32)
+                    image = torch.from_numpy(np.ascontiguousarray(img))  # [H,W,C] uint8, not resized yet
+                    alpha_mask = None  # made from the alpha channel on the device
                 else:
-                    alpha_mask = None
+                    # augmentation
+                    aug = self.aug_helper.get_augmentor(subset.color_aug)
+                    if aug is not None:
+                        # augment RGB channels only
+                        img_rgb = img[:, :, :3]
+                        img_rgb = aug(image=img_rgb)["image"]
+                        img[:, :, :3] = img_rgb
+
+                    if flipped:
+                        img = img[:, ::-1, :].copy()  # copy to avoid negative stride problem
+
+                    if subset.alpha_mask:
+                        if img.shape[2] == 4:
+                            alpha_mask = img[:, :, 3]  # [H,W]
+                            alpha_mask = alpha_mask.astype(np.float32) / 255.0  # 0.0~1.0
+                            alpha_mask = torch.FloatTensor(alpha_mask)
+                        else:
+                            alpha_mask = torch.ones((img.shape[0], img.shape[1]), dtype=torch.float32)
+                    else:
+                        alpha_mask = None
+
+                    img = img[:, :, :3]  # remove alpha channel
 
-                img = img[:, :, :3]  # remove alpha channel
+                    image = self.image_transforms(img)  # -1.0~1.0のtorch.Tensorになる
 
                 latents = None
-                image = self.image_transforms(img)  # -1.0~1.0のtorch.Tensorになる
                 del img
 
             images.append(image)
             latents_list.append(latents)
             alpha_mask_list.append(alpha_mask)
 
-            target_size = (image.shape[2], image.shape[1]) if image is not None else (latents.shape[2] * 8, latents.shape[1] * 8)
+            if image is not None and self.device_augmentation:
+                target_size = image_info.bucket_reso  # image will be resized and trimmed to bucket reso on the device
+            elif image is not None:
+                target_size = (image.shape[2], image.shape[1])
+            else:
+                target_size = (latents.shape[2] * 8, latents.shape[1] * 8)
 
             if not flipped:
                 crop_left_top = (crop_ltrb[0], crop_ltrb[1])
@@ -1357,15 +1823,23 @@ class BaseDataset(torch.utils.data.Dataset):
 
             # captionとtext encoder outputを処理する
             caption = image_info.caption  # default
-            if image_info.text_encoder_outputs1 is not None:
-                text_encoder_outputs1_list.append(image_info.text_encoder_outputs1)
-                text_encoder_outputs2_list.append(image_info.text_encoder_outputs2)
-                text_encoder_pool2_list.append(image_info.text_encoder_pool2)
-                captions.append(caption)
-            elif image_info.text_encoder_outputs_npz is not None:
-                text_encoder_outputs1, text_encoder_outputs2, text_encoder_pool2 = load_text_encoder_outputs_from_disk(
-                    image_info.text_encoder_outputs_npz
-                )
+            if image_info.text_encoder_outputs1 is not None or image_info.text_encoder_outputs_npz is not None:
+                # sample one of the cached caption variants for this step
+                variant = random.randrange(self.text_encoder_outputs_variants) if self.text_encoder_outputs_variants > 1 else None
+                if image_info.text_encoder_outputs1 is not None:
+                    text_encoder_outputs1 = image_info.text_encoder_outputs1
+                    text_encoder_outputs2 = image_info.text_encoder_outputs2
+                    text_encoder_pool2 = image_info.text_encoder_pool2
+                    if variant is not None:
+                        text_encoder_outputs1 = text_encoder_outputs1[variant]
+                        if text_encoder_outputs2 is not None:
+                            text_encoder_outputs2 = text_encoder_outputs2[variant]
+                            text_encoder_pool2 = text_encoder_pool2[variant]
+                else:
+                    text_encoder_outputs1, text_encoder_outputs2, text_encoder_pool2 = load_text_encoder_outputs_from_disk(
+                        image_info.text_encoder_outputs_npz, variant
+                    )
+
                 text_encoder_outputs1_list.append(text_encoder_outputs1)
                 text_encoder_outputs2_list.append(text_encoder_outputs2)
                 text_encoder_pool2_list.append(text_encoder_pool2)
@@ -1383,19 +1857,11 @@ class BaseDataset(torch.utils.data.Dataset):
                 else:
                     captions.append(caption)
 
-                if not self.token_padding_disabled:  # this option might be omitted in future
-                    if self.XTI_layers:
-                        token_caption = self.get_input_ids(caption_layer, self.tokenizers[0])
-                    else:
-                        token_caption = self.get_input_ids(caption, self.tokenizers[0])
-                    input_ids_list.append(token_caption)
-
+                # captions without XTI are tokenized at once after the loop
+                if not self.token_padding_disabled and self.XTI_layers:  # this option might be omitted in future
+                    input_ids_list.append(self.get_input_ids(caption_layer, self.tokenizers[0]))
                     if len(self.tokenizers) > 1:
-                        if self.XTI_layers:
-                            token_caption2 = self.get_input_ids(caption_layer, self.tokenizers[1])
-                        else:
-                            token_caption2 = self.get_input_ids(caption, self.tokenizers[1])
-                        input_ids2_list.append(token_caption2)
+                        input_ids2_list.append(self.get_input_ids(caption_layer, self.tokenizers[1]))
 
         example = {}
         example["loss_weights"] = torch.FloatTensor(loss_weights)
@@ -1410,9 +1876,12 @@ class BaseDataset(torch.utils.data.Dataset):
                     ).input_ids
                 else:
                     example["input_ids2"] = None
-            else:
+            elif self.XTI_layers:
                 example["input_ids"] = torch.stack(input_ids_list)
                 example["input_ids2"] = torch.stack(input_ids2_list) if len(self.tokenizers) > 1 else None
+            else:
+                example["input_ids"] = self.get_input_ids_batch(captions, self.tokenizers[0])
+                example["input_ids2"] = self.get_input_ids_batch(captions, self.tokenizers[1]) if len(self.tokenizers) > 1 else None
             example["text_encoder_outputs1_list"] = None
             example["text_encoder_outputs2_list"] = None
             example["text_encoder_pool2_list"] = None
@@ -1423,8 +1892,10 @@ class BaseDataset(torch.utils.data.Dataset):
             # example["input_ids"] = torch.stack([self.get_input_ids(cap, self.tokenizers[0]) for cap in captions])
             # example["input_ids2"] = torch.stack([self.get_input_ids(cap, self.tokenizers[1]) for cap in captions])
             example["text_encoder_outputs1_list"] = torch.stack(text_encoder_outputs1_list)
-            example["text_encoder_outputs2_list"] = torch.stack(text_encoder_outputs2_list)
-            example["text_encoder_pool2_list"] = torch.stack(text_encoder_pool2_list)
+            # SD1/2 has only one Text Encoder, so outputs2 and pool2 are not cached
+            has_outputs2 = text_encoder_outputs2_list[0] is not None
+            example["text_encoder_outputs2_list"] = torch.stack(text_encoder_outputs2_list) if has_outputs2 else None
+            example["text_encoder_pool2_list"] = torch.stack(text_encoder_pool2_list) if has_outputs2 else None
 
         # if one of alpha_masks is not None, we need to replace None with ones
         none_or_not = [x is None for x in alpha_mask_list]
@@ -1443,7 +1914,10 @@ class BaseDataset(torch.utils.data.Dataset):
         else:
             example["alpha_masks"] = torch.stack(alpha_mask_list)
 
-        if images[0] is not None:
+        if images[0] is not None and self.device_augmentation:
+            # list of uint8 images with different sizes, processed by apply_device_augmentation
+            example["device_augmentation_params"] = device_augmentation_params
+        elif images[0] is not None:
             images = torch.stack(images)
             images = images.to(memory_format=torch.contiguous_format).float()
         else:
@@ -1458,10 +1932,10 @@ class BaseDataset(torch.utils.data.Dataset):
         example["target_sizes_hw"] = torch.stack([torch.LongTensor(x) for x in target_sizes_hw])
         example["flippeds"] = flippeds
 
-        example["network_multipliers"] = torch.FloatTensor([self.network_multiplier] * len(captions))
+        example["network_multipliers"] = torch.FloatTensor(network_multipliers)
 
         if self.debug_dataset:
-            example["image_keys"] = bucket[image_index : image_index + self.batch_size]
+            example["image_keys"] = image_keys
         return example
 
     def get_item_for_caching(self, bucket, bucket_batch_size, image_index):
@@ -1476,7 +1950,8 @@ class BaseDataset(torch.utils.data.Dataset):
         alpha_mask = None
         random_crop = None
 
-        for image_key in bucket[image_index : image_index + bucket_batch_size]:
+        for i in bucket[image_index : image_index + bucket_batch_size]:
+            image_key = self.image_keys[i]
             image_info = self.image_data[image_key]
             subset = self.image_to_subset[image_key]
 
@@ -1500,8 +1975,13 @@ class BaseDataset(torch.utils.data.Dataset):
                 image = None
 
             if self.caching_mode == "text":
-                input_ids1 = self.get_input_ids(caption, self.tokenizers[0])
-                input_ids2 = self.get_input_ids(caption, self.tokenizers[1])
+                # num_variants,... if caption variants are enabled
+                variant_captions = self.get_text_encoder_outputs_captions(image_info)
+                input_ids1 = self.get_input_ids_batch(variant_captions, self.tokenizers[0])
+                input_ids2 = self.get_input_ids_batch(variant_captions, self.tokenizers[1]) if len(self.tokenizers) > 1 else None
+                if self.text_encoder_outputs_variants == 1:
+                    input_ids1 = input_ids1[0]
+                    input_ids2 = input_ids2[0] if input_ids2 is not None else None
             else:
                 input_ids1 = None
                 input_ids2 = None
@@ -1549,8 +2029,12 @@ class DreamBoothDataset(BaseDataset):
         bucket_no_upscale: bool,
         prior_loss_weight: float,
         debug_dataset: bool,
+        latents_cache_dir: Optional[str] = None,
+        cache_storage_dtype: str = "float32",
     ) -> None:
-        super().__init__(tokenizer, max_token_length, resolution, network_multiplier, debug_dataset)
+        super().__init__(
+            tokenizer, max_token_length, resolution, network_multiplier, debug_dataset, latents_cache_dir, cache_storage_dtype
+        )
 
         assert resolution is not None, f"resolution is required / resolution（解像度）指定は必須です"
 
@@ -1574,14 +2058,17 @@ class DreamBoothDataset(BaseDataset):
             self.bucket_reso_steps = None  # この情報は使われない
             self.bucket_no_upscale = False
 
-        def read_caption(img_path, caption_extension, enable_wildcard):
+        def get_caption_paths(img_path, caption_extension):
             # captionの候補ファイル名を作る
             base_name = os.path.splitext(img_path)[0]
             base_name_face_det = base_name
             tokens = base_name.split("_")
             if len(tokens) >= 5:
                 base_name_face_det = "_".join(tokens[:-4])
-            cap_paths = [base_name + caption_extension, base_name_face_det + caption_extension]
+            return [base_name + caption_extension, base_name_face_det + caption_extension]
+
+        def read_caption(img_path, caption_extension, enable_wildcard):
+            cap_paths = get_caption_paths(img_path, caption_extension)
 
             caption = None
             for cap_path in cap_paths:
@@ -1600,6 +2087,15 @@ class DreamBoothDataset(BaseDataset):
                     break
             return caption
 
+        def read_caption_with_index(img_path, caption_extension, enable_wildcard):
+            # 前回読み込んだキャプションファイルが変更されていなければインデックスの内容を使う
+            return self.dataset_index.get_caption(
+                img_path,
+                get_caption_paths(img_path, caption_extension),
+                f"{caption_extension}:{enable_wildcard}",
+                lambda: read_caption(img_path, caption_extension, enable_wildcard),
+            )
+
         def load_dreambooth_dir(subset: DreamBoothSubset):
             if not os.path.isdir(subset.image_dir):
                 logger.warning(f"not directory: {subset.image_dir}")
@@ -1637,10 +2133,14 @@ class DreamBoothDataset(BaseDataset):
                 missing_captions = [img_path for img_path, caption in zip(img_paths, captions) if caption is None or caption == ""]
             else:
                 # 画像ファイルごとにプロンプトを読み込み、もしあればそちらを使う
+                caps_for_imgs = map_in_threads(
+                    lambda img_path: read_caption_with_index(img_path, subset.caption_extension, subset.enable_wildcard),
+                    img_paths,
+                    desc="read caption",
+                )
                 captions = []
                 missing_captions = []
-                for img_path in img_paths:
-                    cap_for_img = read_caption(img_path, subset.caption_extension, subset.enable_wildcard)
+                for img_path, cap_for_img in zip(img_paths, caps_for_imgs):
                     if cap_for_img is None and subset.class_tokens is None:
                         logger.warning(
                             f"neither caption file nor class tokens are found. use empty caption for {img_path} / キャプションファイルもclass tokenも見つかりませんでした。空のキャプションを使用します: {img_path}"
@@ -1672,7 +2172,11 @@ class DreamBoothDataset(BaseDataset):
 
             if not use_cached_info_for_subset and subset.cache_info:
                 logger.info(f"cache image info for / 画像情報をキャッシュします : {info_cache_file}")
-                sizes = [self.get_image_size(img_path) for img_path in tqdm(img_paths, desc="get image size")]
+                sizes = map_in_threads(
+                    lambda img_path: self.dataset_index.get_image_size(img_path, self.get_image_size),
+                    img_paths,
+                    desc="get image size",
+                )
                 matas = {}
                 for img_path, caption, size in zip(img_paths, captions, sizes):
                     matas[img_path] = {"caption": caption, "resolution": list(size)}
@@ -1680,6 +2184,8 @@ class DreamBoothDataset(BaseDataset):
                     json.dump(matas, f, ensure_ascii=False, indent=2)
                 logger.info(f"cache image info done for / 画像情報を出力しました : {info_cache_file}")
 
+            self.dataset_index.save()
+
             # if sizes are not set, image size will be read in make_buckets
             return img_paths, captions, sizes
 
@@ -1767,8 +2273,12 @@ class FineTuningDataset(BaseDataset):
         bucket_reso_steps: int,
         bucket_no_upscale: bool,
         debug_dataset: bool,
+        latents_cache_dir: Optional[str] = None,
+        cache_storage_dtype: str = "float32",
     ) -> None:
-        super().__init__(tokenizer, max_token_length, resolution, network_multiplier, debug_dataset)
+        super().__init__(
+            tokenizer, max_token_length, resolution, network_multiplier, debug_dataset, latents_cache_dir, cache_storage_dtype
+        )
 
         self.batch_size = batch_size
 
@@ -1995,8 +2505,12 @@ class ControlNetDataset(BaseDataset):
         bucket_reso_steps: int,
         bucket_no_upscale: bool,
         debug_dataset: float,
+        latents_cache_dir: Optional[str] = None,
+        cache_storage_dtype: str = "float32",
     ) -> None:
-        super().__init__(tokenizer, max_token_length, resolution, network_multiplier, debug_dataset)
+        super().__init__(
+            tokenizer, max_token_length, resolution, network_multiplier, debug_dataset, latents_cache_dir, cache_storage_dtype
+        )
 
         db_subsets = []
         for subset in subsets:
@@ -2028,6 +2542,7 @@ class ControlNetDataset(BaseDataset):
                 subset.caption_suffix,
                 subset.token_warmup_min,
                 subset.token_warmup_step,
+                subset.network_multiplier,
             )
             db_subsets.append(db_subset)
 
@@ -2045,6 +2560,8 @@ class ControlNetDataset(BaseDataset):
             bucket_no_upscale,
             1.0,
             debug_dataset,
+            latents_cache_dir,
+            cache_storage_dtype,
         )
 
         # config_util等から参照される値をいれておく（若干微妙なのでなんとかしたい）
@@ -2103,6 +2620,20 @@ class ControlNetDataset(BaseDataset):
     def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True):
         return self.dreambooth_dataset_delegate.cache_latents(vae, vae_batch_size, cache_to_disk, is_main_process)
 
+    def enable_device_augmentation(self):
+        super().enable_device_augmentation()
+        self.dreambooth_dataset_delegate.enable_device_augmentation()
+
+    def set_image_cache(self, image_cache: DecodedImageCache):
+        self.dreambooth_dataset_delegate.set_image_cache(image_cache)
+
+    def set_text_encoder_outputs_variants(self, num_variants):
+        super().set_text_encoder_outputs_variants(num_variants)
+        self.dreambooth_dataset_delegate.set_text_encoder_outputs_variants(num_variants)
+
+    def get_text_encoder_outputs_captions(self, info: ImageInfo) -> List[str]:
+        return self.dreambooth_dataset_delegate.get_text_encoder_outputs_captions(info)
+
     def __len__(self):
         return self.dreambooth_dataset_delegate.__len__()
 
@@ -2117,7 +2648,8 @@ class ControlNetDataset(BaseDataset):
 
         conditioning_images = []
 
-        for i, image_key in enumerate(bucket[image_index : image_index + bucket_batch_size]):
+        for i, image_index_in_dataset in enumerate(bucket[image_index : image_index + bucket_batch_size]):
+            image_key = self.dreambooth_dataset_delegate.image_keys[image_index_in_dataset]
             image_info = self.dreambooth_dataset_delegate.image_data[image_key]
 
             target_size_hw = example["target_sizes_hw"][i]
@@ -2190,17 +2722,39 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
         for dataset in self.datasets:
             dataset.enable_XTI(*args, **kwargs)
 
+    def cache_images_in_memory(self, max_bytes: int):
+        # one cache shared by all datasets, so that the budget is for the total
+        image_cache = DecodedImageCache(max_bytes)
+        for i, dataset in enumerate(self.datasets):
+            logger.info(f"[Dataset {i}]")
+            dataset.set_image_cache(image_cache)
+
     def cache_latents(self, vae, vae_batch_size=1, cache_to_disk=False, is_main_process=True):
         for i, dataset in enumerate(self.datasets):
             logger.info(f"[Dataset {i}]")
             dataset.cache_latents(vae, vae_batch_size, cache_to_disk, is_main_process)
 
     def cache_text_encoder_outputs(
-        self, tokenizers, text_encoders, device, weight_dtype, cache_to_disk=False, is_main_process=True
+        self,
+        tokenizers,
+        text_encoders,
+        device,
+        weight_dtype,
+        cache_to_disk=False,
+        is_main_process=True,
+        clip_skip=None,
+        v2=False,
+        num_variants=1,
     ):
         for i, dataset in enumerate(self.datasets):
             logger.info(f"[Dataset {i}]")
-            dataset.cache_text_encoder_outputs(tokenizers, text_encoders, device, weight_dtype, cache_to_disk, is_main_process)
+            dataset.cache_text_encoder_outputs(
+                tokenizers, text_encoders, device, weight_dtype, cache_to_disk, is_main_process, clip_skip, v2, num_variants
+            )
+
+    def set_text_encoder_outputs_variants(self, num_variants):
+        for dataset in self.datasets:
+            dataset.set_text_encoder_outputs_variants(num_variants)
 
     def set_caching_mode(self, caching_mode):
         for dataset in self.datasets:
@@ -2213,8 +2767,8 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
     def is_latent_cacheable(self) -> bool:
         return all([dataset.is_latent_cacheable() for dataset in self.datasets])
 
-    def is_text_encoder_output_cacheable(self) -> bool:
-        return all([dataset.is_text_encoder_output_cacheable() for dataset in self.datasets])
+    def is_text_encoder_output_cacheable(self, num_variants=1) -> bool:
+        return all([dataset.is_text_encoder_output_cacheable(num_variants) for dataset in self.datasets])
 
     def set_current_epoch(self, epoch):
         for dataset in self.datasets:
@@ -2232,39 +2786,354 @@ class DatasetGroup(torch.utils.data.ConcatDataset):
         for dataset in self.datasets:
             dataset.disable_token_padding()
 
+    def enable_device_augmentation(self):
+        for dataset in self.datasets:
+            dataset.enable_device_augmentation()
+
 
-def is_disk_cached_latents_is_expected(reso, npz_path: str, flip_aug: bool, alpha_mask: bool):
+def load_npz_array_shapes_and_scalars(npz_path: str) -> Tuple[Dict[str, Tuple[int, ...]], Dict[str, Union[int, float, bool]]]:
+    # read only the headers of arrays in npz, and the values of scalar (0-d) arrays which follow their headers
+    shapes = {}
+    scalars = {}
+    with zipfile.ZipFile(npz_path) as zf:
+        for name in zf.namelist():
+            if not name.endswith(".npy"):
+                continue
+            with zf.open(name) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+                if shape == () and not dtype.hasobject:
+                    scalars[name[: -len(".npy")]] = np.frombuffer(f.read(dtype.itemsize), dtype=dtype)[0].item()
+            shapes[name[: -len(".npy")]] = tuple(shape)
+    return shapes, scalars
+
+
+def load_npz_array_shapes(npz_path: str) -> Dict[str, Tuple[int, ...]]:
+    # read only the headers of arrays in npz, not the arrays themselves
+    return load_npz_array_shapes_and_scalars(npz_path)[0]
+
+
+def is_latents_shapes_expected(reso, shapes: Dict[str, Sequence[int]], flip_aug: bool, alpha_mask: bool) -> bool:
     expected_latents_size = (reso[1] // 8, reso[0] // 8)  # bucket_resoはWxHなので注意
 
-    if not os.path.exists(npz_path):
+    if "latents" not in shapes or "original_size" not in shapes or "crop_ltrb" not in shapes:  # old ver?
+        return False
+    if tuple(shapes["latents"][1:3]) != expected_latents_size:
         return False
 
-    try:
-        npz = np.load(npz_path)
-        if "latents" not in npz or "original_size" not in npz or "crop_ltrb" not in npz:  # old ver?
+    if flip_aug:
+        if "latents_flipped" not in shapes:
             return False
-        if npz["latents"].shape[1:3] != expected_latents_size:
+        if tuple(shapes["latents_flipped"][1:3]) != expected_latents_size:
             return False
 
-        if flip_aug:
-            if "latents_flipped" not in npz:
-                return False
-            if npz["latents_flipped"].shape[1:3] != expected_latents_size:
-                return False
+    if alpha_mask:
+        if "alpha_mask" not in shapes:
+            return False
+        if (shapes["alpha_mask"][1], shapes["alpha_mask"][0]) != tuple(reso):  # HxW => WxH != reso
+            return False
+    else:
+        if "alpha_mask" in shapes:
+            return False
 
-        if alpha_mask:
-            if "alpha_mask" not in npz:
-                return False
-            if (npz["alpha_mask"].shape[1], npz["alpha_mask"].shape[0]) != reso:  # HxW => WxH != reso
-                return False
-        else:
-            if "alpha_mask" in npz:
-                return False
+    return True
+
+
+def is_disk_cached_latents_is_expected(reso, npz_path: str, flip_aug: bool, alpha_mask: bool):
+    if not os.path.exists(npz_path):
+        return False
+
+    try:
+        shapes = load_npz_array_shapes(npz_path)
     except Exception as e:
         logger.error(f"Error loading file: {npz_path}")
         raise e
 
-    return True
+    return is_latents_shapes_expected(reso, shapes, flip_aug, alpha_mask)
+
+
+def get_file_stat(path: str) -> Optional[List[int]]:
+    # size and mtime of the file, or None if the file does not exist
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+class DatasetIndex:
+    r"""
+    画像サイズとキャプションを、画像のディレクトリごとのjsonlに保存する。再起動時に画像サイズの取得とキャプションの読み込みを省略できる
+    Persistent index of image sizes and captions, stored as json lines per image directory. Entries are keyed by file name
+    and invalidated per file by the size and mtime of the image (for the resolution) and the caption files (for captions).
+    New or changed entries are appended on save; the file is rewritten only when it has grown with stale lines.
+    """
+
+    FILE_NAME = "dataset_index.jsonl"
+
+    def __init__(self) -> None:
+        self._indices: Dict[str, Dict[str, dict]] = {}  # directory -> {image file name: entry}
+        self._num_lines: Dict[str, int] = {}  # directory -> number of lines in the index file
+        self._pending: Dict[str, Dict[str, dict]] = {}  # directory -> {image file name: entry}, not saved yet
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # DataLoaderのworkerにはエントリを渡さない（必要なら再度読み込む）
+        return {}
+
+    def __setstate__(self, state):
+        self.__init__()
+
+    def _get_index(self, directory: str) -> Dict[str, dict]:
+        with self._lock:
+            index = self._indices.get(directory)
+            if index is None:
+                index = {}
+                num_lines = 0
+                index_file = os.path.join(directory, self.FILE_NAME)
+                if os.path.isfile(index_file):
+                    try:
+                        with open(index_file, "rt", encoding="utf-8") as f:
+                            for line in f:
+                                num_lines += 1
+                                try:
+                                    entry = json.loads(line)
+                                except ValueError:
+                                    continue  # partially written line
+                                index[entry.pop("name")] = entry  # later lines override earlier ones
+                    except OSError:
+                        logger.warning(f"ignore unreadable dataset index: {index_file}")
+                self._indices[directory] = index
+                self._num_lines[directory] = num_lines
+            return index
+
+    def _get_entry(self, image_path: str) -> dict:
+        return self._get_index(os.path.dirname(image_path)).get(os.path.basename(image_path), {})
+
+    def _update_entry(self, image_path: str, **values) -> None:
+        directory = os.path.dirname(image_path)
+        name = os.path.basename(image_path)
+        index = self._get_index(directory)
+        with self._lock:
+            entry = dict(index.get(name, {}))
+            entry.update(values)
+            index[name] = entry
+            self._pending.setdefault(directory, {})[name] = entry
+
+    def get_image_size(self, image_path: str, get_image_size_func) -> Tuple[int, int]:
+        image_stat = get_file_stat(image_path)
+        entry = self._get_entry(image_path)
+        if image_stat is not None and entry.get("image_stat") == image_stat and "resolution" in entry:
+            return tuple(entry["resolution"])
+
+        size = get_image_size_func(image_path)
+        self._update_entry(image_path, image_stat=image_stat, resolution=list(size))
+        return size
+
+    def get_caption(self, image_path: str, caption_paths: Sequence[str], variant: str, read_caption_func) -> Optional[str]:
+        r"""
+        variant: key of the caption reading options (caption extension etc.), captions are cached for each variant
+        read_caption_func: called without arguments when the cached caption is invalid
+        """
+        caption_stats = [get_file_stat(cap_path) for cap_path in caption_paths]
+        cached = self._get_entry(image_path).get("captions", {}).get(variant)
+        if cached is not None and cached["caption_stats"] == caption_stats:
+            return cached["caption"]
+
+        caption = read_caption_func()
+        captions = dict(self._get_entry(image_path).get("captions", {}))
+        captions[variant] = {
+            "caption_stats": caption_stats,
+            "caption": caption,
+            "caption_hash": None if caption is None else hashlib.sha256(caption.encode("utf-8")).hexdigest(),
+        }
+        self._update_entry(image_path, captions=captions)
+        return caption
+
+    def save(self) -> None:
+        # すべてのプロセスがデータセットを作るので、メインプロセスのみが書き込む
+        # every process builds the dataset: only the main process writes the index. the datasets are made before
+        # Accelerator is created, so the rank is taken from the environment variable set by accelerate/torchrun
+        if int(os.environ.get("RANK", "0")) != 0:
+            self._pending.clear()
+            return
+
+        for directory, pending in self._pending.items():
+            index = self._indices[directory]
+            index_file = os.path.join(directory, self.FILE_NAME)
+
+            # 古い行が多くなったら書き直す、それ以外は追記する
+            compact = self._num_lines[directory] + len(pending) > 2 * len(index)
+            entries = index if compact else pending
+            lines = [json.dumps({"name": name, **entry}, ensure_ascii=False) + "\n" for name, entry in entries.items()]
+            try:
+                if compact:
+                    tmp_file = f"{index_file}.{os.getpid()}.tmp"
+                    with open(tmp_file, "wt", encoding="utf-8") as f:
+                        f.writelines(lines)
+                    os.replace(tmp_file, index_file)
+                    self._num_lines[directory] = len(lines)
+                else:
+                    with open(index_file, "at", encoding="utf-8") as f:
+                        f.writelines(lines)
+                    self._num_lines[directory] += len(lines)
+            except OSError as e:
+                logger.warning(f"failed to save dataset index / データセットのインデックスを保存できませんでした: {index_file}, {e}")
+        self._pending.clear()
+
+
+class LatentsCacheManifest:
+    r"""
+    npzのlatentsキャッシュの検証用の情報を、ディレクトリごとのjsonに保存する。npzを開かずにキャッシュの有効性を確認できる
+    Records array shapes of cached npz files with the stat of the source image and the npz, per directory.
+    An entry is valid only while the size and mtime of both files are unchanged, otherwise npz headers are read again.
+    """
+
+    FILE_NAME = "latents_cache_manifest.json"
+
+    def __init__(self) -> None:
+        self._manifests: Dict[str, Dict[str, dict]] = {}  # directory -> {npz file name: entry}
+        self._dirty_dirs = set()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get_manifest(self, directory: str) -> Dict[str, dict]:
+        with self._lock:
+            manifest = self._manifests.get(directory)
+            if manifest is None:
+                manifest = {}
+                manifest_file = os.path.join(directory, self.FILE_NAME)
+                if os.path.isfile(manifest_file):
+                    try:
+                        with open(manifest_file, "rt", encoding="utf-8") as f:
+                            manifest = json.load(f)
+                    except (OSError, ValueError):
+                        logger.warning(f"ignore broken latents cache manifest: {manifest_file}")
+                        manifest = {}
+                self._manifests[directory] = manifest
+            return manifest
+
+    def get_shapes(self, image_path: str, npz_path: str) -> Optional[Dict[str, List[int]]]:
+        entry = self._get_manifest(os.path.dirname(npz_path)).get(os.path.basename(npz_path))
+        if entry is None:
+            return None
+        if entry["npz_stat"] != get_file_stat(npz_path) or entry["image_stat"] != get_file_stat(image_path):
+            return None
+        return entry["shapes"]
+
+    def update(self, image_path: str, npz_path: str, shapes: Dict[str, Sequence[int]]) -> None:
+        directory = os.path.dirname(npz_path)
+        manifest = self._get_manifest(directory)
+        entry = {
+            "shapes": {name: list(shape) for name, shape in shapes.items()},
+            "image_stat": get_file_stat(image_path),
+            "npz_stat": get_file_stat(npz_path),
+        }
+        with self._lock:
+            manifest[os.path.basename(npz_path)] = entry
+            self._dirty_dirs.add(directory)
+
+    def save(self) -> None:
+        for directory in self._dirty_dirs:
+            manifest_file = os.path.join(directory, self.FILE_NAME)
+            try:
+                with open(manifest_file, "wt", encoding="utf-8") as f:
+                    json.dump(self._manifests[directory], f, ensure_ascii=False)
+            except OSError as e:
+                logger.warning(f"failed to save latents cache manifest / manifestを保存できませんでした: {manifest_file}, {e}")
+        self._dirty_dirs.clear()
+
+
+def check_disk_cached_latents(
+    image_path: str, npz_path: str, reso, flip_aug: bool, alpha_mask: bool, manifest: Optional[LatentsCacheManifest]
+) -> bool:
+    # check the manifest first, and read npz headers only if the manifest has no valid entry
+    shapes = manifest.get_shapes(image_path, npz_path) if manifest is not None else None
+    if shapes is None:
+        if not os.path.exists(npz_path):
+            return False
+        try:
+            shapes = load_npz_array_shapes(npz_path)
+        except Exception as e:
+            logger.error(f"Error loading file: {npz_path}")
+            raise e
+        if manifest is not None:
+            manifest.update(image_path, npz_path, shapes)
+    return is_latents_shapes_expected(reso, shapes, flip_aug, alpha_mask)
+
+
+def map_in_threads(func, items: Sequence, desc: Optional[str] = None, max_workers: Optional[int] = None) -> List:
+    # for I/O bound functions such as file existence check. results are in the same order as items
+    if len(items) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(tqdm(executor.map(func, items), total=len(items), desc=desc))
+
+
+# ディスクキャッシュの保存形式。読み込み時はfloat32に戻す
+# storage dtypes of disk caches. the dtype is recorded as the dtype of each array: float16 as is, bfloat16 as the bit pattern
+# in uint16, and int8 with a per-tensor scale (stored as "{name}_scale"). arrays are upcast to float32 on load
+CACHE_STORAGE_DTYPES = ["float32", "float16", "bfloat16", "int8"]
+
+
+def encode_cache_array(tensor: torch.Tensor, storage_dtype: str = "float32") -> Tuple[np.ndarray, Optional[float]]:
+    tensor = tensor.detach().cpu()
+    if storage_dtype == "float32":
+        return tensor.float().numpy(), None
+    if storage_dtype == "float16":
+        return tensor.half().numpy(), None
+    if storage_dtype == "bfloat16":
+        return tensor.bfloat16().view(torch.int16).numpy().view(np.uint16), None
+    if storage_dtype == "int8":
+        tensor = tensor.float()
+        scale = tensor.abs().max().item() / 127.0
+        if scale == 0.0:
+            scale = 1.0
+        return torch.round(tensor / scale).clamp(-127, 127).to(torch.int8).numpy(), scale
+    raise ValueError(f"unknown cache storage dtype / 不明なキャッシュ保存形式です: {storage_dtype}")
+
+
+def decode_cache_array(array: np.ndarray, scale: Optional[float] = None) -> np.ndarray:
+    if array.dtype == np.float32:
+        return array
+    if array.dtype == np.float16:
+        return array.astype(np.float32)
+    if array.dtype == np.uint16:  # bfloat16
+        return (array.astype(np.uint32) << 16).view(np.float32)
+    if array.dtype == np.int8:
+        assert scale is not None, "scale is required for int8 cache / int8のキャッシュにはscaleが必要です"
+        return array.astype(np.float32) * np.float32(scale)
+    raise ValueError(f"unsupported dtype in cache / キャッシュに対応していない型があります: {array.dtype}")
+
+
+def get_alpha_mask_storage_dtype(storage_dtype: str) -> str:
+    # alpha mask is in 0-1 with 256 levels, int8 is too coarse for it
+    return "float16" if storage_dtype == "int8" else storage_dtype
+
+
+def add_cache_array(arrays: Dict[str, np.ndarray], name: str, tensor: torch.Tensor, storage_dtype: str) -> None:
+    array, scale = encode_cache_array(tensor, storage_dtype)
+    arrays[name] = array
+    if scale is not None:
+        arrays[name + "_scale"] = np.array(scale, dtype=np.float32)
+
+
+def get_cache_array(npz, name: str) -> Optional[np.ndarray]:
+    if name not in npz:
+        return None
+    scale = npz[name + "_scale"].item() if name + "_scale" in npz else None
+    return decode_cache_array(npz[name], scale)
 
 
 # 戻り値は、latents_tensor, (original_size width, original_size height), (crop left, crop top)
@@ -2275,29 +3144,366 @@ def load_latents_from_disk(
     if "latents" not in npz:
         raise ValueError(f"error: npz is old format. please re-generate {npz_path}")
 
-    latents = npz["latents"]
+    latents = get_cache_array(npz, "latents")
     original_size = npz["original_size"].tolist()
     crop_ltrb = npz["crop_ltrb"].tolist()
-    flipped_latents = npz["latents_flipped"] if "latents_flipped" in npz else None
-    alpha_mask = npz["alpha_mask"] if "alpha_mask" in npz else None
+    flipped_latents = get_cache_array(npz, "latents_flipped")
+    alpha_mask = get_cache_array(npz, "alpha_mask")
     return latents, original_size, crop_ltrb, flipped_latents, alpha_mask
 
 
-def save_latents_to_disk(npz_path, latents_tensor, original_size, crop_ltrb, flipped_latents_tensor=None, alpha_mask=None):
+def savez_atomic(npz_path: str, **arrays) -> None:
+    # write to a temporary file and rename it, so an interrupted write never leaves a truncated npz
+    tmp_path = f"{npz_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, npz_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_latents_to_disk(
+    npz_path,
+    latents_tensor,
+    original_size,
+    crop_ltrb,
+    flipped_latents_tensor=None,
+    alpha_mask=None,
+    storage_dtype: str = "float32",
+):
     kwargs = {}
+    add_cache_array(kwargs, "latents", latents_tensor, storage_dtype)
     if flipped_latents_tensor is not None:
-        kwargs["latents_flipped"] = flipped_latents_tensor.float().cpu().numpy()
+        add_cache_array(kwargs, "latents_flipped", flipped_latents_tensor, storage_dtype)
     if alpha_mask is not None:
-        kwargs["alpha_mask"] = alpha_mask.float().cpu().numpy()
-    np.savez(
+        add_cache_array(kwargs, "alpha_mask", alpha_mask, get_alpha_mask_storage_dtype(storage_dtype))
+    savez_atomic(
         npz_path,
-        latents=latents_tensor.float().cpu().numpy(),
         original_size=np.array(original_size),
         crop_ltrb=np.array(crop_ltrb),
         **kwargs,
     )
 
 
+class AsyncCacheWriter:
+    r"""
+    キャッシュファイルの書き込みをバックグラウンドのスレッドで行う
+    Write-behind stage for cache files. Writes are run in a thread pool, and submit blocks while too many writes are pending,
+    so the memory for pending tensors is bounded. Call flush (or use as a context manager) to wait for all writes,
+    errors in writes are raised there.
+    """
+
+    def __init__(self, num_workers: int = 4, max_pending: Optional[int] = None) -> None:
+        self.executor = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="cache_writer")
+        self.max_pending = max_pending if max_pending is not None else num_workers * 2
+        self.futures = collections.deque()
+
+    def submit(self, func, *args, **kwargs) -> None:
+        self.futures.append(self.executor.submit(func, *args, **kwargs))
+        while len(self.futures) > self.max_pending:
+            self.futures.popleft().result()
+
+    def flush(self) -> None:
+        while len(self.futures) > 0:
+            self.futures.popleft().result()
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # do not hide the original error by errors in writes
+            self.executor.shutdown(wait=True)
+
+
+class ShardedLatentsStore:
+    r"""
+    latentsをいくつかの大きなshardファイルにまとめて格納するディスクキャッシュ。画像ごとの.npzの代わりに使う
+    Disk cache of latents packed into a few large shard files instead of one .npz per image.
+
+    Layout of the cache directory:
+        {writer_id}-{n:05d}.shard : raw arrays, each array is aligned to ALIGNMENT bytes
+        index-{writer_id}.jsonl   : one entry per line, keyed by image key and bucket reso
+
+    Each writer (process) appends to its own shard and index files, so multiple processes can cache to the same directory.
+    If the same key is cached again, the later entry wins and the old data remains in the shard as garbage.
+    Arrays are read via np.memmap without opening the file for each sample.
+
+    Index entries are written only after the data they refer to is fsynced (every INDEX_FLUSH_INTERVAL entries and on
+    flush/close), so an interrupted run never leaves entries pointing to truncated data. save is thread safe.
+
+    merge_indices merges the index files of all writers into index-merged.jsonl, which is read before the others.
+    """
+
+    SHARD_SIZE = 1024**3  # bytes, a new shard is started when the current one exceeds this size
+    ALIGNMENT = 64
+    INDEX_FLUSH_INTERVAL = 256
+    INDEX_FILE_PREFIX = "index-"
+    INDEX_FILE_EXT = ".jsonl"
+    MERGED_INDEX_FILE_NAME = "index-merged.jsonl"
+    SHARD_FILE_EXT = ".shard"
+
+    def __init__(self, cache_dir: str, writer_id: str = "0") -> None:
+        self.cache_dir = cache_dir
+        self.writer_id = writer_id
+
+        self._index: Optional[Dict[Tuple[str, Tuple[int, int]], dict]] = None
+        self._memmaps: Dict[str, np.memmap] = {}
+        self._shard_file = None
+        self._shard_name: Optional[str] = None
+        self._index_file = None
+        self._pending_entries: List[dict] = []
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # file handles and memmaps cannot be pickled for DataLoader workers, they are reopened lazily
+        state = self.__dict__.copy()
+        state["_memmaps"] = {}
+        state["_shard_file"] = None
+        state["_shard_name"] = None
+        state["_index_file"] = None
+        state["_pending_entries"] = []
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _get_index_files(self) -> List[str]:
+        if not os.path.isdir(self.cache_dir):
+            return []
+        index_files = glob.glob(os.path.join(glob.escape(self.cache_dir), self.INDEX_FILE_PREFIX + "*" + self.INDEX_FILE_EXT))
+        # the merged index is older than the index files of writers
+        return sorted(index_files, key=lambda f: (os.path.basename(f) != self.MERGED_INDEX_FILE_NAME, f))
+
+    def _load_index(self) -> None:
+        index = {}
+        if os.path.isdir(self.cache_dir):
+            for index_file in self._get_index_files():
+                with open(index_file, "rt", encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except json.JSONDecodeError:
+                            # the last line may be incomplete if the process was interrupted
+                            logger.warning(f"ignore broken line in latents cache index: {index_file}")
+                            continue
+                        index[(entry["key"], tuple(entry["reso"]))] = entry
+        self._index = index
+
+    def _get_entry(self, key: str, reso: Tuple[int, int]) -> Optional[dict]:
+        if self._index is None:
+            self._load_index()
+        return self._index.get((key, tuple(reso)))
+
+    def __len__(self) -> int:
+        if self._index is None:
+            self._load_index()
+        return len(self._index)
+
+    def is_cached(self, key: str, reso: Tuple[int, int], flip_aug: bool, alpha_mask: bool) -> bool:
+        # same check as is_disk_cached_latents_is_expected, but only the index is used
+        entry = self._get_entry(key, reso)
+        if entry is None:
+            return False
+
+        expected_latents_size = [reso[1] // 8, reso[0] // 8]  # bucket_resoはWxHなので注意
+        arrays = entry["arrays"]
+        if arrays["latents"]["shape"][1:3] != expected_latents_size:
+            return False
+        if flip_aug:
+            if "latents_flipped" not in arrays or arrays["latents_flipped"]["shape"][1:3] != expected_latents_size:
+                return False
+        if alpha_mask:
+            if "alpha_mask" not in arrays or arrays["alpha_mask"]["shape"] != [reso[1], reso[0]]:
+                return False
+        elif "alpha_mask" in arrays:
+            return False
+        return True
+
+    def _get_memmap(self, shard_name: str) -> np.memmap:
+        memmap = self._memmaps.get(shard_name)
+        if memmap is None or len(memmap) < os.path.getsize(os.path.join(self.cache_dir, shard_name)):
+            # mode "c" (copy-on-write) makes the arrays writable for torch without modifying the file
+            memmap = np.memmap(os.path.join(self.cache_dir, shard_name), dtype=np.uint8, mode="c")
+            self._memmaps[shard_name] = memmap
+        return memmap
+
+    def _read_array(self, memmap: np.memmap, array_info: dict) -> np.ndarray:
+        dtype = np.dtype(array_info["dtype"])
+        shape = tuple(array_info["shape"])
+        offset = array_info["offset"]
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        # float32 is returned without copy, other dtypes are upcast to float32
+        return decode_cache_array(memmap[offset : offset + nbytes].view(dtype).reshape(shape), array_info.get("scale"))
+
+    def load(
+        self, key: str, reso: Tuple[int, int]
+    ) -> Tuple[np.ndarray, List[int], List[int], Optional[np.ndarray], Optional[np.ndarray]]:
+        # same return values as load_latents_from_disk
+        entry = self._get_entry(key, reso)
+        if entry is None:
+            # the cache may be written by another process after the index was loaded
+            self._load_index()
+            entry = self._get_entry(key, reso)
+        if entry is None:
+            raise ValueError(f"latents are not found in the cache / latentsがキャッシュにありません: {key}, {reso}")
+
+        memmap = self._get_memmap(entry["shard"])
+        arrays = entry["arrays"]
+        latents = self._read_array(memmap, arrays["latents"])
+        flipped_latents = self._read_array(memmap, arrays["latents_flipped"]) if "latents_flipped" in arrays else None
+        alpha_mask = self._read_array(memmap, arrays["alpha_mask"]) if "alpha_mask" in arrays else None
+        return latents, entry["original_size"], entry["crop_ltrb"], flipped_latents, alpha_mask
+
+    def merge_indices(self) -> int:
+        r"""
+        全writerのindexをひとつのファイルにまとめる。書き込み中のwriterがないときに呼ぶこと
+        merges the index files of all writers into one file, call this only when no writer is running. returns number of entries
+        """
+        index_files = self._get_index_files()
+        self._load_index()
+
+        merged_file = os.path.join(self.cache_dir, self.MERGED_INDEX_FILE_NAME)
+        tmp_file = merged_file + ".tmp"
+        with open(tmp_file, "wt", encoding="utf-8") as f:
+            for entry in self._index.values():
+                f.write(json.dumps(entry) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, merged_file)
+
+        for index_file in index_files:
+            if os.path.basename(index_file) != self.MERGED_INDEX_FILE_NAME:
+                os.remove(index_file)
+        return len(self._index)
+
+    def _prepare_shard_for_write(self) -> None:
+        if self._shard_file is not None and self._shard_file.tell() < self.SHARD_SIZE:
+            return
+
+        if self._shard_file is not None:
+            self._flush()  # entries in the current shard must be durable before it is closed
+            self._shard_file.close()
+            shard_no = int(os.path.splitext(self._shard_name)[0].split("-")[-1]) + 1
+        else:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # continue the last shard of this writer if it is not full
+            shard_no = 0
+            while os.path.exists(os.path.join(self.cache_dir, f"{self.writer_id}-{shard_no + 1:05d}{self.SHARD_FILE_EXT}")):
+                shard_no += 1
+            last_shard = os.path.join(self.cache_dir, f"{self.writer_id}-{shard_no:05d}{self.SHARD_FILE_EXT}")
+            if os.path.exists(last_shard) and os.path.getsize(last_shard) >= self.SHARD_SIZE:
+                shard_no += 1
+
+        self._shard_name = f"{self.writer_id}-{shard_no:05d}{self.SHARD_FILE_EXT}"
+        self._shard_file = open(os.path.join(self.cache_dir, self._shard_name), "ab")
+
+    def _write_array(self, array_and_scale: Tuple[np.ndarray, Optional[float]]) -> dict:
+        array, scale = array_and_scale
+        offset = self._shard_file.tell()
+        padding = (-offset) % self.ALIGNMENT
+        if padding > 0:
+            self._shard_file.write(b"\0" * padding)
+            offset += padding
+        array = np.ascontiguousarray(array)
+        self._shard_file.write(array.tobytes())
+        array_info = {"offset": offset, "shape": list(array.shape), "dtype": array.dtype.str}
+        if scale is not None:
+            array_info["scale"] = scale
+        return array_info
+
+    def save(
+        self,
+        key: str,
+        reso: Tuple[int, int],
+        latents_tensor,
+        original_size,
+        crop_ltrb,
+        flipped_latents_tensor=None,
+        alpha_mask=None,
+        storage_dtype: str = "float32",
+    ) -> None:
+        # same arguments as save_latents_to_disk except key and reso
+        latents = encode_cache_array(latents_tensor, storage_dtype)
+        if flipped_latents_tensor is not None:
+            flipped_latents = encode_cache_array(flipped_latents_tensor, storage_dtype)
+        else:
+            flipped_latents = None
+        if alpha_mask is not None:
+            alpha_mask = encode_cache_array(alpha_mask, get_alpha_mask_storage_dtype(storage_dtype))
+
+        with self._lock:
+            self._prepare_shard_for_write()
+            if self._index is None:
+                self._load_index()
+
+            arrays = {"latents": self._write_array(latents)}
+            if flipped_latents is not None:
+                arrays["latents_flipped"] = self._write_array(flipped_latents)
+            if alpha_mask is not None:
+                arrays["alpha_mask"] = self._write_array(alpha_mask)
+
+            entry = {
+                "key": key,
+                "reso": [int(reso[0]), int(reso[1])],
+                "shard": self._shard_name,
+                "original_size": np.array(original_size).tolist(),
+                "crop_ltrb": np.array(crop_ltrb).tolist(),
+                "arrays": arrays,
+            }
+            self._pending_entries.append(entry)
+            self._index[(key, tuple(reso))] = entry
+
+            if len(self._pending_entries) >= self.INDEX_FLUSH_INTERVAL:
+                self._flush()
+
+    def _flush(self) -> None:
+        if len(self._pending_entries) == 0:
+            return
+
+        # data must be durable before the index entries refer to it
+        self._shard_file.flush()
+        os.fsync(self._shard_file.fileno())
+
+        if self._index_file is None:
+            index_path = os.path.join(self.cache_dir, f"{self.INDEX_FILE_PREFIX}{self.writer_id}{self.INDEX_FILE_EXT}")
+            self._index_file = open(index_path, "at", encoding="utf-8")
+        self._index_file.write("".join([json.dumps(entry) + "\n" for entry in self._pending_entries]))
+        self._index_file.flush()
+        os.fsync(self._index_file.fileno())
+        self._pending_entries = []
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def close(self) -> None:
+        with self._lock:
+            self._flush()
+            if self._shard_file is not None:
+                self._shard_file.close()
+                self._shard_file = None
+                self._shard_name = None
+            if self._index_file is not None:
+                self._index_file.close()
+                self._index_file = None
+
+
 def debug_dataset(train_dataset, show_input_ids=False):
     logger.info(f"Total dataset length (steps) / データセットの長さ（ステップ数）: {len(train_dataset)}")
     logger.info(
@@ -2320,6 +3526,7 @@ def debug_dataset(train_dataset, show_input_ids=False):
             logger.info(f"steps: {steps} ({i + 1}/{len(train_dataset)})")
 
             example = train_dataset[idx]
+            apply_device_augmentation(example, torch.device("cpu"))
             if example["latents"] is not None:
                 logger.info(f"sample has latents from npz file: {example['latents'].size()}")
             for j, (ik, cap, lw, iid, orgsz, crptl, trgsz, flpdz) in enumerate(
@@ -2501,6 +3708,18 @@ def load_image(image_path, alpha=False):
 
 
 # 画像を読み込む。戻り値はnumpy.ndarray,(original width, original height),(crop left, crop top, crop right, crop bottom)
+def get_trim_offsets(random_crop: bool, resized_size: Tuple[int, int], reso) -> Tuple[int, int]:
+    # left and top offsets to trim the resized image to the bucket reso
+    trim_left = trim_top = 0
+    if resized_size[0] > reso[0]:
+        trim_size = resized_size[0] - reso[0]
+        trim_left = trim_size // 2 if not random_crop else random.randint(0, trim_size)
+    if resized_size[1] > reso[1]:
+        trim_size = resized_size[1] - reso[1]
+        trim_top = trim_size // 2 if not random_crop else random.randint(0, trim_size)
+    return trim_left, trim_top
+
+
 def trim_and_resize_if_required(
     random_crop: bool, image: np.ndarray, reso, resized_size: Tuple[int, int]
 ) -> Tuple[np.ndarray, Tuple[int, int], Tuple[int, int, int, int]]:
@@ -2516,16 +3735,8 @@ def trim_and_resize_if_required(
 
     image_height, image_width = image.shape[0:2]
 
-    if image_width > reso[0]:
-        trim_size = image_width - reso[0]
-        p = trim_size // 2 if not random_crop else random.randint(0, trim_size)
-        # logger.info(f"w {trim_size} {p}")
-        image = image[:, p : p + reso[0]]
-    if image_height > reso[1]:
-        trim_size = image_height - reso[1]
-        p = trim_size // 2 if not random_crop else random.randint(0, trim_size)
-        # logger.info(f"h {trim_size} {p})
-        image = image[p : p + reso[1]]
+    trim_left, trim_top = get_trim_offsets(random_crop, (image_width, image_height), reso)
+    image = image[trim_top : trim_top + reso[1], trim_left : trim_left + reso[0]]
 
     # random cropの場合のcropされた値をどうcrop left/topに反映するべきか全くアイデアがない
     # I have no idea how to reflect the cropped value in crop left/top in the case of random crop
@@ -2536,20 +3747,160 @@ def trim_and_resize_if_required(
     return image, original_size, crop_ltrb
 
 
-def cache_batch_latents(
-    vae: AutoencoderKL, cache_to_disk: bool, image_infos: List[ImageInfo], flip_aug: bool, use_alpha_mask: bool, random_crop: bool
-) -> None:
+def shift_hue_on_device(images: torch.Tensor, hue_shifts: torch.Tensor) -> torch.Tensor:
     r"""
-    requires image_infos to have: absolute_path, bucket_reso, resized_size, latents_npz
-    optionally requires image_infos to have: image
-    if cache_to_disk is True, set info.latents_npz
-        flipped latents is also saved if flip_aug is True
-    if cache_to_disk is False, set info.latents
-        latents_flipped is also set if flip_aug is True
-    latents_original_size and latents_crop_ltrb are also set
+    images: [B,3,H,W] 0~255, hue_shifts: [B] in OpenCV hue unit (180 for 360 degrees)
+    AugHelper.color_aug converts RGB images with COLOR_BGR2HSV, so the channel 2 is treated as red like it
+    """
+    b, g, r = images[:, 0], images[:, 1], images[:, 2]
+    max_c = torch.max(torch.max(r, g), b)
+    min_c = torch.min(torch.min(r, g), b)
+    delta = max_c - min_c
+    safe_delta = delta.clamp_min(1e-6)
+    saturation = delta / max_c.clamp_min(1e-6)
+
+    # hue in 0~6
+    hue = torch.where(
+        max_c == r, ((g - b) / safe_delta) % 6, torch.where(max_c == g, (b - r) / safe_delta + 2, (r - g) / safe_delta + 4)
+    )
+    hue = (hue + hue_shifts[:, None, None] / 30.0) % 6
+
+    def channel(n):
+        k = (n + hue) % 6
+        return max_c - max_c * saturation * torch.clamp(torch.min(k, 4 - k), 0, 1)
+
+    return torch.stack([channel(1), channel(3), channel(5)], dim=1)  # b, g, r
+
+
+def apply_device_augmentation(batch: dict, device: torch.device) -> None:
+    r"""
+    --device_augmentation が有効な場合に、uint8の画像のリサイズ、trim、augmentation、正規化を学習デバイス上で行う
+    resize, trim, color augmentation, flip and normalization of the uint8 images in the batch on the device.
+    sets batch["images"] to [B,3,H,W] in -1.0~1.0 and batch["alpha_masks"] if any image has alpha channel.
+    does nothing if the batch is not made with device augmentation
+    """
+    params = batch.get("device_augmentation_params")
+    if params is None or batch["images"] is None:
+        return
+
+    # 画像ごとにサイズが異なるので、リサイズとtrimは一枚ずつ行う
+    images = []
+    for image, (resized_size, (trim_left, trim_top), reso, _, _, _) in zip(batch["images"], params):
+        image = image.to(device, non_blocking=True).permute(2, 0, 1).unsqueeze(0).float()  # 1,C,H,W
+        height, width = image.shape[2:]
+        if width != resized_size[0] or height != resized_size[1]:
+            size = (resized_size[1], resized_size[0])
+            if width > resized_size[0] and height > resized_size[1]:
+                image = torch.nn.functional.interpolate(image, size=size, mode="area")  # same as cv2.INTER_AREA
+            else:
+                image = torch.nn.functional.interpolate(image, size=size, mode="bicubic", antialias=True)
+            image = image.round().clamp(0, 255)  # same as uint8 images in CPU path
+        images.append(image[:, :, trim_top : trim_top + reso[1], trim_left : trim_left + reso[0]])
+
+    # if one of images has alpha channel, add opaque alpha channel to others
+    num_channels = max(image.shape[1] for image in images)
+    if num_channels == 4:
+        images = [image if image.shape[1] == 4 else torch.cat([image, torch.full_like(image[:, :1], 255)], dim=1) for image in images]
+    images = torch.cat(images)
+
+    # ここからはbatch全体をまとめて処理する
+    flipped = torch.tensor([p[5] for p in params], dtype=torch.bool, device=device)
+    images = torch.where(flipped[:, None, None, None], images.flip(3), images)
+
+    rgb = images[:, :3]
+    gammas = [p[4] for p in params]
+    if any(gamma is not None for gamma in gammas):
+        has_gamma = torch.tensor([gamma is not None for gamma in gammas], dtype=torch.bool, device=device)
+        gammas = torch.tensor([1.0 if gamma is None else gamma for gamma in gammas], dtype=torch.float32, device=device)
+        rgb = torch.where(has_gamma[:, None, None, None], (rgb ** gammas[:, None, None, None]).clamp(0, 255).floor(), rgb)
+    hue_shifts = [p[3] for p in params]
+    if any(hue_shift is not None for hue_shift in hue_shifts):
+        hue_shifts = torch.tensor([0.0 if h is None else h for h in hue_shifts], dtype=torch.float32, device=device)
+        rgb = shift_hue_on_device(rgb, hue_shifts)
+
+    batch["images"] = (rgb / 127.5 - 1.0).contiguous()  # same as IMAGE_TRANSFORMS
+    if num_channels == 4:
+        batch["alpha_masks"] = images[:, 3] / 255.0
+
+
+class LatentsCachingCondition(NamedTuple):
+    # images in a batch for caching latents must have the same condition
+    reso: Tuple[int, int]
+    flip_aug: bool
+    alpha_mask: bool
+    random_crop: bool
+
+
+def make_batches_for_latents_caching(
+    image_infos: List[ImageInfo], image_to_subset: Dict[str, BaseSubset], vae_batch_size: int
+) -> List[Tuple[LatentsCachingCondition, List[ImageInfo]]]:
+    # sort by resolution, and split by resolution and some conditions
+    image_infos = sorted(image_infos, key=lambda info: info.bucket_reso[0] * info.bucket_reso[1])
+
+    batches: List[Tuple[LatentsCachingCondition, List[ImageInfo]]] = []
+    batch: List[ImageInfo] = []
+    current_condition = None
+
+    for info in image_infos:
+        subset = image_to_subset[info.image_key]
+
+        # if batch is not empty and condition is changed, flush the batch. Note that current_condition is not None if batch is not empty
+        condition = LatentsCachingCondition(tuple(info.bucket_reso), subset.flip_aug, subset.alpha_mask, subset.random_crop)
+        if len(batch) > 0 and current_condition != condition:
+            batches.append((current_condition, batch))
+            batch = []
+
+        batch.append(info)
+        current_condition = condition
+
+        # if number of data in batch is enough, flush the batch
+        if len(batch) >= vae_batch_size:
+            batches.append((current_condition, batch))
+            batch = []
+            current_condition = None
+
+    if len(batch) > 0:
+        batches.append((current_condition, batch))
+    return batches
+
+
+def encode_batches_for_latents_caching(vae, batches: List[Tuple[LatentsCachingCondition, List[ImageInfo]]]):
+    r"""
+    generator of (condition, image_infos, latents, flipped_latents, alpha_masks) for each batch, in the same order as batches.
+    images of the following batches are loaded and resized by worker threads while the current batch is encoded by VAE
+    """
+    num_loader_workers = max(1, min(8, os.cpu_count() or 1))
+    max_prefetch_batches = num_loader_workers * 2
+
+    with ThreadPoolExecutor(max_workers=num_loader_workers) as loader:
+        load_futures = collections.deque()
+        next_batch_index = 0
+        for condition, batch in batches:
+            # keep loading batches ahead (bounded)
+            while next_batch_index < len(batches) and len(load_futures) < max_prefetch_batches:
+                next_condition, next_batch = batches[next_batch_index]
+                load_futures.append(
+                    loader.submit(load_images_for_latents_caching, next_batch, next_condition.alpha_mask, next_condition.random_crop)
+                )
+                next_batch_index += 1
+
+            images, alpha_masks = load_futures.popleft().result()
+            latents, flipped_latents = encode_images_for_latents_caching(vae, images, condition.flip_aug)
+            del images
+
+            yield condition, batch, latents, flipped_latents, alpha_masks
+
+
+def load_images_for_latents_caching(
+    image_infos: List[ImageInfo], use_alpha_mask: bool, random_crop: bool
+) -> Tuple[np.ndarray, List[Optional[torch.Tensor]]]:
+    r"""
+    load, resize and trim images for caching latents. this is CPU only, so it can be run in worker threads
+    returns uint8 images [B,H,W,3] and alpha masks [H,W] (or None)
+    latents_original_size and latents_crop_ltrb of image_infos are set
     """
     images = []
-    alpha_masks: List[np.ndarray] = []
+    alpha_masks: List[Optional[torch.Tensor]] = []
     for info in image_infos:
         image = load_image(info.absolute_path, use_alpha_mask) if info.image is None else np.array(info.image, np.uint8)
         # TODO 画像のメタデータが壊れていて、メタデータから割り当てたbucketと実際の画像サイズが一致しない場合があるのでチェック追加要
@@ -2564,17 +3915,23 @@ def cache_batch_latents(
                 alpha_mask = alpha_mask.astype(np.float32) / 255.0
                 alpha_mask = torch.FloatTensor(alpha_mask)  # [H,W]
             else:
-                alpha_mask = torch.ones_like(image[:, :, 0], dtype=torch.float32)  # [H,W]
+                alpha_mask = torch.ones(image.shape[:2], dtype=torch.float32)  # [H,W]
         else:
             alpha_mask = None
         alpha_masks.append(alpha_mask)
 
-        image = image[:, :, :3]  # remove alpha channel if exists
-        image = IMAGE_TRANSFORMS(image)
-        images.append(image)
+        images.append(image[:, :, :3])  # remove alpha channel if exists
+
+    return np.stack(images, axis=0), alpha_masks
+
 
-    img_tensors = torch.stack(images, dim=0)
-    img_tensors = img_tensors.to(device=vae.device, dtype=vae.dtype)
+def encode_images_for_latents_caching(
+    vae: AutoencoderKL, images: np.ndarray, flip_aug: bool
+) -> Tuple[torch.Tensor, Union[torch.Tensor, List[None]]]:
+    # uint8 [B,H,W,3] is transferred to the device and normalized there. same as IMAGE_TRANSFORMS
+    img_tensors = torch.from_numpy(images).to(vae.device).permute(0, 3, 1, 2)
+    img_tensors = img_tensors.float().div(255.0).sub(0.5).div(0.5)
+    img_tensors = img_tensors.to(memory_format=torch.contiguous_format, dtype=vae.dtype)
 
     with torch.no_grad():
         latents = vae.encode(img_tensors).latent_dist.sample().to("cpu")
@@ -2586,12 +3943,39 @@ def cache_batch_latents(
     else:
         flipped_latents = [None] * len(latents)
 
+    if not HIGH_VRAM:
+        clean_memory_on_device(vae.device)
+
+    return latents, flipped_latents
+
+
+def save_batch_latents(
+    cache_to_disk: bool,
+    image_infos: List[ImageInfo],
+    latents: torch.Tensor,
+    flipped_latents: Union[torch.Tensor, List[None]],
+    alpha_masks: List[Optional[torch.Tensor]],
+    flip_aug: bool,
+    latents_store: Optional[ShardedLatentsStore] = None,
+    storage_dtype: str = "float32",
+) -> None:
     for info, latent, flipped_latent, alpha_mask in zip(image_infos, latents, flipped_latents, alpha_masks):
         # check NaN
         if torch.isnan(latents).any() or (flipped_latent is not None and torch.isnan(flipped_latent).any()):
             raise RuntimeError(f"NaN detected in latents: {info.absolute_path}")
 
-        if cache_to_disk:
+        if cache_to_disk and info.latents_store_key is not None:
+            latents_store.save(
+                info.latents_store_key,
+                info.bucket_reso,
+                latent,
+                info.latents_original_size,
+                info.latents_crop_ltrb,
+                flipped_latent,
+                alpha_mask,
+                storage_dtype,
+            )
+        elif cache_to_disk:
             save_latents_to_disk(
                 info.latents_npz,
                 latent,
@@ -2599,6 +3983,7 @@ def cache_batch_latents(
                 info.latents_crop_ltrb,
                 flipped_latent,
                 alpha_mask,
+                storage_dtype,
             )
         else:
             info.latents = latent
@@ -2606,56 +3991,194 @@ def cache_batch_latents(
                 info.latents_flipped = flipped_latent
             info.alpha_mask = alpha_mask
 
-    if not HIGH_VRAM:
-        clean_memory_on_device(vae.device)
+
+def cache_batch_latents(
+    vae: AutoencoderKL,
+    cache_to_disk: bool,
+    image_infos: List[ImageInfo],
+    flip_aug: bool,
+    use_alpha_mask: bool,
+    random_crop: bool,
+    latents_store: Optional[ShardedLatentsStore] = None,
+    writer: Optional[AsyncCacheWriter] = None,
+    storage_dtype: str = "float32",
+) -> None:
+    r"""
+    requires image_infos to have: absolute_path, bucket_reso, resized_size, latents_npz
+    optionally requires image_infos to have: image
+    if cache_to_disk is True, set info.latents_npz
+        flipped latents is also saved if flip_aug is True
+        if info.latents_store_key is set, latents are saved to latents_store instead of npz
+        if writer is specified, files are written in background. call writer.flush() to wait for them
+        latents are stored as storage_dtype (one of CACHE_STORAGE_DTYPES)
+    if cache_to_disk is False, set info.latents
+        latents_flipped is also set if flip_aug is True
+    latents_original_size and latents_crop_ltrb are also set
+    """
+    images, alpha_masks = load_images_for_latents_caching(image_infos, use_alpha_mask, random_crop)
+    latents, flipped_latents = encode_images_for_latents_caching(vae, images, flip_aug)
+    if cache_to_disk and writer is not None:
+        writer.submit(
+            save_batch_latents, True, image_infos, latents, flipped_latents, alpha_masks, flip_aug, latents_store, storage_dtype
+        )
+    else:
+        save_batch_latents(
+            cache_to_disk, image_infos, latents, flipped_latents, alpha_masks, flip_aug, latents_store, storage_dtype
+        )
 
 
 def cache_batch_text_encoder_outputs(
-    image_infos, tokenizers, text_encoders, max_token_length, cache_to_disk, input_ids1, input_ids2, dtype
+    image_infos,
+    tokenizers,
+    text_encoders,
+    max_token_length,
+    cache_to_disk,
+    input_ids1,
+    input_ids2,
+    dtype,
+    writer=None,
+    storage_dtype="float32",
+    clip_skip=None,
+    v2=False,
+    num_variants=1,
 ):
+    """
+    SDXL: input_ids2 is required, all outputs are cached.
+    SD1/2: input_ids2 is None, only hidden_state1 (with clip_skip and max_token_length applied) is cached.
+    If num_variants > 1, input_ids are (b*num_variants,...) and each image gets (num_variants,...) outputs.
+    """
     input_ids1 = input_ids1.to(text_encoders[0].device)
-    input_ids2 = input_ids2.to(text_encoders[1].device)
 
     with torch.no_grad():
-        b_hidden_state1, b_hidden_state2, b_pool2 = get_hidden_states_sdxl(
-            max_token_length,
-            input_ids1,
-            input_ids2,
-            tokenizers[0],
-            tokenizers[1],
-            text_encoders[0],
-            text_encoders[1],
-            dtype,
-        )
+        if input_ids2 is not None:
+            input_ids2 = input_ids2.to(text_encoders[1].device)
+            b_hidden_state1, b_hidden_state2, b_pool2 = get_hidden_states_sdxl(
+                max_token_length,
+                input_ids1,
+                input_ids2,
+                tokenizers[0],
+                tokenizers[1],
+                text_encoders[0],
+                text_encoders[1],
+                dtype,
+            )
+        else:
+            b_hidden_state1 = get_hidden_states_sd1_sd2(
+                input_ids1, tokenizers[0], text_encoders[0], clip_skip, max_token_length, v2, dtype
+            )
+            b_hidden_state2 = b_pool2 = None
 
         # ここでcpuに移動しておかないと、上書きされてしまう
         b_hidden_state1 = b_hidden_state1.detach().to("cpu")  # b,n*75+2,768
-        b_hidden_state2 = b_hidden_state2.detach().to("cpu")  # b,n*75+2,1280
-        b_pool2 = b_pool2.detach().to("cpu")  # b,1280
-
-    for info, hidden_state1, hidden_state2, pool2 in zip(image_infos, b_hidden_state1, b_hidden_state2, b_pool2):
-        if cache_to_disk:
-            save_text_encoder_outputs_to_disk(info.text_encoder_outputs_npz, hidden_state1, hidden_state2, pool2)
+        if b_hidden_state2 is not None:
+            b_hidden_state2 = b_hidden_state2.detach().to("cpu")  # b,n*75+2,1280
+            b_pool2 = b_pool2.detach().to("cpu")  # b,1280
+
+    if num_variants > 1:
+        # b*num_variants,... -> b,num_variants,...
+        b_hidden_state1 = b_hidden_state1.reshape(-1, num_variants, *b_hidden_state1.shape[1:])
+        if b_hidden_state2 is not None:
+            b_hidden_state2 = b_hidden_state2.reshape(-1, num_variants, *b_hidden_state2.shape[1:])
+            b_pool2 = b_pool2.reshape(-1, num_variants, *b_pool2.shape[1:])
+
+    cache_params = get_text_encoder_outputs_cache_params(input_ids2 is not None, clip_skip, max_token_length, v2)
+    for i, (info, hidden_state1) in enumerate(zip(image_infos, b_hidden_state1)):
+        hidden_state2 = b_hidden_state2[i] if b_hidden_state2 is not None else None
+        pool2 = b_pool2[i] if b_pool2 is not None else None
+        if cache_to_disk and writer is not None:
+            writer.submit(
+                save_text_encoder_outputs_to_disk,
+                info.text_encoder_outputs_npz,
+                hidden_state1,
+                hidden_state2,
+                pool2,
+                storage_dtype,
+                num_variants,
+                cache_params,
+            )
+        elif cache_to_disk:
+            save_text_encoder_outputs_to_disk(
+                info.text_encoder_outputs_npz, hidden_state1, hidden_state2, pool2, storage_dtype, num_variants, cache_params
+            )
         else:
             info.text_encoder_outputs1 = hidden_state1
             info.text_encoder_outputs2 = hidden_state2
             info.text_encoder_pool2 = pool2
 
 
-def save_text_encoder_outputs_to_disk(npz_path, hidden_state1, hidden_state2, pool2):
-    np.savez(
-        npz_path,
-        hidden_state1=hidden_state1.cpu().float().numpy(),
-        hidden_state2=hidden_state2.cpu().float().numpy(),
-        pool2=pool2.cpu().float().numpy(),
-    )
+def get_text_encoder_outputs_cache_params(
+    is_sdxl: bool, clip_skip: Optional[int], max_token_length: Optional[int], v2: bool
+) -> Dict[str, int]:
+    # options which change SD1/2 outputs, recorded in the cache as scalars. None is recorded as 0
+    if is_sdxl:
+        return {}
+    return {"clip_skip": clip_skip or 0, "max_token_length": max_token_length or 0, "v2": int(v2)}
 
 
-def load_text_encoder_outputs_from_disk(npz_path):
+def save_text_encoder_outputs_to_disk(
+    npz_path,
+    hidden_state1,
+    hidden_state2,
+    pool2,
+    storage_dtype: str = "float32",
+    num_variants: int = 1,
+    cache_params: Optional[Dict[str, int]] = None,
+):
+    # hidden_state2 and pool2 are None for SD1/2
+    # with num_variants > 1, the states have the variants in the first dim and each variant is saved as a separate array
+    # (e.g. hidden_state1_0, hidden_state1_1, ...), so that loading one variant reads only that variant
+    arrays = {}
+    if num_variants > 1:
+        arrays["num_variants"] = np.array(num_variants, dtype=np.int32)
+    for key, value in (cache_params or {}).items():
+        arrays[key] = np.array(value, dtype=np.int32)
+    suffixes = [""] if num_variants == 1 else [f"_{k}" for k in range(num_variants)]
+    for k, suffix in enumerate(suffixes):
+        index = slice(None) if num_variants == 1 else k
+        add_cache_array(arrays, "hidden_state1" + suffix, hidden_state1[index], storage_dtype)
+        if hidden_state2 is not None:
+            add_cache_array(arrays, "hidden_state2" + suffix, hidden_state2[index], storage_dtype)
+        if pool2 is not None:
+            add_cache_array(arrays, "pool2" + suffix, pool2[index], storage_dtype)
+    savez_atomic(npz_path, **arrays)
+
+
+def is_disk_cached_text_encoder_outputs_valid(
+    npz_path: str, is_sdxl: bool, num_variants: int = 1, cache_params: Optional[Dict[str, int]] = None
+) -> bool:
+    # SD1/2 and SDXL caches share the same file name, so check that the cache matches the model, the number of variants
+    # and the options recorded by get_text_encoder_outputs_cache_params. only the headers and scalars are read
+    if not os.path.exists(npz_path):
+        return False
+    try:
+        shapes, scalars = load_npz_array_shapes_and_scalars(npz_path)
+    except Exception as e:
+        logger.error(f"Error loading file / ファイル読み込みエラー: {npz_path}")
+        raise e
+
+    suffix = "" if num_variants == 1 else "_0"
+    if "hidden_state1" + suffix not in shapes:  # also rejects old caches with stacked variants
+        return False
+    if ("hidden_state2" + suffix in shapes) != is_sdxl:
+        return False
+    if scalars.get("num_variants", 1) != num_variants:
+        return False
+    for key, value in (cache_params or {}).items():
+        if scalars.get(key) != value:  # old cache without the options is also invalid
+            return False
+    return True
+
+
+def load_text_encoder_outputs_from_disk(npz_path, variant: Optional[int] = None):
+    # variant: index of the caption variant to load from a cache with num_variants > 1. np.load is lazy, so only that
+    # variant is read from the file
+    suffix = "" if variant is None else f"_{variant}"
     with np.load(npz_path) as f:
-        hidden_state1 = torch.from_numpy(f["hidden_state1"])
-        hidden_state2 = torch.from_numpy(f["hidden_state2"]) if "hidden_state2" in f else None
-        pool2 = torch.from_numpy(f["pool2"]) if "pool2" in f else None
+        hidden_state1 = torch.from_numpy(get_cache_array(f, "hidden_state1" + suffix))
+        hidden_state2 = get_cache_array(f, "hidden_state2" + suffix)
+        hidden_state2 = torch.from_numpy(hidden_state2) if hidden_state2 is not None else None
+        pool2 = get_cache_array(f, "pool2" + suffix)
+        pool2 = torch.from_numpy(pool2) if pool2 is not None else None
     return hidden_state1, hidden_state2, pool2
 
 
@@ -3598,6 +5121,24 @@ def add_masked_loss_arguments(parser: argparse.ArgumentParser):
     )
 
 
+def add_text_encoder_caching_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument(
+        "--cache_text_encoder_outputs", action="store_true", help="cache text encoder outputs / text encoderの出力をキャッシュする"
+    )
+    parser.add_argument(
+        "--cache_text_encoder_outputs_to_disk",
+        action="store_true",
+        help="cache text encoder outputs to disk / text encoderの出力をディスクにキャッシュする",
+    )
+    parser.add_argument(
+        "--cache_text_encoder_outputs_variants",
+        type=int,
+        default=1,
+        help="number of augmented captions (shuffle_caption, caption_tag_dropout_rate, caption_dropout_rate, wildcards) to cache per image,"
+        + " one of them is used for each step / 画像ごとにキャッシュするキャプション拡張（shuffle_caption等）のバリエーション数、各ステップでそのうち一つを使う",
+    )
+
+
 def get_sanitized_config_or_none(args: argparse.Namespace):
     # if `--log_config` is enabled, return args for logging. if not, return None.
     # when `--log_config is enabled, filter out sensitive values from args
@@ -3707,6 +5248,11 @@ def verify_training_args(args: argparse.Namespace):
             "cache_latents_to_disk is enabled, so cache_latents is also enabled / cache_latents_to_diskが有効なため、cache_latentsを有効にします"
         )
 
+    if args.device_augmentation and args.cache_latents:
+        raise ValueError(
+            "device_augmentation cannot be used with cache_latents / device_augmentationとcache_latentsは同時に指定できません"
+        )
+
     # noise_offset, perlin_noise, multires_noise_iterations cannot be enabled at the same time
     # # Listを使って数えてもいいけど並べてしまえ
     # if args.noise_offset is not None and args.multires_noise_iterations is not None:
@@ -3818,9 +5364,24 @@ def add_dataset_arguments(
     parser.add_argument(
         "--color_aug", action="store_true", help="enable weak color augmentation / 学習時に色合いのaugmentationを有効にする"
     )
+    parser.add_argument(
+        "--device_augmentation",
+        action="store_true",
+        help="resize, crop, augment and normalize images on the training device per batch instead of in DataLoader workers. not available with cache_latents"
+        + " / 画像のリサイズ、crop、augmentation、正規化をDataLoaderのworkerではなく学習デバイス上でbatchごとに行う。cache_latentsとは併用できません",
+    )
     parser.add_argument(
         "--flip_aug", action="store_true", help="enable horizontal flip augmentation / 学習時に左右反転のaugmentationを有効にする"
     )
+    parser.add_argument(
+        "--cache_images_in_memory_mb",
+        type=int,
+        default=None,
+        help="cache decoded images in shared memory up to this size (MB) for augmentation without latents caching (e.g. color_aug, random_crop)."
+        + " the size is per process: each GPU process has its own cache"
+        + " / デコードした画像を指定サイズ（MB）までshared memoryにキャッシュする。latentsをキャッシュできないaugmentation（color_aug、random_cropなど）用。"
+        + "サイズはプロセスごと（GPUごとに別のキャッシュを持つ）",
+    )
     parser.add_argument(
         "--face_crop_aug_range",
         type=str,
@@ -3856,6 +5417,21 @@ def add_dataset_arguments(
         action="store_true",
         help="cache latents to disk to reduce VRAM usage (augmentations must be disabled) / VRAM削減のためにlatentをディスクにcacheする（augmentationは使用不可）",
     )
+    parser.add_argument(
+        "--latents_cache_dir",
+        type=str,
+        default=None,
+        help="directory for sharded latents cache. if specified with cache_latents_to_disk, latents are stored in a few large shard files in this directory instead of npz files next to images"
+        + " / 分割latentsキャッシュのディレクトリ。cache_latents_to_diskと同時に指定すると、画像ごとのnpzファイルの代わりにこのディレクトリ内の少数の大きなshardファイルにlatentsを格納する",
+    )
+    parser.add_argument(
+        "--cache_storage_dtype",
+        type=str,
+        default="float32",
+        choices=CACHE_STORAGE_DTYPES,
+        help="dtype to store latents and text encoder outputs in disk cache. bfloat16 is stored as uint16, int8 is scaled per tensor. they are upcast to float32 on load"
+        + " / latentsとtext encoder出力をディスクにキャッシュするときの型。bfloat16はuint16として、int8はテンソルごとのスケール付きで保存され、読み込み時にfloat32に戻される",
+    )
     parser.add_argument(
         "--enable_bucket",
         action="store_true",
@@ -4742,6 +6318,14 @@ def patch_accelerator_for_fp16_training(accelerator):
 
 
 def get_hidden_states(args: argparse.Namespace, input_ids, tokenizer, text_encoder, weight_dtype=None):
+    return get_hidden_states_sd1_sd2(
+        input_ids, tokenizer, text_encoder, args.clip_skip, args.max_token_length, args.v2, weight_dtype
+    )
+
+
+def get_hidden_states_sd1_sd2(
+    input_ids, tokenizer, text_encoder, clip_skip=None, max_token_length=None, v2=False, weight_dtype=None
+):
     # with no_token_padding, the length is not max length, return result immediately
     if input_ids.size()[-1] != tokenizer.model_max_length:
         return text_encoder(input_ids)[0]
@@ -4750,21 +6334,21 @@ def get_hidden_states(args: argparse.Namespace, input_ids, tokenizer, text_encod
     b_size = input_ids.size()[0]
     input_ids = input_ids.reshape((-1, tokenizer.model_max_length))  # batch_size*3, 77
 
-    if args.clip_skip is None:
+    if clip_skip is None:
         encoder_hidden_states = text_encoder(input_ids)[0]
     else:
         enc_out = text_encoder(input_ids, output_hidden_states=True, return_dict=True)
-        encoder_hidden_states = enc_out["hidden_states"][-args.clip_skip]
+        encoder_hidden_states = enc_out["hidden_states"][-clip_skip]
         encoder_hidden_states = text_encoder.text_model.final_layer_norm(encoder_hidden_states)
 
     # bs*3, 77, 768 or 1024
     encoder_hidden_states = encoder_hidden_states.reshape((b_size, -1, encoder_hidden_states.shape[-1]))
 
-    if args.max_token_length is not None:
-        if args.v2:
+    if max_token_length is not None:
+        if v2:
             # v2: <BOS>...<EOS> <PAD> ... の三連を <BOS>...<EOS> <PAD> ... へ戻す　正直この実装でいいのかわからん
             states_list = [encoder_hidden_states[:, 0].unsqueeze(1)]  # <BOS>
-            for i in range(1, args.max_token_length, tokenizer.model_max_length):
+            for i in range(1, max_token_length, tokenizer.model_max_length):
                 chunk = encoder_hidden_states[:, i : i + tokenizer.model_max_length - 2]  # <BOS> の後から 最後の前まで
                 if i > 0:
                     for j in range(len(chunk)):
@@ -4776,7 +6360,7 @@ def get_hidden_states(args: argparse.Namespace, input_ids, tokenizer, text_encod
         else:
             # v1: <BOS>...<EOS> の三連を <BOS>...<EOS> へ戻す
             states_list = [encoder_hidden_states[:, 0].unsqueeze(1)]  # <BOS>
-            for i in range(1, args.max_token_length, tokenizer.model_max_length):
+            for i in range(1, max_token_length, tokenizer.model_max_length):
                 states_list.append(
                     encoder_hidden_states[:, i : i + tokenizer.model_max_length - 2]
                 )  # <BOS> の後から <EOS> の前まで
@@ -5709,12 +7293,103 @@ class collator_class:
         return examples[0]
 
 
+class DevicePrefetcher:
+    """
+    wraps a (prepared) DataLoader and transfers the next batch to the device on a side stream while the current step runs.
+    the DataLoader should be created with pin_memory=True so that batches are pinned in its thread: CPU tensors which are
+    not pinned are pinned here as a fallback. if the device is not CUDA, the DataLoader is used as is.
+    """
+
+    def __init__(self, dataloader, device):
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        self.enabled = self.device.type == "cuda" and torch.cuda.is_available()
+
+    def __len__(self):
+        return len(self.dataloader)
+
+    def to_device(self, obj):
+        if isinstance(obj, torch.Tensor):
+            if obj.device.type == "cpu" and not obj.is_pinned():
+                obj = obj.pin_memory()  # fallback, blocks this thread
+            return obj.to(self.device, non_blocking=True)
+        if isinstance(obj, dict):
+            return {k: self.to_device(v) for k, v in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.to_device(v) for v in obj)
+        return obj
+
+    def record_stream(self, obj, stream):
+        # tensors allocated on the side stream are used on the current stream
+        if isinstance(obj, torch.Tensor):
+            if obj.device.type == "cuda":
+                obj.record_stream(stream)
+        elif isinstance(obj, dict):
+            for v in obj.values():
+                self.record_stream(v, stream)
+        elif isinstance(obj, (list, tuple)):
+            for v in obj:
+                self.record_stream(v, stream)
+
+    def __iter__(self):
+        if not self.enabled:
+            yield from self.dataloader
+            return
+
+        # accelerate's DataLoaderShard transfers batches synchronously by itself, so leave it to this prefetcher
+        if getattr(self.dataloader, "device", None) is not None:
+            self.dataloader.device = None
+
+        stream = torch.cuda.Stream(device=self.device)
+        current_stream = torch.cuda.current_stream(self.device)
+        dataloader_iter = iter(self.dataloader)
+
+        def preload():
+            batch = next(dataloader_iter, None)
+            if batch is None:
+                return None
+            with torch.cuda.stream(stream):
+                return self.to_device(batch)
+
+        # do not read ahead of the last batch: accelerate ends the gradient state of the DataLoader at StopIteration
+        num_batches = len(self.dataloader)
+        next_batch = preload() if num_batches > 0 else None
+        for i in range(num_batches):
+            if next_batch is None:
+                return
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            self.record_stream(batch, current_stream)
+
+            next_batch = preload() if i + 1 < num_batches else None
+
+            # accelerate sets end_of_dataloader when the last batch is read, so set it for the batch actually yielded
+            if hasattr(self.dataloader, "end_of_dataloader"):
+                self.dataloader.end_of_dataloader = i + 1 == num_batches
+            yield batch
+
+        # remaining batches if any, and let the DataLoader finish the epoch
+        for batch in dataloader_iter:
+            yield self.to_device(batch)
+
+
 class LossRecorder:
-    def __init__(self):
+    def __init__(self, sync_interval: int = 1):
         self.loss_list: List[float] = []
         self.loss_total: float = 0.0
+        self.last_loss: Optional[float] = None
+
+        # loss tensors are kept on device and copied to host every sync_interval steps to avoid syncing every step
+        self.sync_interval = sync_interval
+        self.pending_losses: List[Tuple[int, int, torch.Tensor]] = []
+
+    def add(self, *, epoch: int, step: int, loss: Union[float, torch.Tensor]) -> None:
+        if isinstance(loss, torch.Tensor):
+            self.pending_losses.append((epoch, step, loss.detach()))
+            if len(self.pending_losses) >= self.sync_interval:
+                self.sync()
+            return
 
-    def add(self, *, epoch: int, step: int, loss: float) -> None:
         if epoch == 0:
             self.loss_list.append(loss)
         else:
@@ -5723,7 +7398,24 @@ class LossRecorder:
             self.loss_total -= self.loss_list[step]
             self.loss_list[step] = loss
         self.loss_total += loss
+        self.last_loss = loss
+
+    def sync(self) -> None:
+        if len(self.pending_losses) == 0:
+            return
+        pending_losses = self.pending_losses
+        self.pending_losses = []
+
+        # copy all pending losses to host at once
+        losses = torch.stack([loss.float() for _, _, loss in pending_losses]).tolist()
+        for (epoch, step, _), loss in zip(pending_losses, losses):
+            self.add(epoch=epoch, step=step, loss=loss)
+
+    @property
+    def is_synced(self) -> bool:
+        return len(self.pending_losses) == 0
 
     @property
     def moving_average(self) -> float:
+        self.sync()
         return self.loss_total / len(self.loss_list)
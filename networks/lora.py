@@ -21,6 +21,95 @@ logger = logging.getLogger(__name__)
 
 RE_UPDOWN = re.compile(r"(up|down)_blocks_(\d+)_(resnets|upsamplers|downsamplers|attentions)_(\d+)_")
 
+# LoRA modules whose original modules are called with the same input: q/k/v of self-attention, k/v of cross-attention
+RE_SHARED_INPUT = [
+    re.compile(r"^(.+_attn1)_to_[qkv]$"),
+    re.compile(r"^(.+_attn2)_to_[kv]$"),
+    re.compile(r"^(.+_self_attn)_[qkv]_proj$"),
+]
+
+
+class LoRASharedInputGroup:
+    """
+    computes LoRA modules which take the same input (e.g. to_q/to_k/to_v) at once: lora_down with one concatenated
+    matmul, and in inference lora_up with one batched matmul. the results are computed by the first module called in
+    the forward of the parent module (attention), and released by the hooks of the parent module.
+    """
+
+    def __init__(self, loras: List["LoRAModule"]):
+        self.loras = loras
+        self.ranks = [lora.lora_dim for lora in loras]
+
+        # lora_up can be batched if all modules have the same rank and the same output dim
+        self.batch_up = len(set(self.ranks)) == 1 and len(set(lora.lora_up.out_features for lora in loras)) == 1
+
+        self.outputs: Optional[List[torch.Tensor]] = None
+        self.outputs_fused = False  # True: outputs are lora_up outputs multiplied by scale, False: lora_down outputs
+
+        self.cached_weights = None
+        self.cached_weights_key = None
+
+    def register_hooks(self, parent_module: torch.nn.Module):
+        # reset before and after each forward of the parent module, so that the results are not kept or reused
+        # even if some modules in the group are skipped (module dropout, disabled, regional etc.)
+        parent_module.register_forward_pre_hook(lambda module, args: self.reset())
+        parent_module.register_forward_hook(lambda module, args, output: self.reset())
+
+    def reset(self):
+        self.outputs = None
+
+    def get_weights(self):
+        # returns concatenated lora_down weight and batched lora_up weight (or None)
+        # in training the weights are concatenated in each forward for backward, in inference they are cached
+        down_weights = [lora.lora_down.weight for lora in self.loras]
+        up_weights = [lora.lora_up.weight for lora in self.loras]
+        if self.loras[0].training:
+            return torch.cat(down_weights, dim=0), None
+
+        key = tuple((w.data_ptr(), w._version) for w in down_weights + up_weights)  # changed by load, to() etc.
+        if key != self.cached_weights_key:
+            with torch.no_grad():
+                down_weight = torch.cat(down_weights, dim=0)
+                up_weight = None
+                if self.batch_up:
+                    # (group, rank, out_dim), scale is multiplied in advance
+                    up_weight = torch.stack([w.t() * lora.scale for w, lora in zip(up_weights, self.loras)])
+                    up_weight = up_weight.to(down_weight.dtype).contiguous()
+            self.cached_weights = (down_weight, up_weight)
+            self.cached_weights_key = key
+        return self.cached_weights
+
+    def compute(self, x: torch.Tensor, fused: bool):
+        down_weight, up_weight = self.get_weights()
+        lx = torch.nn.functional.linear(x, down_weight)
+        if not fused:
+            self.outputs = list(lx.split(self.ranks, dim=-1))
+        elif up_weight is not None:
+            # (N, group*rank) -> (group, N, rank) @ (group, rank, out_dim) -> (group, N, out_dim)
+            lx = lx.reshape(-1, len(self.loras), self.ranks[0]).transpose(0, 1)
+            ly = torch.bmm(lx, up_weight)
+            self.outputs = [y.view(*x.shape[:-1], y.size(-1)) for y in ly]
+        else:
+            lxs = lx.split(self.ranks, dim=-1)
+            self.outputs = [lora.lora_up(lx) * lora.scale for lora, lx in zip(self.loras, lxs)]
+        self.outputs_fused = fused
+
+    def get_output(self, index: int, x: torch.Tensor, fused: bool) -> torch.Tensor:
+        # computed again if the output of this module is already taken, e.g. recomputation by gradient checkpointing
+        if self.outputs is None or self.outputs[index] is None or self.outputs_fused != fused:
+            self.compute(x, fused)
+
+        output = self.outputs[index]
+        self.outputs[index] = None
+        return output
+
+    def lora_down(self, index: int, x: torch.Tensor) -> torch.Tensor:
+        return self.get_output(index, x, False)
+
+    def lora_forward(self, index: int, x: torch.Tensor) -> torch.Tensor:
+        # lora_up(lora_down(x)) * scale, for inference
+        return self.get_output(index, x, True)
+
 
 class LoRAModule(torch.nn.Module):
     """
@@ -82,11 +171,34 @@ class LoRAModule(torch.nn.Module):
         self.rank_dropout = rank_dropout
         self.module_dropout = module_dropout
 
+        self.shared_input_group: Optional[LoRASharedInputGroup] = None  # set by LoRANetwork.fuse_shared_input_modules
+        self.shared_input_index = None
+
     def apply_to(self):
         self.org_forward = self.org_module.forward
         self.org_module.forward = self.forward
         del self.org_module
 
+    def lora_down_forward(self, x):
+        if self.shared_input_group is None:
+            return self.lora_down(x)
+        return self.shared_input_group.lora_down(self.shared_input_index, x)
+
+    def get_multiplier(self, lx: torch.Tensor):
+        # multiplier is a float or a tensor of (batch_size,) for each sample
+        if not isinstance(self.multiplier, torch.Tensor):
+            return self.multiplier
+
+        multiplier = self.multiplier
+        if multiplier.size(0) != lx.size(0):
+            # Text Encoder with max_token_length: batch_size*n chunks
+            assert lx.size(0) % multiplier.size(0) == 0, (
+                f"batch size {lx.size(0)} is not a multiple of the number of multipliers {multiplier.size(0)}"
+                + f" / バッチサイズ {lx.size(0)} が適用率の数 {multiplier.size(0)} の倍数ではありません"
+            )
+            multiplier = multiplier.repeat_interleave(lx.size(0) // multiplier.size(0))
+        return multiplier.to(dtype=lx.dtype).view(-1, *([1] * (lx.dim() - 1)))
+
     def forward(self, x):
         org_forwarded = self.org_forward(x)
 
@@ -95,7 +207,7 @@ class LoRAModule(torch.nn.Module):
             if torch.rand(1) < self.module_dropout:
                 return org_forwarded
 
-        lx = self.lora_down(x)
+        lx = self.lora_down_forward(x)
 
         # normal dropout
         if self.dropout is not None and self.training:
@@ -118,7 +230,7 @@ class LoRAModule(torch.nn.Module):
 
         lx = self.lora_up(lx)
 
-        return org_forwarded + lx * self.multiplier * scale
+        return org_forwarded + lx * self.get_multiplier(lx) * scale
 
 
 class LoRAInfModule(LoRAModule):
@@ -223,7 +335,15 @@ class LoRAInfModule(LoRAModule):
 
     def default_forward(self, x):
         # logger.info(f"default_forward {self.lora_name} {x.size()}")
-        return self.org_forward(x) + self.lora_up(self.lora_down(x)) * self.multiplier * self.scale
+        if self.shared_input_group is None:
+            lx = self.lora_up(self.lora_down(x)) * self.scale
+        else:
+            lx = self.shared_input_group.lora_forward(self.shared_input_index, x)
+
+        multiplier = self.get_multiplier(lx)
+        if isinstance(multiplier, torch.Tensor):
+            return self.org_forward(x) + lx * multiplier
+        return torch.add(self.org_forward(x), lx, alpha=multiplier)  # multiply and add in one op
 
     def forward(self, x):
         if not self.enabled:
@@ -505,6 +625,10 @@ def create_network(
     if block_lr_weight is not None:
         network.set_block_lr_weight(block_lr_weight)
 
+    fuse_qkv = kwargs.get("fuse_qkv", None)
+    if fuse_qkv is not None and str(fuse_qkv).lower() == "true":
+        network.fuse_shared_input_modules()
+
     return network
 
 
@@ -855,6 +979,10 @@ def create_network_from_weights(multiplier, file, vae, text_encoder, unet, weigh
     if block_lr_weight is not None:
         network.set_block_lr_weight(block_lr_weight)
 
+    fuse_qkv = kwargs.get("fuse_qkv", None)
+    if fuse_qkv is not None and str(fuse_qkv).lower() == "true":
+        network.fuse_shared_input_modules()
+
     return network, weights_sd
 
 
@@ -874,6 +1002,9 @@ class LoRANetwork(torch.nn.Module):
     LORA_PREFIX_TEXT_ENCODER1 = "lora_te1"
     LORA_PREFIX_TEXT_ENCODER2 = "lora_te2"
 
+    # set_multiplier accepts a tensor of multipliers for each sample (LoRAModule only)
+    PER_SAMPLE_MULTIPLIER_SUPPORTED = True
+
     def __init__(
         self,
         text_encoder: Union[List[CLIPTextModel], CLIPTextModel],
@@ -1012,6 +1143,9 @@ class LoRANetwork(torch.nn.Module):
                                 rank_dropout=rank_dropout,
                                 module_dropout=module_dropout,
                             )
+                            # parent module (attention) is used to group the modules taking the same input
+                            parent_name = child_name.rsplit(".", 1)[0] if "." in child_name else ""
+                            lora.parent_module_ref = [module.get_submodule(parent_name)]
                             loras.append(lora)
             return loras, skipped
 
@@ -1059,7 +1193,17 @@ class LoRANetwork(torch.nn.Module):
             assert lora.lora_name not in names, f"duplicated lora name: {lora.lora_name}"
             names.add(lora.lora_name)
 
-    def set_multiplier(self, multiplier):
+    def set_multiplier(self, multiplier: Union[float, torch.Tensor]):
+        """
+        multiplier: float, or tensor of (batch_size,) to apply different multipliers to each sample in a batch
+        """
+        if isinstance(multiplier, torch.Tensor) and multiplier.dim() > 0:
+            # move to the device once here, not in each module
+            device = next(self.parameters()).device
+            multiplier = multiplier.to(device, dtype=torch.float32)
+        else:
+            # scalar: replaces the per-sample multipliers of the previous batch
+            multiplier = float(multiplier)
         self.multiplier = multiplier
         for lora in self.text_encoder_loras + self.unet_loras:
             lora.multiplier = self.multiplier
@@ -1094,6 +1238,33 @@ class LoRANetwork(torch.nn.Module):
             lora.apply_to()
             self.add_module(lora.lora_name, lora)
 
+    def fuse_shared_input_modules(self):
+        """
+        group LoRA modules which take the same input (q/k/v of attention) and compute their lora_down at once, and
+        lora_up at once in inference (LoRAInfModule). state_dict is not changed. Conv2d modules are not fused.
+        """
+        groups: Dict[str, List[LoRAModule]] = {}
+        for lora in self.text_encoder_loras + self.unet_loras:
+            if not isinstance(lora.lora_down, torch.nn.Linear):
+                continue
+            for pattern in RE_SHARED_INPUT:
+                m = pattern.match(lora.lora_name)
+                if m:
+                    groups.setdefault(m.group(1), []).append(lora)
+                    break
+
+        num_fused = 0
+        for loras in groups.values():
+            if len(loras) < 2 or len(set(lora.lora_down.in_features for lora in loras)) > 1:
+                continue
+            group = LoRASharedInputGroup(loras)
+            group.register_hooks(loras[0].parent_module_ref[0])
+            for i, lora in enumerate(loras):
+                lora.shared_input_group = group
+                lora.shared_input_index = i
+            num_fused += len(loras)
+        logger.info(f"fuse {num_fused} LoRA modules sharing the same input")
+
     # マージできるかどうかを返す
     def is_mergeable(self):
         return True
@@ -1366,45 +1537,50 @@ class LoRANetwork(torch.nn.Module):
             org_module._lora_restored = False
             lora.enabled = False
 
+    def get_max_norm_groups(self):
+        # group LoRA modules by the shapes of up/down weights to compute the norms in batches
+        groups = {}
+        for lora in self.text_encoder_loras + self.unet_loras:
+            up = lora.lora_up.weight
+            down = lora.lora_down.weight
+            if up.dim() == 4 and up.shape[2:] != (1, 1):
+                raise NotImplementedError(f"max norm regularization is not supported for {lora.lora_name}")
+            key = (tuple(up.shape), tuple(down.shape), up.dtype, up.device)
+            groups.setdefault(key, []).append(lora)
+        return list(groups.values())
+
+    @torch.no_grad()
     def apply_max_norm_regularization(self, max_norm_value, device):
-        downkeys = []
-        upkeys = []
-        alphakeys = []
-        norms = []
-        keys_scaled = 0
+        """
+        scale up/down weights of the modules whose norm of (up @ down) * scale exceeds max_norm_value.
+        returns the number of scaled modules, mean and max of the norms as tensors on the device to avoid syncing.
+        """
+        if getattr(self, "max_norm_groups", None) is None:
+            self.max_norm_groups = self.get_max_norm_groups()
 
-        state_dict = self.state_dict()
-        for key in state_dict.keys():
-            if "lora_down" in key and "weight" in key:
-                downkeys.append(key)
-                upkeys.append(key.replace("lora_down", "lora_up"))
-                alphakeys.append(key.replace("lora_down.weight", "alpha"))
-
-        for i in range(len(downkeys)):
-            down = state_dict[downkeys[i]].to(device)
-            up = state_dict[upkeys[i]].to(device)
-            alpha = state_dict[alphakeys[i]].to(device)
-            dim = down.shape[0]
-            scale = alpha / dim
-
-            if up.shape[2:] == (1, 1) and down.shape[2:] == (1, 1):
-                updown = (up.squeeze(2).squeeze(2) @ down.squeeze(2).squeeze(2)).unsqueeze(2).unsqueeze(3)
-            elif up.shape[2:] == (3, 3) or down.shape[2:] == (3, 3):
-                updown = torch.nn.functional.conv2d(down.permute(1, 0, 2, 3), up).permute(1, 0, 2, 3)
-            else:
-                updown = up @ down
+        keys_scaled = 0
+        norms = []
+        for loras in self.max_norm_groups:
+            ups = [lora.lora_up.weight for lora in loras]
+            downs = [lora.lora_down.weight for lora in loras]
+            up = torch.stack(ups).flatten(2).float()  # n, out, dim (Conv2d up is 1x1)
+            down = torch.stack(downs).flatten(2).float()  # n, dim, in*kernel_size
+            alpha = torch.stack([lora.alpha for lora in loras]).to(device, dtype=torch.float32)
+            scale = alpha / down.shape[1]
+
+            # ||up @ down||_F^2 = sum((up^T up) * (down down^T)): dim x dim matrices instead of out x in
+            gram_up = up.transpose(1, 2) @ up
+            gram_down = down @ down.transpose(1, 2)
+            norm = (gram_up * gram_down).sum(dim=(1, 2)).clamp(min=0).sqrt() * scale
+
+            clamped_norm = norm.clamp(min=max_norm_value / 2)
+            ratio = torch.clamp(clamped_norm, max=max_norm_value) / clamped_norm
+            sqrt_ratio = ratio**0.5
+            torch._foreach_mul_(ups, list(sqrt_ratio.to(ups[0].dtype).unbind(0)))
+            torch._foreach_mul_(downs, list(sqrt_ratio.to(downs[0].dtype).unbind(0)))
 
-            updown *= scale
+            keys_scaled = keys_scaled + (ratio != 1).sum()
+            norms.append(norm * ratio)
 
-            norm = updown.norm().clamp(min=max_norm_value / 2)
-            desired = torch.clamp(norm, max=max_norm_value)
-            ratio = desired.cpu() / norm.cpu()
-            sqrt_ratio = ratio**0.5
-            if ratio != 1:
-                keys_scaled += 1
-                state_dict[upkeys[i]] *= sqrt_ratio
-                state_dict[downkeys[i]] *= sqrt_ratio
-            scalednorm = updown.norm() * ratio
-            norms.append(scalednorm.item())
-
-        return keys_scaled, sum(norms) / len(norms), max(norms)
+        norms = torch.cat(norms)
+        return keys_scaled, norms.mean(), norms.max()
@@ -176,6 +176,9 @@ def train(args):
     ds_for_collator = train_dataset_group if args.max_data_loader_n_workers == 0 else None
     collator = train_util.collator_class(current_epoch, current_step, ds_for_collator)
 
+    if args.device_augmentation:
+        train_dataset_group.enable_device_augmentation()
+
     train_dataset_group.verify_bucket_reso_steps(32)
 
     if args.debug_dataset:
@@ -192,9 +195,12 @@ def train(args):
             train_dataset_group.is_latent_cacheable()
         ), "when caching latents, either color_aug or random_crop cannot be used / latentをキャッシュするときはcolor_augとrandom_cropは使えません"
 
+    if args.cache_images_in_memory_mb is not None and not cache_latents:
+        train_dataset_group.cache_images_in_memory(args.cache_images_in_memory_mb * 1024 * 1024)
+
     if args.cache_text_encoder_outputs:
         assert (
-            train_dataset_group.is_text_encoder_output_cacheable()
+            train_dataset_group.is_text_encoder_output_cacheable(args.cache_text_encoder_outputs_variants)
         ), "when caching text encoder output, either caption_dropout_rate, shuffle_caption, token_warmup_step or caption_tag_dropout_rate cannot be used / text encoderの出力をキャッシュするときはcaption_dropout_rate, shuffle_caption, token_warmup_step, caption_tag_dropout_rateは使えません"
 
     # acceleratorを準備する
@@ -315,6 +321,7 @@ def train(args):
                     None,
                     args.cache_text_encoder_outputs_to_disk,
                     accelerator.is_main_process,
+                    num_variants=args.cache_text_encoder_outputs_variants,
                 )
             accelerator.wait_for_everyone()
 
@@ -413,6 +420,7 @@ def train(args):
         collate_fn=collator,
         num_workers=n_workers,
         persistent_workers=args.persistent_data_loader_workers,
+        pin_memory=torch.cuda.is_available(),
     )
 
     # 学習ステップ数を計算する
@@ -608,13 +616,14 @@ def train(args):
         for m in training_models:
             m.train()
 
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(train_util.DevicePrefetcher(train_dataloader, accelerator.device)):
             current_step.value = global_step
 
             if args.fused_optimizer_groups:
                 optimizer_hooked_count = {i: 0 for i in range(len(optimizers))}  # reset counter for each step
 
             with accelerator.accumulate(*training_models):
+                train_util.apply_device_augmentation(batch, accelerator.device)
                 if "latents" in batch and batch["latents"] is not None:
                     latents = batch["latents"].to(accelerator.device).to(dtype=weight_dtype)
                 else:
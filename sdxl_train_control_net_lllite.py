@@ -114,6 +114,9 @@ def train(args):
     ds_for_collator = train_dataset_group if args.max_data_loader_n_workers == 0 else None
     collator = train_util.collator_class(current_epoch, current_step, ds_for_collator)
 
+    if args.device_augmentation:
+        train_dataset_group.enable_device_augmentation()
+
     train_dataset_group.verify_bucket_reso_steps(32)
 
     if args.debug_dataset:
@@ -134,9 +137,12 @@ def train(args):
             "WARNING: random_crop is not supported yet for ControlNet training / ControlNetの学習ではrandom_cropはまだサポートされていません"
         )
 
+    if args.cache_images_in_memory_mb is not None and not cache_latents:
+        train_dataset_group.cache_images_in_memory(args.cache_images_in_memory_mb * 1024 * 1024)
+
     if args.cache_text_encoder_outputs:
         assert (
-            train_dataset_group.is_text_encoder_output_cacheable()
+            train_dataset_group.is_text_encoder_output_cacheable(args.cache_text_encoder_outputs_variants)
         ), "when caching Text Encoder output, either caption_dropout_rate, shuffle_caption, token_warmup_step or caption_tag_dropout_rate cannot be used / Text Encoderの出力をキャッシュするときはcaption_dropout_rate, shuffle_caption, token_warmup_step, caption_tag_dropout_rateは使えません"
 
     # acceleratorを準備する
@@ -187,6 +193,7 @@ def train(args):
                 None,
                 args.cache_text_encoder_outputs_to_disk,
                 accelerator.is_main_process,
+                num_variants=args.cache_text_encoder_outputs_variants,
             )
         accelerator.wait_for_everyone()
 
@@ -253,6 +260,7 @@ def train(args):
         collate_fn=collator,
         num_workers=n_workers,
         persistent_workers=args.persistent_data_loader_workers,
+        pin_memory=torch.cuda.is_available(),
     )
 
     # 学習ステップ数を計算する
@@ -393,10 +401,11 @@ def train(args):
         accelerator.print(f"\nepoch {epoch+1}/{num_train_epochs}")
         current_epoch.value = epoch + 1
 
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(train_util.DevicePrefetcher(train_dataloader, accelerator.device)):
             current_step.value = global_step
             with accelerator.accumulate(unet):
                 with torch.no_grad():
+                    train_util.apply_device_augmentation(batch, accelerator.device)
                     if "latents" in batch and batch["latents"] is not None:
                         latents = batch["latents"].to(accelerator.device).to(dtype=weight_dtype)
                     else:
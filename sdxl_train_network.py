@@ -22,7 +22,7 @@ class SdxlNetworkTrainer(train_network.NetworkTrainer):
 
         if args.cache_text_encoder_outputs:
             assert (
-                train_dataset_group.is_text_encoder_output_cacheable()
+                train_dataset_group.is_text_encoder_output_cacheable(args.cache_text_encoder_outputs_variants)
             ), "when caching Text Encoder output, either caption_dropout_rate, shuffle_caption, token_warmup_step or caption_tag_dropout_rate cannot be used / Text Encoderの出力をキャッシュするときはcaption_dropout_rate, shuffle_caption, token_warmup_step, caption_tag_dropout_rateは使えません"
 
         assert (
@@ -77,6 +77,7 @@ class SdxlNetworkTrainer(train_network.NetworkTrainer):
                     weight_dtype,
                     args.cache_text_encoder_outputs_to_disk,
                     accelerator.is_main_process,
+                    num_variants=args.cache_text_encoder_outputs_variants,
                 )
 
             text_encoders[0].to("cpu", dtype=torch.float32)  # Text Encoder doesn't work with fp16 on CPU
@@ -169,7 +170,7 @@ class SdxlNetworkTrainer(train_network.NetworkTrainer):
 
 def setup_parser() -> argparse.ArgumentParser:
     parser = train_network.setup_parser()
-    sdxl_train_util.add_sdxl_training_arguments(parser)
+    sdxl_train_util.add_sdxl_training_arguments(parser, support_text_encoder_caching=False)
     return parser
 
 
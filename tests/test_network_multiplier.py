@@ -0,0 +1,71 @@
+import torch
+from PIL import Image
+
+from library.train_util import DatasetGroup, DreamBoothDataset, DreamBoothSubset
+
+
+class DummyTokenizer:
+    model_max_length = 77
+    bos_token_id = 1
+    eos_token_id = 2
+    pad_token_id = 0
+
+    def __call__(self, text, padding=None, truncation=None, max_length=77, return_tensors=None):
+        def encode(t):
+            ids = [1] + [3 + ord(c) % 50 for c in t][: max_length - 2] + [2]
+            return ids + [0] * (max_length - len(ids))
+
+        class Result:
+            input_ids = torch.tensor([encode(t) for t in ([text] if isinstance(text, str) else text)])
+
+        return Result()
+
+
+def make_subset(image_dir, network_multiplier):
+    return DreamBoothSubset(
+        str(image_dir),
+        False,  # is_reg
+        "token",  # class_tokens
+        ".txt",
+        False,  # cache_info
+        False,  # alpha_mask
+        1,  # num_repeats
+        False,  # shuffle_caption
+        ",",
+        0,  # keep_tokens
+        None,
+        None,
+        False,  # enable_wildcard
+        False,  # color_aug
+        False,  # flip_aug
+        None,
+        False,  # random_crop
+        0.0,
+        0,
+        0.0,
+        None,
+        None,
+        0,
+        0,
+        network_multiplier,
+    )
+
+
+def test_subsets_with_different_multipliers_in_one_bucket(tmp_path):
+    subsets = []
+    for name, network_multiplier in [("a", 0.5), ("b", None)]:
+        image_dir = tmp_path / name
+        image_dir.mkdir()
+        for i in range(2):
+            Image.new("RGB", (64, 64)).save(image_dir / f"{name}{i}.png")
+        subsets.append(make_subset(image_dir, network_multiplier))
+
+    # all images have the same size, so they are in the same bucket and in the same batch
+    dataset = DreamBoothDataset(subsets, 4, DummyTokenizer(), None, (64, 64), 1.0, True, 64, 64, 64, False, 1.0, False)
+    dataset.make_buckets()
+    group = DatasetGroup([dataset])
+    group.set_current_epoch(1)
+
+    assert len(group) == 1
+    example = group[0]
+    assert sorted(example["network_multipliers"].tolist()) == [0.5, 0.5, 1.0, 1.0]  # None falls back to the dataset
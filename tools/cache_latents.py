@@ -1,9 +1,12 @@
 # latentsのdiskへの事前キャッシュを行う / cache latents to disk
 
 import argparse
-import math
-from multiprocessing import Value
+import glob
+import json
 import os
+import threading
+from typing import List, Optional
+import zlib
 
 from accelerate.utils import set_seed
 import torch
@@ -22,9 +25,98 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+JOURNAL_FLUSH_INTERVAL = 64  # batches
+
+
+class CacheJournal:
+    r"""
+    キャッシュ済みの画像を記録する。中断後に再開するときは、記録済みの画像をnpzを開かずにスキップする
+    Progress journal of cached images, one json line per image, one file per shard. Entries are recorded after the cache is
+    written and appended to the file on flush, which is called after the cache files (and the sharded store) are flushed,
+    so an entry in the journal always refers to a complete cache.
+    """
+
+    FILE_PREFIX = "cache_latents_journal-"
+    FILE_EXT = ".jsonl"
+
+    def __init__(self, journal_dir: str, shard_index: int, num_shards: int) -> None:
+        os.makedirs(journal_dir, exist_ok=True)
+        self.journal_file = os.path.join(journal_dir, f"{self.FILE_PREFIX}{shard_index:05d}-of-{num_shards:05d}{self.FILE_EXT}")
+        self._pending: List[dict] = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load_entries(cls, journal_dir: str) -> List[dict]:
+        # entries of all shards, the number of shards may be changed from the previous run
+        entries = []
+        for journal_file in sorted(glob.glob(os.path.join(glob.escape(journal_dir), cls.FILE_PREFIX + "*" + cls.FILE_EXT))):
+            with open(journal_file, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.warning(f"ignore broken line in journal: {journal_file}")  # interrupted while writing
+        return entries
+
+    @staticmethod
+    def get_entry_key(entry: dict):
+        return entry["key"], tuple(entry["reso"]), entry["flip_aug"], entry["alpha_mask"]
+
+    def record(self, image_infos: List[train_util.ImageInfo], flip_aug: bool, alpha_mask: bool) -> None:
+        entries = []
+        for info in image_infos:
+            entry = {"key": info.absolute_path, "reso": list(info.bucket_reso), "flip_aug": flip_aug, "alpha_mask": alpha_mask}
+            if info.latents_npz is not None:
+                # npz headers are recorded for the manifest in the merge step
+                entry["npz"] = info.latents_npz
+                entry["shapes"] = {k: list(v) for k, v in train_util.load_npz_array_shapes(info.latents_npz).items()}
+            entries.append(entry)
+        with self._lock:
+            self._pending.extend(entries)
+
+    def flush(self) -> None:
+        with self._lock:
+            entries, self._pending = self._pending, []
+        if len(entries) == 0:
+            return
+        with open(self.journal_file, "at", encoding="utf-8") as f:
+            f.write("".join([json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries]))
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def is_in_shard(absolute_path: str, shard_index: int, num_shards: int) -> bool:
+    # stable across runs and processes, and adding images to the dataset does not move other images to another shard
+    return zlib.crc32(absolute_path.encode("utf-8")) % num_shards == shard_index
+
+
+def merge_caches(args: argparse.Namespace, journal_dir: Optional[str]) -> None:
+    # 全shardの結果をひとつのmanifestにまとめる
+    if args.latents_cache_dir is not None:
+        num_entries = train_util.ShardedLatentsStore(args.latents_cache_dir).merge_indices()
+        logger.info(f"merged latents cache index / indexをまとめました: {num_entries} entries in {args.latents_cache_dir}")
+        return
+
+    if journal_dir is None:
+        logger.warning("journal_dir is not specified, nothing to merge / journal_dirが指定されていないため、まとめる対象がありません")
+        return
+
+    entries = [entry for entry in CacheJournal.load_entries(journal_dir) if entry.get("npz") is not None]
+    manifest = train_util.LatentsCacheManifest()
+    train_util.map_in_threads(
+        lambda entry: manifest.update(entry["key"], entry["npz"], entry["shapes"]), entries, desc="merge journals"
+    )
+    manifest.save()
+    logger.info(f"merged journals into latents cache manifests / manifestにまとめました: {len(entries)} entries")
+
 
 def cache_to_disk(args: argparse.Namespace) -> None:
     setup_logging(args, reset=True)
+
+    if args.merge_only:
+        merge_caches(args, args.journal_dir if args.journal_dir is not None else args.latents_cache_dir)
+        return
+
     train_util.prepare_dataset_args(args, True)
 
     # check cache latents arg
@@ -86,20 +178,47 @@ def cache_to_disk(args: argparse.Namespace) -> None:
         blueprint = blueprint_generator.generate(user_config, args, tokenizer=tokenizers)
         train_dataset_group = config_util.generate_dataset_group_by_blueprint(blueprint.dataset_group)
     else:
-        train_dataset_group = train_util.load_arbitrary_dataset(args, tokenizers)
-
-    # datasetのcache_latentsを呼ばなければ、生の画像が返る
-
-    current_epoch = Value("i", 0)
-    current_step = Value("i", 0)
-    ds_for_collator = train_dataset_group if args.max_data_loader_n_workers == 0 else None
-    collator = train_util.collator_class(current_epoch, current_step, ds_for_collator)
+        raise ValueError("dataset_class is not supported / dataset_classはサポートされていません")
 
     # acceleratorを準備する
     logger.info("prepare accelerator")
     args.deepspeed = False
     accelerator = train_util.prepare_accelerator(args)
 
+    # 画像のパスのハッシュでshardに分ける。accelerateで起動した場合はプロセスごとに一つのshardを担当する
+    num_shards = args.num_shards if args.num_shards is not None else accelerator.num_processes
+    shard_index = args.shard_index if args.shard_index is not None else accelerator.process_index
+    assert (
+        0 <= shard_index < num_shards
+    ), f"shard_index must be in 0 to num_shards-1 / shard_indexは0からnum_shards-1の範囲で指定してください: {shard_index}, {num_shards}"
+    journal_dir = args.journal_dir if args.journal_dir is not None else args.latents_cache_dir
+
+    # collect images of this shard
+    shard_infos = []
+    for dataset in train_dataset_group.datasets:
+        for info in dataset.image_data.values():
+            if info.latents_npz is not None or not is_in_shard(info.absolute_path, shard_index, num_shards):
+                continue  # fine tuning dataset may have npz already
+            if args.latents_cache_dir is not None:
+                info.latents_store_key = info.absolute_path
+            else:
+                info.latents_npz = os.path.splitext(info.absolute_path)[0] + ".npz"
+            shard_infos.append((info, dataset.image_to_subset[info.image_key]))
+    logger.info(f"shard {shard_index}/{num_shards}: {len(shard_infos)} images")
+
+    # resume: skip images recorded in the journal, without opening the cache files
+    journal = None
+    if journal_dir is not None:
+        cached_keys = set(CacheJournal.get_entry_key(entry) for entry in CacheJournal.load_entries(journal_dir))
+        num_infos = len(shard_infos)
+        shard_infos = [
+            (info, subset)
+            for info, subset in shard_infos
+            if (info.absolute_path, tuple(info.bucket_reso), subset.flip_aug, subset.alpha_mask) not in cached_keys
+        ]
+        logger.info(f"skip {num_infos - len(shard_infos)} images recorded in the journal / journalに記録済みの画像をスキップします")
+        journal = CacheJournal(journal_dir, shard_index, num_shards)
+
     # mixed precisionに対応した型を用意しておき適宜castする
     weight_dtype, _ = train_util.prepare_dtype(args)
     vae_dtype = torch.float32 if args.no_half_vae else weight_dtype
@@ -117,61 +236,74 @@ def cache_to_disk(args: argparse.Namespace) -> None:
     vae.requires_grad_(False)
     vae.eval()
 
-    # dataloaderを準備する
-    train_dataset_group.set_caching_mode("latents")
-
-    # DataLoaderのプロセス数：0 は persistent_workers が使えないので注意
-    n_workers = min(args.max_data_loader_n_workers, os.cpu_count())  # cpu_count or max_data_loader_n_workers
-
-    train_dataloader = torch.utils.data.DataLoader(
-        train_dataset_group,
-        batch_size=1,
-        shuffle=True,
-        collate_fn=collator,
-        num_workers=n_workers,
-        persistent_workers=args.persistent_data_loader_workers,
-    )
-
-    # acceleratorを使ってモデルを準備する：マルチGPUで使えるようになるはず
-    train_dataloader = accelerator.prepare(train_dataloader)
-
-    # データ取得のためのループ
-    for batch in tqdm(train_dataloader):
-        b_size = len(batch["images"])
-        vae_batch_size = b_size if args.vae_batch_size is None else args.vae_batch_size
-        flip_aug = batch["flip_aug"]
-        alpha_mask = batch["alpha_mask"]
-        random_crop = batch["random_crop"]
-        bucket_reso = batch["bucket_reso"]
-
-        # バッチを分割して処理する
-        for i in range(0, b_size, vae_batch_size):
-            images = batch["images"][i : i + vae_batch_size]
-            absolute_paths = batch["absolute_paths"][i : i + vae_batch_size]
-            resized_sizes = batch["resized_sizes"][i : i + vae_batch_size]
-
-            image_infos = []
-            for i, (image, absolute_path, resized_size) in enumerate(zip(images, absolute_paths, resized_sizes)):
-                image_info = train_util.ImageInfo(absolute_path, 1, "dummy", False, absolute_path)
-                image_info.image = image
-                image_info.bucket_reso = bucket_reso
-                image_info.resized_size = resized_size
-                image_info.latents_npz = os.path.splitext(absolute_path)[0] + ".npz"
-
-                if args.skip_existing:
-                    if train_util.is_disk_cached_latents_is_expected(
-                        image_info.bucket_reso, image_info.latents_npz, flip_aug, alpha_mask
-                    ):
-                        logger.warning(f"Skipping {image_info.latents_npz} because it already exists.")
-                        continue
-
-                image_infos.append(image_info)
-
-            if len(image_infos) > 0:
-                train_util.cache_batch_latents(vae, True, image_infos, flip_aug, alpha_mask, random_crop)
+    # each shard writes its own shard files and index to the sharded store
+    if args.latents_cache_dir is not None:
+        latents_store = train_util.ShardedLatentsStore(args.latents_cache_dir, str(shard_index))
+    else:
+        latents_store = None
+
+    if args.skip_existing:
+        # the manifest is only read here, it is written in the merge step
+        manifest = train_util.LatentsCacheManifest()
+
+        def check_cache(info_and_subset) -> bool:
+            info, subset = info_and_subset
+            if latents_store is not None:
+                return latents_store.is_cached(info.latents_store_key, info.bucket_reso, subset.flip_aug, subset.alpha_mask)
+            return train_util.check_disk_cached_latents(
+                info.absolute_path, info.latents_npz, info.bucket_reso, subset.flip_aug, subset.alpha_mask, manifest
+            )
+
+        cache_availables = train_util.map_in_threads(check_cache, shard_infos, desc="check existing caches")
+        for (info, _), cache_available in zip(shard_infos, cache_availables):
+            if cache_available:
+                logger.warning(f"Skipping {info.absolute_path} because it already exists.")
+        shard_infos = [info_and_subset for info_and_subset, available in zip(shard_infos, cache_availables) if not available]
+
+    image_to_subset = {info.image_key: subset for info, subset in shard_infos}
+    vae_batch_size = args.train_batch_size if args.vae_batch_size is None else args.vae_batch_size
+    batches = train_util.make_batches_for_latents_caching([info for info, _ in shard_infos], image_to_subset, vae_batch_size)
+
+    def save_batch(condition, image_infos, latents, flipped_latents, alpha_masks):
+        train_util.save_batch_latents(
+            True, image_infos, latents, flipped_latents, alpha_masks, condition.flip_aug, latents_store, args.cache_storage_dtype
+        )
+        if journal is not None:
+            journal.record(image_infos, condition.flip_aug, condition.alpha_mask)
+
+    def flush_journal():
+        # the journal must not be ahead of the caches
+        writer.flush()
+        if latents_store is not None:
+            latents_store.flush()
+        if journal is not None:
+            journal.flush()
+
+    # images are loaded in worker threads and files are written in background while the next batch is encoded
+    with train_util.AsyncCacheWriter() as writer:
+        pipeline = train_util.encode_batches_for_latents_caching(vae, batches)
+        for i, (condition, image_infos, latents, flipped_latents, alpha_masks) in enumerate(
+            tqdm(pipeline, total=len(batches), smoothing=1)
+        ):
+            writer.submit(save_batch, condition, image_infos, latents, flipped_latents, alpha_masks)
+            if (i + 1) % JOURNAL_FLUSH_INTERVAL == 0:
+                flush_journal()
+        flush_journal()
+
+    if latents_store is not None:
+        latents_store.close()
 
     accelerator.wait_for_everyone()
-    accelerator.print(f"Finished caching latents for {len(train_dataset_group)} batches.")
+    accelerator.print(f"Finished caching latents for {len(batches)} batches in shard {shard_index}/{num_shards}.")
+
+    if num_shards == accelerator.num_processes and journal_dir is not None:
+        # all shards are processed by this launch. plain npz files without journal need no merge
+        if accelerator.is_main_process:
+            merge_caches(args, journal_dir)
+    else:
+        logger.info(
+            "run with --merge_only after all shards are finished / 全shardの終了後に--merge_onlyを指定して実行してください"
+        )
 
 
 def setup_parser() -> argparse.ArgumentParser:
@@ -193,6 +325,33 @@ def setup_parser() -> argparse.ArgumentParser:
         action="store_true",
         help="skip images if npz already exists (both normal and flipped exists if flip_aug is enabled) / npzが既に存在する画像をスキップする（flip_aug有効時は通常、反転の両方が存在する画像をスキップ）",
     )
+    parser.add_argument(
+        "--num_shards",
+        type=int,
+        default=None,
+        help="split images into this number of shards by hash of the path, default is number of processes of accelerate"
+        + " / 画像をパスのハッシュでこの数のshardに分ける。デフォルトはaccelerateのプロセス数",
+    )
+    parser.add_argument(
+        "--shard_index",
+        type=int,
+        default=None,
+        help="index of the shard processed by this process (0 to num_shards-1), default is process index of accelerate"
+        + " / このプロセスが処理するshardの番号（0～num_shards-1）。デフォルトはaccelerateのプロセス番号",
+    )
+    parser.add_argument(
+        "--journal_dir",
+        type=str,
+        default=None,
+        help="directory for progress journals to resume caching, default is latents_cache_dir"
+        + " / 再開用の進捗記録のディレクトリ。デフォルトはlatents_cache_dir",
+    )
+    parser.add_argument(
+        "--merge_only",
+        action="store_true",
+        help="only merge the results of all shards into one cache manifest (index), run after all shards are finished"
+        + " / 全shardの結果をひとつのmanifest（index）にまとめる処理のみを行う。全shardの終了後に実行する",
+    )
     return parser
 
 
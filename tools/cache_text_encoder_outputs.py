@@ -30,11 +30,6 @@ def cache_to_disk(args: argparse.Namespace) -> None:
         args.cache_text_encoder_outputs_to_disk
     ), "cache_text_encoder_outputs_to_disk must be True / cache_text_encoder_outputs_to_diskはTrueである必要があります"
 
-    # できるだけ準備はしておくが今のところSDXLのみしか動かない
-    assert (
-        args.sdxl
-    ), "cache_text_encoder_outputs_to_disk is only available for SDXL / cache_text_encoder_outputs_to_diskはSDXLのみ利用可能です"
-
     use_dreambooth_method = args.in_json is None
 
     if args.seed is not None:
@@ -122,6 +117,7 @@ def cache_to_disk(args: argparse.Namespace) -> None:
 
     # dataloaderを準備する
     train_dataset_group.set_caching_mode("text")
+    train_dataset_group.set_text_encoder_outputs_variants(args.cache_text_encoder_outputs_variants)
 
     # DataLoaderのプロセス数：0 は persistent_workers が使えないので注意
     n_workers = min(args.max_data_loader_n_workers, os.cpu_count())  # cpu_count or max_data_loader_n_workers
@@ -138,6 +134,10 @@ def cache_to_disk(args: argparse.Namespace) -> None:
     # acceleratorを使ってモデルを準備する：マルチGPUで使えるようになるはず
     train_dataloader = accelerator.prepare(train_dataloader)
 
+    # files are written in background while the next batch is encoded
+    writer = train_util.AsyncCacheWriter()
+    cache_params = train_util.get_text_encoder_outputs_cache_params(args.sdxl, args.clip_skip, args.max_token_length, args.v2)
+
     # データ取得のためのループ
     for batch in tqdm(train_dataloader):
         absolute_paths = batch["absolute_paths"]
@@ -151,7 +151,9 @@ def cache_to_disk(args: argparse.Namespace) -> None:
             image_info
 
             if args.skip_existing:
-                if os.path.exists(image_info.text_encoder_outputs_npz):
+                if train_util.is_disk_cached_text_encoder_outputs_valid(
+                    image_info.text_encoder_outputs_npz, args.sdxl, args.cache_text_encoder_outputs_variants, cache_params
+                ):
                     logger.warning(f"Skipping {image_info.text_encoder_outputs_npz} because it already exists.")
                     continue
                 
@@ -161,11 +163,28 @@ def cache_to_disk(args: argparse.Namespace) -> None:
 
         if len(image_infos) > 0:
             b_input_ids1 = torch.stack([image_info.input_ids1 for image_info in image_infos])
-            b_input_ids2 = torch.stack([image_info.input_ids2 for image_info in image_infos])
+            b_input_ids2 = torch.stack([image_info.input_ids2 for image_info in image_infos]) if args.sdxl else None
+            if args.cache_text_encoder_outputs_variants > 1:
+                # b,num_variants,... -> b*num_variants,...
+                b_input_ids1 = b_input_ids1.flatten(0, 1)
+                b_input_ids2 = b_input_ids2.flatten(0, 1) if b_input_ids2 is not None else None
             train_util.cache_batch_text_encoder_outputs(
-                image_infos, tokenizers, text_encoders, args.max_token_length, True, b_input_ids1, b_input_ids2, weight_dtype
+                image_infos,
+                tokenizers,
+                text_encoders,
+                args.max_token_length,
+                True,
+                b_input_ids1,
+                b_input_ids2,
+                weight_dtype,
+                writer,
+                args.cache_storage_dtype,
+                args.clip_skip,
+                args.v2,
+                args.cache_text_encoder_outputs_variants,
             )
 
+    writer.close()  # wait for all writes
     accelerator.wait_for_everyone()
     accelerator.print(f"Finished caching latents for {len(train_dataset_group)} batches.")
 
@@ -107,6 +107,9 @@ def train(args):
     ds_for_collator = train_dataset_group if args.max_data_loader_n_workers == 0 else None
     collator = train_util.collator_class(current_epoch, current_step, ds_for_collator)
 
+    if args.device_augmentation:
+        train_dataset_group.enable_device_augmentation()
+
     train_dataset_group.verify_bucket_reso_steps(64)
 
     if args.debug_dataset:
@@ -123,6 +126,9 @@ def train(args):
             train_dataset_group.is_latent_cacheable()
         ), "when caching latents, either color_aug or random_crop cannot be used / latentをキャッシュするときはcolor_augとrandom_cropは使えません"
 
+    if args.cache_images_in_memory_mb is not None and not cache_latents:
+        train_dataset_group.cache_images_in_memory(args.cache_images_in_memory_mb * 1024 * 1024)
+
     # acceleratorを準備する
     logger.info("prepare accelerator")
     accelerator = train_util.prepare_accelerator(args)
@@ -274,6 +280,7 @@ def train(args):
         collate_fn=collator,
         num_workers=n_workers,
         persistent_workers=args.persistent_data_loader_workers,
+        pin_memory=torch.cuda.is_available(),
     )
 
     # 学習ステップ数を計算する
@@ -418,10 +425,11 @@ def train(args):
             accelerator.print(f"\nepoch {epoch+1}/{num_train_epochs}")
         current_epoch.value = epoch + 1
 
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(train_util.DevicePrefetcher(train_dataloader, accelerator.device)):
             current_step.value = global_step
             with accelerator.accumulate(controlnet):
                 with torch.no_grad():
+                    train_util.apply_device_augmentation(batch, accelerator.device)
                     if "latents" in batch and batch["latents"] is not None:
                         latents = batch["latents"].to(accelerator.device).to(dtype=weight_dtype)
                     else:
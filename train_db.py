@@ -90,6 +90,9 @@ def train(args):
     ds_for_collator = train_dataset_group if args.max_data_loader_n_workers == 0 else None
     collator = train_util.collator_class(current_epoch, current_step, ds_for_collator)
 
+    if args.device_augmentation:
+        train_dataset_group.enable_device_augmentation()
+
     if args.no_token_padding:
         train_dataset_group.disable_token_padding()
 
@@ -104,6 +107,9 @@ def train(args):
             train_dataset_group.is_latent_cacheable()
         ), "when caching latents, either color_aug or random_crop cannot be used / latentをキャッシュするときはcolor_augとrandom_cropは使えません"
 
+    if args.cache_images_in_memory_mb is not None and not cache_latents:
+        train_dataset_group.cache_images_in_memory(args.cache_images_in_memory_mb * 1024 * 1024)
+
     # acceleratorを準備する
     logger.info("prepare accelerator")
 
@@ -196,6 +202,7 @@ def train(args):
         collate_fn=collator,
         num_workers=n_workers,
         persistent_workers=args.persistent_data_loader_workers,
+        pin_memory=torch.cuda.is_available(),
     )
 
     # 学習ステップ数を計算する
@@ -308,7 +315,7 @@ def train(args):
         if args.gradient_checkpointing or global_step < args.stop_text_encoder_training:
             text_encoder.train()
 
-        for step, batch in enumerate(train_dataloader):
+        for step, batch in enumerate(train_util.DevicePrefetcher(train_dataloader, accelerator.device)):
             current_step.value = global_step
             # 指定したステップ数でText Encoderの学習を止める
             if global_step == args.stop_text_encoder_training:
@@ -321,6 +328,8 @@ def train(args):
 
             with accelerator.accumulate(*training_models):
                 with torch.no_grad():
+                    train_util.apply_device_augmentation(batch, accelerator.device)
+
                     # latentに変換
                     if cache_latents:
                         latents = batch["latents"].to(accelerator.device).to(dtype=weight_dtype)
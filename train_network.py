@@ -95,6 +95,25 @@ class NetworkTrainer:
         return logs
 
     def assert_extra_args(self, args, train_dataset_group):
+        if args.cache_text_encoder_outputs_to_disk and not args.cache_text_encoder_outputs:
+            args.cache_text_encoder_outputs = True
+            logger.warning(
+                "cache_text_encoder_outputs is enabled because cache_text_encoder_outputs_to_disk is enabled / "
+                + "cache_text_encoder_outputs_to_diskが有効になっているためcache_text_encoder_outputsが有効になりました"
+            )
+
+        if args.cache_text_encoder_outputs:
+            assert (
+                train_dataset_group.is_text_encoder_output_cacheable(args.cache_text_encoder_outputs_variants)
+            ), "when caching Text Encoder output, either caption_dropout_rate, shuffle_caption, token_warmup_step or caption_tag_dropout_rate cannot be used / Text Encoderの出力をキャッシュするときはcaption_dropout_rate, shuffle_caption, token_warmup_step, caption_tag_dropout_rateは使えません"
+            assert (
+                not args.weighted_captions
+            ), "weighted_captions cannot be used with caching Text Encoder outputs / Text Encoderの出力をキャッシュするときはweighted_captionsは使えません"
+
+        assert (
+            args.network_train_unet_only or not args.cache_text_encoder_outputs
+        ), "network for Text Encoder cannot be trained with caching Text Encoder outputs / Text Encoderの出力をキャッシュしながらText Encoderのネットワークを学習することはできません"
+
         train_dataset_group.verify_bucket_reso_steps(64)
 
     def load_target_model(self, args, weight_dtype, accelerator):
@@ -106,18 +125,55 @@ class NetworkTrainer:
         return tokenizer
 
     def is_text_encoder_outputs_cached(self, args):
-        return False
+        return args.cache_text_encoder_outputs
 
     def is_train_text_encoder(self, args):
         return not args.network_train_unet_only and not self.is_text_encoder_outputs_cached(args)
 
     def cache_text_encoder_outputs_if_needed(
-        self, args, accelerator, unet, vae, tokenizers, text_encoders, data_loader, weight_dtype
+        self, args, accelerator, unet, vae, tokenizers, text_encoders, dataset: train_util.DatasetGroup, weight_dtype
     ):
-        for t_enc in text_encoders:
-            t_enc.to(accelerator.device, dtype=weight_dtype)
+        if args.cache_text_encoder_outputs:
+            if not args.lowram:
+                # メモリ消費を減らす
+                logger.info("move vae and unet to cpu to save memory")
+                org_vae_device = vae.device
+                org_unet_device = unet.device
+                vae.to("cpu")
+                unet.to("cpu")
+                clean_memory_on_device(accelerator.device)
+
+            # When TE is not be trained, it will not be prepared so we need to use explicit autocast
+            with accelerator.autocast():
+                dataset.cache_text_encoder_outputs(
+                    tokenizers,
+                    text_encoders,
+                    accelerator.device,
+                    weight_dtype,
+                    args.cache_text_encoder_outputs_to_disk,
+                    accelerator.is_main_process,
+                    args.clip_skip,
+                    args.v2,
+                    args.cache_text_encoder_outputs_variants,
+                )
+
+            for t_enc in text_encoders:
+                t_enc.to("cpu", dtype=torch.float32)  # Text Encoder doesn't work with fp16 on CPU
+            clean_memory_on_device(accelerator.device)
+
+            if not args.lowram:
+                logger.info("move vae and unet back to original device")
+                vae.to(org_vae_device)
+                unet.to(org_unet_device)
+        else:
+            # Text Encoderから毎回出力を取得するので、GPUに乗せておく
+            for t_enc in text_encoders:
+                t_enc.to(accelerator.device, dtype=weight_dtype)
 
     def get_text_cond(self, args, accelerator, batch, tokenizers, text_encoders, weight_dtype):
+        if batch.get("text_encoder_outputs1_list") is not None:
+            return batch["text_encoder_outputs1_list"].to(accelerator.device).to(weight_dtype)
+
         input_ids = batch["input_ids"].to(accelerator.device)
         encoder_hidden_states = train_util.get_hidden_states(args, input_ids, tokenizers[0], text_encoders[0], weight_dtype)
         return encoder_hidden_states
@@ -205,6 +261,9 @@ class NetworkTrainer:
         ds_for_collator = train_dataset_group if args.max_data_loader_n_workers == 0 else None
         collator = train_util.collator_class(current_epoch, current_step, ds_for_collator)
 
+        if args.device_augmentation:
+            train_dataset_group.enable_device_augmentation()
+
         if args.debug_dataset:
             train_util.debug_dataset(train_dataset_group)
             return
@@ -219,6 +278,9 @@ class NetworkTrainer:
                 train_dataset_group.is_latent_cacheable()
             ), "when caching latents, either color_aug or random_crop cannot be used / latentをキャッシュするときはcolor_augとrandom_cropは使えません"
 
+        if args.cache_images_in_memory_mb is not None and not cache_latents and isinstance(train_dataset_group, train_util.DatasetGroup):
+            train_dataset_group.cache_images_in_memory(args.cache_images_in_memory_mb * 1024 * 1024)
+
         self.assert_extra_args(args, train_dataset_group)
 
         # acceleratorを準備する
@@ -309,6 +371,7 @@ class NetworkTrainer:
         if network is None:
             return
         network_has_multiplier = hasattr(network, "set_multiplier")
+        network_has_per_sample_multiplier = getattr(network, "PER_SAMPLE_MULTIPLIER_SUPPORTED", False)
 
         if hasattr(network, "prepare_network"):
             network.prepare_network(args)
@@ -377,6 +440,7 @@ class NetworkTrainer:
             collate_fn=collator,
             num_workers=n_workers,
             persistent_workers=args.persistent_data_loader_workers,
+            pin_memory=torch.cuda.is_available(),
         )
 
         # 学習ステップ数を計算する
@@ -844,7 +908,16 @@ class NetworkTrainer:
                 init_kwargs=init_kwargs,
             )
 
-        loss_recorder = train_util.LossRecorder()
+        loss_recorder = train_util.LossRecorder(args.loss_sync_steps)
+
+        # if all datasets have the same multiplier, we don't need to check multipliers in each batch (it syncs the device)
+        if isinstance(train_dataset_group, train_util.DatasetGroup):
+            dataset_multipliers = set(
+                dataset.get_network_multiplier(subset) for dataset in train_dataset_group.datasets for subset in dataset.subsets
+            )
+        else:
+            dataset_multipliers = {train_dataset_group.network_multiplier}
+        uniform_multiplier = dataset_multipliers.pop() if len(dataset_multipliers) == 1 else None
         del train_dataset_group
 
         # callback for step start
@@ -877,7 +950,13 @@ class NetworkTrainer:
                 accelerator.print(f"removing old checkpoint: {old_ckpt_file}")
                 os.remove(old_ckpt_file)
 
+        def reset_multiplier_for_sampling():
+            # per-sample multipliers of the last batch must not be applied to the batch for sampling
+            if network_has_multiplier and uniform_multiplier is None:
+                accelerator.unwrap_model(network).set_multiplier(1.0)
+
         # For --sample_at_first
+        reset_multiplier_for_sampling()
         self.sample_images(accelerator, args, 0, global_step, accelerator.device, vae, tokenizer, text_encoder, unet)
 
         # training loop
@@ -900,7 +979,7 @@ class NetworkTrainer:
                 skipped_dataloader = accelerator.skip_first_batches(train_dataloader, initial_step - 1)
                 initial_step = 1
 
-            for step, batch in enumerate(skipped_dataloader or train_dataloader):
+            for step, batch in enumerate(train_util.DevicePrefetcher(skipped_dataloader or train_dataloader, accelerator.device)):
                 current_step.value = global_step
                 if initial_step > 0:
                     initial_step -= 1
@@ -909,6 +988,7 @@ class NetworkTrainer:
                 with accelerator.accumulate(training_model):
                     on_step_start(text_encoder, unet)
 
+                    train_util.apply_device_augmentation(batch, accelerator.device)
                     if "latents" in batch and batch["latents"] is not None:
                         latents = batch["latents"].to(accelerator.device).to(dtype=weight_dtype)
                     else:
@@ -931,13 +1011,15 @@ class NetworkTrainer:
                     latents = latents * self.vae_scale_factor
 
                     # get multiplier for each sample
-                    if network_has_multiplier:
+                    if network_has_multiplier and uniform_multiplier is not None:
+                        accelerator.unwrap_model(network).set_multiplier(uniform_multiplier)
+                    elif network_has_multiplier:
                         multipliers = batch["network_multipliers"]
                         # if all multipliers are same, use single multiplier
                         if torch.all(multipliers == multipliers[0]):
                             multipliers = multipliers[0].item()
-                        else:
-                            raise NotImplementedError("multipliers for each sample is not supported yet")
+                        elif not network_has_per_sample_multiplier:
+                            raise NotImplementedError("multipliers for each sample is not supported by this network")
                         # print(f"set multiplier: {multipliers}")
                         accelerator.unwrap_model(network).set_multiplier(multipliers)
 
@@ -1022,10 +1104,10 @@ class NetworkTrainer:
                     optimizer.zero_grad(set_to_none=True)
 
                 if args.scale_weight_norms:
+                    # values may be tensors on the device, converted to float when logged
                     keys_scaled, mean_norm, maximum_norm = accelerator.unwrap_model(network).apply_max_norm_regularization(
                         args.scale_weight_norms, accelerator.device
                     )
-                    max_mean_logs = {"Keys Scaled": keys_scaled, "Average key norm": mean_norm}
                 else:
                     keys_scaled, mean_norm, maximum_norm = None, None, None
 
@@ -1034,6 +1116,7 @@ class NetworkTrainer:
                     progress_bar.update(1)
                     global_step += 1
 
+                    reset_multiplier_for_sampling()
                     self.sample_images(accelerator, args, None, global_step, accelerator.device, vae, tokenizer, text_encoder, unet)
 
                     # 指定ステップごとにモデルを保存
@@ -1051,20 +1134,27 @@ class NetworkTrainer:
                                 remove_ckpt_name = train_util.get_step_ckpt_name(args, "." + args.save_model_as, remove_step_no)
                                 remove_model(remove_ckpt_name)
 
-                current_loss = loss.detach().item()
-                loss_recorder.add(epoch=epoch, step=step, loss=current_loss)
-                avr_loss: float = loss_recorder.moving_average
-                logs = {"avr_loss": avr_loss}  # , "lr": lr_scheduler.get_last_lr()[0]}
-                progress_bar.set_postfix(**logs)
-
-                if args.scale_weight_norms:
-                    progress_bar.set_postfix(**{**max_mean_logs, **logs})
-
-                if args.logging_dir is not None:
-                    logs = self.generate_step_logs(
-                        args, current_loss, avr_loss, lr_scheduler, lr_descriptions, keys_scaled, mean_norm, maximum_norm
-                    )
-                    accelerator.log(logs, step=global_step)
+                # loss is copied to host every loss_sync_steps steps, logs are updated only at that time
+                loss_recorder.add(epoch=epoch, step=step, loss=loss)
+                if global_step >= args.max_train_steps:
+                    loss_recorder.sync()
+
+                if loss_recorder.is_synced:
+                    current_loss = loss_recorder.last_loss
+                    avr_loss: float = loss_recorder.moving_average
+                    logs = {"avr_loss": avr_loss}  # , "lr": lr_scheduler.get_last_lr()[0]}
+                    progress_bar.set_postfix(**logs)
+
+                    if args.scale_weight_norms:
+                        keys_scaled, mean_norm, maximum_norm = int(keys_scaled), float(mean_norm), float(maximum_norm)
+                        max_mean_logs = {"Keys Scaled": keys_scaled, "Average key norm": mean_norm}
+                        progress_bar.set_postfix(**{**max_mean_logs, **logs})
+
+                    if args.logging_dir is not None:
+                        logs = self.generate_step_logs(
+                            args, current_loss, avr_loss, lr_scheduler, lr_descriptions, keys_scaled, mean_norm, maximum_norm
+                        )
+                        accelerator.log(logs, step=global_step)
 
                 if global_step >= args.max_train_steps:
                     break
@@ -1090,6 +1180,7 @@ class NetworkTrainer:
                     if args.save_state:
                         train_util.save_and_remove_state_on_epoch_end(args, accelerator, epoch + 1)
 
+            reset_multiplier_for_sampling()
             self.sample_images(accelerator, args, epoch + 1, global_step, accelerator.device, vae, tokenizer, text_encoder, unet)
 
             # end of epoch
@@ -1124,7 +1215,15 @@ def setup_parser() -> argparse.ArgumentParser:
     train_util.add_optimizer_arguments(parser)
     config_util.add_config_arguments(parser)
     custom_train_functions.add_custom_train_arguments(parser)
+    train_util.add_text_encoder_caching_arguments(parser)
 
+    parser.add_argument(
+        "--loss_sync_steps",
+        type=int,
+        default=1,
+        help="copy the loss to CPU and update the progress bar and logs every N steps to avoid waiting for the GPU every step"
+        + " / N ステップごとにlossをCPUにコピーし進捗表示とログを更新する（毎ステップのGPU待ちを避ける）",
+    )
     parser.add_argument(
         "--no_metadata", action="store_true", help="do not save metadata in output model / メタデータを出力先モデルに保存しない"
     )
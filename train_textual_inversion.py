@@ -322,6 +322,9 @@ class TextualInversionTrainer:
         ds_for_collator = train_dataset_group if args.max_data_loader_n_workers == 0 else None
         collator = train_util.collator_class(current_epoch, current_step, ds_for_collator)
 
+        if args.device_augmentation:
+            train_dataset_group.enable_device_augmentation()
+
         # make captions: tokenstring tokenstring1 tokenstring2 ...tokenstringn という文字列に書き換える超乱暴な実装
         if use_template:
             accelerator.print(f"use template for training captions. is object: {args.use_object_template}")
@@ -358,6 +361,9 @@ class TextualInversionTrainer:
                 train_dataset_group.is_latent_cacheable()
             ), "when caching latents, either color_aug or random_crop cannot be used / latentをキャッシュするときはcolor_augとrandom_cropは使えません"
 
+        if args.cache_images_in_memory_mb is not None and not cache_latents and isinstance(train_dataset_group, train_util.DatasetGroup):
+            train_dataset_group.cache_images_in_memory(args.cache_images_in_memory_mb * 1024 * 1024)
+
         # モデルに xformers とか memory efficient attention を組み込む
         train_util.replace_unet_modules(unet, args.mem_eff_attn, args.xformers, args.sdpa)
         if torch.__version__ >= "2.0.0":  # PyTorch 2.0.0 以上対応のxformersなら以下が使える
@@ -397,6 +403,7 @@ class TextualInversionTrainer:
             collate_fn=collator,
             num_workers=n_workers,
             persistent_workers=args.persistent_data_loader_workers,
+            pin_memory=torch.cuda.is_available(),
         )
 
         # 学習ステップ数を計算する
@@ -556,10 +563,11 @@ class TextualInversionTrainer:
 
             loss_total = 0
 
-            for step, batch in enumerate(train_dataloader):
+            for step, batch in enumerate(train_util.DevicePrefetcher(train_dataloader, accelerator.device)):
                 current_step.value = global_step
                 with accelerator.accumulate(text_encoders[0]):
                     with torch.no_grad():
+                        train_util.apply_device_augmentation(batch, accelerator.device)
                         if "latents" in batch and batch["latents"] is not None:
                             latents = batch["latents"].to(accelerator.device).to(dtype=weight_dtype)
                         else: